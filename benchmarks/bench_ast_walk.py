@@ -0,0 +1,155 @@
+r"""
+`pandoc_utils.walk_ast` against `pandocfilters.walk` on large ASTs.
+
+For the synthetic documents of `bench_filter_throughput.py` at several
+scales, this times (best of a few repeats):
+
+* `traverse`: a walk with an action that changes nothing, for the node
+  types `LatexFilter` handles, i.e. the cost of the walk itself;
+* `filter`: the `LatexFilter` walk, after the environment bodies were
+  converted (offline, see `bench_filter_throughput.offline`), so that only
+  the walk and the filter's own work are timed.
+
+A last case nests a paragraph in a few thousand block quotes, which
+`pandocfilters.walk` can't walk within Python's recursion limit.
+
+Run with:
+
+    python benchmarks/bench_ast_walk.py
+    python benchmarks/bench_ast_walk.py -s 1 -s 32
+"""
+import json
+import time
+from optparse import OptionParser
+
+from pandocfilters import walk, Para, Str, BlockQuote
+
+from pynoweb_tools.pandoc_utils import (LatexFilter, walk_ast,
+                                        filter_node_types)
+
+from bench_filter_throughput import (base_counts, make_doc, count_nodes,
+                                     offline)
+
+
+def null_action(key, value, oformat, meta):
+    return None
+
+
+def best_time(func, make_args, repeats):
+    r''' The best time of `repeats` calls of `func` on fresh arguments from
+    `make_args` (which isn't timed).
+    '''
+    times = []
+    for _ in range(repeats):
+        args = make_args()
+        start_time = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def traverse_case(doc_json, repeats):
+    handlers = dict.fromkeys(filter_node_types, null_action)
+
+    def make_args():
+        return (json.loads(doc_json),)
+
+    return (best_time(lambda doc: walk(doc, null_action, 'html', {}),
+                      make_args, repeats),
+            best_time(lambda doc: walk_ast(doc, handlers, 'html', {}),
+                      make_args, repeats))
+
+
+def filter_case(doc_json, repeats):
+    def make_args():
+        doc = json.loads(doc_json)
+        latex_filter = LatexFilter(doc['meta'])
+        latex_filter.batch_convert_latex_envs(doc['blocks'])
+        return doc, latex_filter
+
+    def run():
+        return (
+            best_time(lambda doc, f: walk(doc, f, 'html', doc['meta']),
+                      make_args, repeats),
+            best_time(lambda doc, f: f.walk(doc, 'html', doc['meta']),
+                      make_args, repeats))
+
+    return offline(run)
+
+
+def deep_case(depth, repeats):
+    def make_args():
+        block = Para([Str('x')])
+        for _ in range(depth):
+            block = BlockQuote([block])
+        return ([block],)
+
+    try:
+        walk_seconds = best_time(
+            lambda blocks: walk(blocks, null_action, 'html', {}),
+            make_args, repeats)
+    except RecursionError:
+        walk_seconds = None
+
+    handlers = dict.fromkeys(filter_node_types, null_action)
+    walk_ast_seconds = best_time(
+        lambda blocks: walk_ast(blocks, handlers, 'html', {}),
+        make_args, repeats)
+
+    return walk_seconds, walk_ast_seconds
+
+
+def run(scales=(1, 4, 16), depth=5000, repeats=3):
+    results = []
+    for scale in scales:
+        counts = dict((k, v * scale) for k, v in base_counts.items())
+        doc_json = json.dumps(make_doc(**counts))
+        n_nodes = count_nodes(json.loads(doc_json)['blocks'])
+
+        for kind, case in (('traverse', traverse_case),
+                           ('filter', filter_case)):
+            walk_seconds, walk_ast_seconds = case(doc_json, repeats)
+            results.append(('{}_{}'.format(kind, scale), n_nodes,
+                            walk_seconds, walk_ast_seconds))
+
+    walk_seconds, walk_ast_seconds = deep_case(depth, repeats)
+    results.append(('deep_{}'.format(depth), depth + 2, walk_seconds,
+                    walk_ast_seconds))
+
+    return results
+
+
+def main():
+    parser = OptionParser(
+        usage="python benchmarks/bench_ast_walk.py [options]")
+    parser.add_option("-s", "--scale",
+                      dest="scales", action="append", type="int",
+                      default=[],
+                      help=("Document scale factor; can be repeated: "
+                            "Default 1, 4 and 16"))
+    parser.add_option("-d", "--depth",
+                      dest="depth", type="int", default=5000,
+                      help="Nesting depth of the deep document")
+    parser.add_option("-r", "--repeats",
+                      dest="repeats", type="int", default=3,
+                      help="Timed runs per case (the best is kept)")
+
+    (options, args) = parser.parse_args()
+
+    results = run(options.scales or (1, 4, 16), options.depth,
+                  options.repeats)
+
+    print("{:<14} {:>8} {:>10} {:>12} {:>8}".format(
+        'case', 'nodes', 'walk (s)', 'walk_ast (s)', 'speedup'))
+    for name, n_nodes, walk_seconds, walk_ast_seconds in results:
+        if walk_seconds is None:
+            print("{:<14} {:>8} {:>10} {:>12.4f} {:>8}".format(
+                name, n_nodes, 'recursion', walk_ast_seconds, '-'))
+        else:
+            print("{:<14} {:>8} {:>10.4f} {:>12.4f} {:>8.1f}".format(
+                name, n_nodes, walk_seconds, walk_ast_seconds,
+                walk_seconds / walk_ast_seconds))
+
+
+if __name__ == '__main__':
+    main()
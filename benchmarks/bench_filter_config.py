@@ -0,0 +1,58 @@
+r"""
+Per-node cost of `latex_prefilter` as the number of AST nodes grows.
+
+The per-node time should stay flat; anything that grows with the
+document (e.g. configuration rebuilt, or accumulated, on every node) shows
+up as a per-node time that increases with the node count.
+
+Run with:
+
+    python benchmarks/bench_filter_config.py
+"""
+import time
+
+from pandocfilters import walk, Para, Str, Space, RawInline, Math
+
+from pynoweb_tools import pandoc_utils
+
+
+def make_doc(n_paras):
+    meta = {'preserved_tex': {'t': 'MetaList', 'c': ['\\autoref']},
+            'figure_ext': {'t': 'MetaString', 'c': 'png'}}
+    para = [RawInline('latex', '\\noindent'), Str('See'), Space(),
+            RawInline('latex', '\\cref{eq:a}'),
+            Space(), Math({'t': 'InlineMath', 'c': []}, 'x')]
+    blocks = [Para(list(para)) for _ in range(n_paras)]
+    return {'pandoc-api-version': [1, 17, 0, 5], 'meta': meta,
+            'blocks': blocks}
+
+
+def count_nodes(x):
+    if isinstance(x, list):
+        return sum(count_nodes(i) for i in x)
+    elif isinstance(x, dict):
+        return ('t' in x) + sum(count_nodes(v) for v in x.values())
+    return 0
+
+
+def run(sizes=(1000, 4000, 16000)):
+    results = []
+    for n_paras in sizes:
+        doc = make_doc(n_paras)
+        n_nodes = count_nodes(doc['blocks'])
+
+        start_time = time.perf_counter()
+        walk(doc, pandoc_utils.latex_prefilter, 'html', doc['meta'])
+        elapsed = time.perf_counter() - start_time
+
+        results.append((n_nodes, elapsed, 1e6 * elapsed / n_nodes))
+
+    return results
+
+
+if __name__ == '__main__':
+    print("{:>10} {:>10} {:>14}".format('nodes', 'total (s)',
+                                        'per node (us)'))
+    for n_nodes, elapsed, per_node in run():
+        print("{:>10} {:>10.3f} {:>14.2f}".format(n_nodes, elapsed,
+                                                  per_node))
@@ -0,0 +1,129 @@
+r"""
+Cold start time of `PynowebFilter`.
+
+Pandoc runs the filter in a new process for every document (and nested
+Pandoc conversions can run it again), so the time it takes to import the
+filter's entry point is paid every time.  This imports the entry point in
+fresh interpreters with `python -X importtime`, reports the best
+cumulative import time and the slowest modules, and fails when the import
+time exceeds a budget or when any of the weave-only packages (Pweave,
+Jupyter, etc.) were imported.
+
+Run with:
+
+    python benchmarks/bench_filter_import.py
+    python benchmarks/bench_filter_import.py --budget 150
+"""
+import sys
+import subprocess
+from optparse import OptionParser
+
+r""" The module `PynowebFilter` runs from (see `setup.py`).
+"""
+filter_module = 'pynoweb_tools.scripts'
+
+r""" Packages that only weaving needs, and that the filter mustn't import.
+"""
+weave_only_packages = ['pweave', 'jupyter_client', 'jupyter_core',
+                       'nbformat', 'nbconvert', 'IPython', 'zmq', 'tornado',
+                       'matplotlib']
+
+default_budget_ms = 250
+
+
+def import_times(module=filter_module):
+    r''' Import `module` in a fresh interpreter with `-X importtime`.
+
+    Returns
+    =======
+    A tuple of a dict mapping module names to `(self, cumulative)` import
+    times in microseconds, and the list of the top-level packages in
+    `sys.modules` afterwards.
+    '''
+    code = ("import sys, {}; "
+            "print('\\n'.join(sorted(set(m.split('.')[0] "
+            "for m in sys.modules))))").format(module)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+
+    times = dict()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            # The header.
+            continue
+        times[fields[2].strip()] = (self_us, cumulative_us)
+
+    return times, proc.stdout.split()
+
+
+def run(module=filter_module, repeats=5):
+    r''' Import `module` `repeats` times.
+
+    Returns
+    =======
+    A tuple of the best cumulative import time in milliseconds, the times
+    of that run and the imported packages.
+    '''
+    best = None
+    for _ in range(repeats):
+        times, packages = import_times(module)
+        if best is None or times[module][1] < best[0][module][1]:
+            best = (times, packages)
+
+    times, packages = best
+    return times[module][1] / 1000., times, packages
+
+
+def main():
+    parser = OptionParser(
+        usage="python benchmarks/bench_filter_import.py [options]")
+    parser.add_option("-b", "--budget",
+                      dest="budget", type="float", default=default_budget_ms,
+                      help=("Fail when the import takes longer, in "
+                            "milliseconds: Default {}".format(
+                                default_budget_ms)))
+    parser.add_option("-r", "--repeats",
+                      dest="repeats", type="int", default=5,
+                      help="Imports to run (the best is kept)")
+    parser.add_option("-n", "--top",
+                      dest="top", type="int", default=10,
+                      help="Number of the slowest modules to list")
+    parser.add_option("-m", "--module",
+                      dest="module", default=filter_module,
+                      help="The module to import")
+
+    (options, args) = parser.parse_args()
+
+    total_ms, times, packages = run(options.module, options.repeats)
+
+    print("{}: {:.1f} ms (budget {:.1f} ms)".format(
+        options.module, total_ms, options.budget))
+    print("{:>10}  {}".format('self (ms)', 'module'))
+    slowest = sorted(times.items(), key=lambda t: t[1][0], reverse=True)
+    for name, (self_us, _) in slowest[:options.top]:
+        print("{:>10.1f}  {}".format(self_us / 1000., name))
+
+    failures = []
+    if total_ms > options.budget:
+        failures.append("the import took {:.1f} ms, over the {:.1f} ms "
+                        "budget".format(total_ms, options.budget))
+
+    weave_only = [p for p in weave_only_packages if p in packages]
+    if weave_only:
+        failures.append("weave-only packages were imported: {}".format(
+            ', '.join(weave_only)))
+
+    if failures:
+        for failure in failures:
+            print("FAIL: {}".format(failure))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
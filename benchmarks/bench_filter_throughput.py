@@ -0,0 +1,371 @@
+r"""
+Throughput of the LaTeX prefilter on scaled synthetic documents.
+
+Each case is a Pandoc JSON AST with `N` LaTeX environments, `M` labeled
+figures, `K` display equations and many `\cref` inlines, scaled by a
+factor.  With `--nesting D`, each environment contains `D` levels of
+nested `proof` environments.  For each case, `LatexFilter.apply` is timed
+(best of a few repeats) and run once more under `tracemalloc` for its peak
+memory; the nested Pandoc conversions of environment bodies and any
+subprocesses started during the walk are counted.
+
+The nested conversions are stubbed (see `stub_convert_latex_env`), and the
+environment cache and Pandoc servers are disabled, so this runs offline
+and measures the filter itself.  A nested conversion count that grows
+faster than the number of nesting levels, or any subprocess, is a
+regression.
+
+The ASTs are generated, but they can be written out with
+`--write-fixtures DIR` (e.g. to check them into a branch, or to run them
+through a real Pandoc) and read back with `--fixtures DIR`.
+
+Results are written as JSON with `--output`, and compared with an earlier
+run's with `--compare`:
+
+    python benchmarks/bench_filter_throughput.py --output before.json
+    git checkout other-branch
+    python benchmarks/bench_filter_throughput.py --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import tracemalloc
+from optparse import OptionParser
+
+from pandocfilters import (Para, Str, Space, RawInline, RawBlock, Math,
+                           Image, Span, Header)
+
+from pynoweb_tools import pandoc_utils
+from pynoweb_tools.pandoc_utils import LatexFilter
+
+api_version = [1, 17, 0, 5]
+
+r""" The documents' contents at scale 1; the `scale` option multiplies
+these.
+"""
+base_counts = {'environments': 25, 'figures': 10, 'equations': 25,
+               'crefs': 100}
+
+env_names = ['theorem', 'lemma', 'example', 'remark']
+
+
+def words(text):
+    res = []
+    for word in text.split():
+        if res:
+            res.append(Space())
+        res.append(Str(word))
+    return res
+
+
+def nested_envs(depth):
+    r''' The LaTeX of `depth` levels of nested environments.
+    '''
+    env = ''
+    for level in reversed(range(depth)):
+        env = ('\\begin{{proof}}\nStep {0} uses $y_{0}$.\n\n{1}'
+               '\\end{{proof}}').format(level, env)
+    return env
+
+
+def make_doc(environments, figures, equations, crefs, nesting=0):
+    r''' A synthetic Pandoc JSON AST, as Pandoc would produce it from
+    LaTeX with raw TeX enabled.
+    '''
+    meta = {'figure_dir': {'t': 'MetaString', 'c': 'figures'},
+            'figure_ext': {'t': 'MetaString', 'c': 'png'}}
+
+    blocks = []
+    n_sections = max(environments, figures, equations, 1)
+    crefs_per_section = crefs // n_sections
+    ref_kinds = ['eq', 'thm', 'fig', 'sec']
+
+    for i in range(n_sections):
+        blocks.append(Header(2, ['sec:{}'.format(i), [], []],
+                             words('Section {}'.format(i))))
+
+        para = words('As shown in')
+        for j in range(crefs_per_section):
+            para += [Space(), RawInline(
+                'latex', '\\cref{{{}:{}}}'.format(ref_kinds[j % 4], j)),
+                Space(), Str('and'), Space(),
+                Math({'t': 'InlineMath', 'c': []}, 'x_{{{}}}'.format(j))]
+        para += [Str('.')]
+        blocks.append(Para(para))
+
+        if i < environments:
+            env_name = env_names[i % len(env_names)]
+            blocks.append(RawBlock('latex', (
+                '\\begin{{{0}}}[Result {1}]\\label{{thm:{1}}}\n'
+                'If $x_{1} > 0$ then \\cref{{eq:{1}}} holds for '
+                'all $n$.\n\n{2}\n'
+                '\\end{{{0}}}').format(env_name, i, nested_envs(nesting))))
+
+        if i < equations:
+            blocks.append(Para([Math({'t': 'DisplayMath', 'c': []},
+                                     'y_{0} = \\sum_i x_i^{0} '
+                                     '\\label{{eq:{0}}}'.format(i))]))
+
+        if i < figures:
+            caption = words('A plot of run {}'.format(i))
+            caption.append(Span(['', [], [['data-label',
+                                           'fig:{}'.format(i)]]], []))
+            blocks.append(Para([Image(
+                ['', [], []], caption,
+                ['plot_{}.pdf'.format(i), 'fig:'])]))
+
+    return {'pandoc-api-version': api_version, 'meta': meta,
+            'blocks': blocks}
+
+
+def stub_convert_latex_env(env_body):
+    r''' An offline stand-in for `pandoc_utils.convert_latex_env`.
+
+    The body's words become `Str`s, its inline math `Math` elements and its
+    environments `RawBlock`s.  Like Pandoc, it turns the batch separators
+    (see `pandoc_utils.convert_latex_envs`) into paragraphs of their own.
+    '''
+    stub_convert_latex_env.calls += 1
+
+    pars = []
+    for par in env_body.split('\n\n'):
+        if pars and pars[-1].count('\\begin{') > pars[-1].count('\\end{'):
+            pars[-1] += '\n\n' + par
+        else:
+            pars.append(par)
+
+    blocks = []
+    for par in pars:
+        if par.strip().startswith('\\begin{'):
+            blocks.append(RawBlock('latex', par.strip()))
+            continue
+
+        inlines = []
+        for i, part in enumerate(par.strip().split('$')):
+            if i % 2:
+                inlines.append(Math({'t': 'InlineMath', 'c': []}, part))
+            elif part.strip():
+                if inlines:
+                    inlines.append(Space())
+                inlines += words(part)
+        if inlines:
+            blocks.append(Para(inlines))
+
+    return json.dumps({'pandoc-api-version': api_version, 'meta': {},
+                       'blocks': blocks})
+
+
+stub_convert_latex_env.calls = 0
+
+
+def count_nodes(x):
+    if isinstance(x, list):
+        return sum(count_nodes(i) for i in x)
+    elif isinstance(x, dict):
+        return ('t' in x) + sum(count_nodes(v) for v in x.values())
+    return 0
+
+
+class SubprocessCounter(object):
+    r""" Counts the subprocesses started while it's active.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        self.popen_init = subprocess.Popen.__init__
+        counter = self
+
+        def counting_init(popen, *args, **kwargs):
+            counter.count += 1
+            return counter.popen_init(popen, *args, **kwargs)
+
+        subprocess.Popen.__init__ = counting_init
+        return self
+
+    def __exit__(self, *args):
+        subprocess.Popen.__init__ = self.popen_init
+
+
+def offline(func):
+    r''' Run `func` with the nested conversions stubbed, and the environment
+    cache and Pandoc servers disabled.
+    '''
+    saved = (pandoc_utils.convert_latex_env, pandoc_utils.env_cache,
+             pandoc_utils.pandoc_server_client)
+
+    pandoc_utils.convert_latex_env = stub_convert_latex_env
+    pandoc_utils.env_cache = False
+    pandoc_utils.pandoc_server_client = False
+    try:
+        return func()
+    finally:
+        (pandoc_utils.convert_latex_env, pandoc_utils.env_cache,
+         pandoc_utils.pandoc_server_client) = saved
+
+
+def run_case(name, doc_json, repeats=3):
+    r''' Benchmark the filter on one document (given as a JSON string, so
+    that each run gets a fresh copy).
+    '''
+    def filter_doc():
+        return LatexFilter().apply(json.loads(doc_json), 'html')
+
+    n_nodes = count_nodes(json.loads(doc_json)['blocks'])
+
+    def measure():
+        times = []
+        for _ in range(repeats):
+            stub_convert_latex_env.calls = 0
+            with SubprocessCounter() as subprocesses:
+                start_time = time.perf_counter()
+                filter_doc()
+                times.append(time.perf_counter() - start_time)
+            nested_conversions = stub_convert_latex_env.calls
+
+        tracemalloc.start()
+        try:
+            filter_doc()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        return {'case': name,
+                'nodes': n_nodes,
+                'seconds': min(times),
+                'per_node_us': 1e6 * min(times) / n_nodes,
+                'peak_kib': peak_bytes / 1024.,
+                'nested_conversions': nested_conversions,
+                'subprocesses': subprocesses.count}
+
+    return offline(measure)
+
+
+def generated_cases(scales, nesting=0):
+    for scale in scales:
+        counts = dict((k, v * scale) for k, v in base_counts.items())
+        name = 'scale_{}'.format(scale)
+        if nesting:
+            name += '_nested_{}'.format(nesting)
+        yield name, json.dumps(make_doc(nesting=nesting, **counts))
+
+
+def fixture_cases(fixture_dir):
+    for fname in sorted(os.listdir(fixture_dir)):
+        if fname.endswith('.json'):
+            with open(os.path.join(fixture_dir, fname), 'r') as f:
+                yield os.path.splitext(fname)[0], f.read()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_results(results, baseline=None):
+    r''' A plain-text table of the results, with the ratios to `baseline`'s
+    times and peak memory when it's given.
+    '''
+    baseline = dict((r['case'], r) for r in (baseline or {}).get(
+        'results', []))
+
+    header = "{:<18} {:>8} {:>10} {:>9} {:>10} {:>7} {:>6}".format(
+        'case', 'nodes', 'total (s)', 'node (us)', 'peak (KiB)', 'nested',
+        'procs')
+    if baseline:
+        header += " {:>8} {:>8}".format('time x', 'peak x')
+
+    lines = [header]
+    for r in results:
+        line = ("{case:<18} {nodes:>8} {seconds:>10.4f} "
+                "{per_node_us:>9.2f} {peak_kib:>10.1f} "
+                "{nested_conversions:>7} {subprocesses:>6}").format(**r)
+        base = baseline.get(r['case'], None)
+        if base is not None:
+            line += " {:>8.2f} {:>8.2f}".format(
+                r['seconds'] / base['seconds'],
+                r['peak_kib'] / base['peak_kib'])
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+
+def main():
+    parser = OptionParser(
+        usage="python benchmarks/bench_filter_throughput.py [options]")
+    parser.add_option("-s", "--scale",
+                      dest="scales", action="append", type="int",
+                      default=[],
+                      help=("Document scale; can be repeated: "
+                            "Default 1, 4 and 16"))
+    parser.add_option("-n", "--nesting",
+                      dest="nesting", type="int", default=0,
+                      help=("Levels of environments nested in each "
+                            "environment"))
+    parser.add_option("-r", "--repeats",
+                      dest="repeats", type="int", default=3,
+                      help="Timed runs per case (the best is kept)")
+    parser.add_option("--fixtures",
+                      dest="fixture_dir", default=None,
+                      help=("Benchmark the Pandoc JSON AST files in this "
+                            "directory instead of generated documents"))
+    parser.add_option("--write-fixtures",
+                      dest="write_fixture_dir", default=None,
+                      help="Write the generated documents to this directory")
+    parser.add_option("-o", "--output",
+                      dest="output", default=None,
+                      help="Write the results to this JSON file")
+    parser.add_option("-c", "--compare",
+                      dest="compare", default=None,
+                      help="Compare with the results in this JSON file")
+
+    (options, args) = parser.parse_args()
+
+    if options.fixture_dir is not None:
+        cases = list(fixture_cases(options.fixture_dir))
+    else:
+        cases = list(generated_cases(options.scales or [1, 4, 16],
+                                     options.nesting))
+
+    if options.write_fixture_dir is not None:
+        os.makedirs(options.write_fixture_dir, exist_ok=True)
+        for name, doc_json in cases:
+            with open(os.path.join(options.write_fixture_dir,
+                                   name + '.json'), 'w') as f:
+                f.write(doc_json)
+
+    results = [run_case(name, doc_json, options.repeats)
+               for name, doc_json in cases]
+
+    report = {'revision': git_revision(),
+              'python': platform.python_version(),
+              'results': results}
+
+    baseline = None
+    if options.compare is not None:
+        with open(options.compare, 'r') as f:
+            baseline = json.load(f)
+        print("Compared with revision {}".format(baseline.get('revision')))
+
+    print(format_results(results, baseline))
+
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if any(r['subprocesses'] for r in results):
+        sys.stderr.write("The filter started subprocesses.\n")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+r"""
+Incremental filtering (see `pynoweb_tools.incremental`) after small edits.
+
+For the synthetic documents of `bench_filter_throughput.py` at several
+scales, this times (best of a few repeats) `LatexFilter.apply`:
+
+* `full`: without incremental filtering;
+* `cold`: incremental, with an empty block store;
+* `unchanged`: incremental, after filtering the same document;
+* `edit_last`/`edit_first`: incremental, after editing the last/first
+  paragraph;
+* `new_env_first`: incremental, after adding an environment at the start,
+  so that every environment after it is renumbered.
+
+The `filtered` column is the number of environment blocks that were
+filtered (i.e. written to the store); the other blocks are always filtered
+(see `incremental.stored_block`).
+
+The environments have `--nesting` levels of nested environments, and the
+LaTeX subset fast path is disabled, like for bodies outside of it.  The
+nested conversions run offline (see `bench_filter_throughput.offline`),
+but with an environment cache that's warmed up before the timed runs, so
+`full` is a rebuild that doesn't need any nested Pandoc calls.  The caches
+are in a temporary directory.
+
+Run with:
+
+    python benchmarks/bench_incremental.py
+    python benchmarks/bench_incremental.py -s 1 -s 32 -n 4
+"""
+import os
+import json
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+from pandocfilters import Para, Str, RawBlock
+
+from pynoweb_tools import pandoc_utils
+from pynoweb_tools.cache import DiskCache
+from pynoweb_tools.pandoc_utils import LatexFilter
+
+from bench_filter_throughput import base_counts, make_doc, offline
+
+
+def edited(doc_json, case):
+    doc = json.loads(doc_json)
+    blocks = doc['blocks']
+    paras = [i for i, b in enumerate(blocks) if b['t'] == 'Para']
+
+    if case == 'edit_last':
+        blocks[paras[-1]] = Para([Str('Edited.')])
+    elif case == 'edit_first':
+        blocks[paras[0]] = Para([Str('Edited.')])
+    elif case == 'new_env_first':
+        blocks.insert(0, RawBlock('latex', '\\begin{theorem}\\label{thm:new}'
+                                  'A new result.\\end{theorem}'))
+
+    return json.dumps(doc)
+
+
+def filter_time(doc_json, store, repeats, prepare=None):
+    r''' The best time of `repeats` filter runs on `doc_json`, each after
+    `prepare` (which isn't timed), and the store writes of the last one.
+    '''
+    pandoc_utils.block_store = store
+
+    times = []
+    for _ in range(repeats):
+        if prepare is not None:
+            prepare()
+        doc = json.loads(doc_json)
+        writes = store.stats['writes'] if store else 0
+        start_time = time.perf_counter()
+        LatexFilter().apply(doc, 'html')
+        times.append(time.perf_counter() - start_time)
+
+    return min(times), (store.stats['writes'] - writes if store else None)
+
+
+def run_scale(doc_json, store_dir, repeats):
+    store = DiskCache(store_dir)
+
+    def clear_store():
+        shutil.rmtree(store_dir, ignore_errors=True)
+
+    def store_original():
+        # Each edit starts from a store with only the original's blocks.
+        clear_store()
+        filter_time(doc_json, store, 1)
+
+    results = [('full',) + filter_time(doc_json, False, repeats),
+               ('cold',) + filter_time(doc_json, store, repeats, clear_store),
+               ('unchanged',) + filter_time(doc_json, store, repeats)]
+
+    for case in ('edit_last', 'edit_first', 'new_env_first'):
+        results.append((case,) + filter_time(edited(doc_json, case), store,
+                                             repeats, store_original))
+
+    return results
+
+
+def run(scales=(1, 4, 16), nesting=2, repeats=3):
+    cache_dir = tempfile.mkdtemp(prefix='bench_incremental_')
+    store_dir = os.path.join(cache_dir, 'blocks')
+    saved = (pandoc_utils.block_store, pandoc_utils.nested_pandoc_version)
+    pandoc_utils.nested_pandoc_version = 'offline'
+
+    def run_scales():
+        pandoc_utils.env_cache = DiskCache(os.path.join(cache_dir,
+                                                        'environments'))
+        results = []
+        for scale in scales:
+            counts = dict((k, v * scale) for k, v in base_counts.items())
+            doc = make_doc(nesting=nesting, **counts)
+            doc['meta']['incremental'] = {'t': 'MetaBool', 'c': True}
+            doc['meta']['latex_fast_path'] = {'t': 'MetaBool', 'c': False}
+            doc_json = json.dumps(doc)
+
+            # Warm up the environment cache.
+            filter_time(doc_json, False, 1)
+
+            for case, seconds, writes in run_scale(doc_json, store_dir,
+                                                   repeats):
+                results.append(('{}_{}'.format(case, scale),
+                                len(doc['blocks']), seconds, writes))
+        return results
+
+    try:
+        return offline(run_scales)
+    finally:
+        (pandoc_utils.block_store,
+         pandoc_utils.nested_pandoc_version) = saved
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def main():
+    parser = OptionParser(
+        usage="python benchmarks/bench_incremental.py [options]")
+    parser.add_option("-s", "--scale",
+                      dest="scales", action="append", type="int",
+                      default=[],
+                      help=("Document scale factor; can be repeated: "
+                            "Default 1, 4 and 16"))
+    parser.add_option("-n", "--nesting",
+                      dest="nesting", type="int", default=2,
+                      help="Levels of nested environments in each one")
+    parser.add_option("-r", "--repeats",
+                      dest="repeats", type="int", default=3,
+                      help="Timed runs per case (the best is kept)")
+
+    (options, args) = parser.parse_args()
+
+    results = run(options.scales or (1, 4, 16), options.nesting,
+                  options.repeats)
+
+    print("{:<20} {:>7} {:>10} {:>9}".format('case', 'blocks', 'total (s)',
+                                             'filtered'))
+    for name, n_blocks, seconds, writes in results:
+        print("{:<20} {:>7} {:>10.4f} {:>9}".format(
+            name, n_blocks, seconds, '-' if writes is None else writes))
+
+
+if __name__ == '__main__':
+    main()
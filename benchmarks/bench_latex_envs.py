@@ -0,0 +1,118 @@
+r"""
+`latex_envs.iter_latex_envs` against the regular expression it replaced,
+on pathological raw LaTeX blocks.
+
+For each kind of input, at growing sizes, this times (best of a few
+repeats) finding the block's environments with the tokenizer and with
+the old `env_pattern` (which only ever found one).  The old pattern is
+skipped at the larger sizes once a run takes longer than `--limit`
+seconds, since it's quadratic (or worse) on these inputs:
+
+* `unclosed`: `\begin`s without `\end`s;
+* `unclosed_title`: the same with `[` optional arguments that never end;
+* `sequence`: many environments one after the other;
+* `nested`: deeply nested environments with the same name;
+* `text`: unclosed environments with text between them.
+
+The old pattern is fast on `sequence` and `nested`, but it finds a single
+environment in both, and in `sequence` that's the wrong one (from the
+first `\begin` to the last `\end`).
+
+Run with:
+
+    python benchmarks/bench_latex_envs.py
+    python benchmarks/bench_latex_envs.py -s 1000 -s 64000 -l 10
+"""
+import re
+import time
+from optparse import OptionParser
+
+from pynoweb_tools.latex_envs import iter_latex_envs
+
+old_env_pattern = re.compile(
+    r'\\begin\{(\w+)\}(\[.+\])?(.*)\\end\{\1\}', re.S)
+
+r""" Functions of the size that make the pathological inputs.
+"""
+inputs = {
+    'unclosed': lambda n: '\\begin{a}' * n + '\\end{b}',
+    'unclosed_title': lambda n: '\\begin{a}[' * n + '\\end{b}',
+    'sequence': lambda n: '\\begin{a}x\\end{a}\n' * n,
+    'nested': lambda n: '\\begin{a}' * n + 'x' + '\\end{a}' * n,
+    'text': lambda n: ('\\begin{a} some text\n' * n) + '\\end{b}',
+}
+
+
+def best_time(func, source, repeats):
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        res = func(source)
+        times.append(time.perf_counter() - start_time)
+    return min(times), res
+
+
+def old_envs(source):
+    ma = old_env_pattern.search(source)
+    return [] if ma is None else [ma.groups()]
+
+
+def new_envs(source):
+    return list(iter_latex_envs(source))
+
+
+def run(sizes=(1000, 4000, 16000), repeats=3, limit=5.0):
+    results = []
+    for name, make_input in inputs.items():
+        old_too_slow = False
+        for size in sizes:
+            source = make_input(size)
+
+            new_seconds, envs = best_time(new_envs, source, repeats)
+
+            old_seconds = None
+            if not old_too_slow:
+                old_seconds, _ = best_time(old_envs, source, 1)
+                old_too_slow = old_seconds > limit
+
+            results.append(('{}_{}'.format(name, size), len(source),
+                            len(envs), old_seconds, new_seconds))
+
+    return results
+
+
+def main():
+    parser = OptionParser(
+        usage="python benchmarks/bench_latex_envs.py [options]")
+    parser.add_option("-s", "--size",
+                      dest="sizes", action="append", type="int",
+                      default=[],
+                      help=("Input size (repetitions); can be repeated: "
+                            "Default 1000, 4000 and 16000"))
+    parser.add_option("-r", "--repeats",
+                      dest="repeats", type="int", default=3,
+                      help="Timed tokenizer runs per case (the best is kept)")
+    parser.add_option("-l", "--limit",
+                      dest="limit", type="float", default=5.0,
+                      help=("Seconds after which the old pattern is skipped "
+                            "at larger sizes"))
+
+    (options, args) = parser.parse_args()
+
+    results = run(options.sizes or (1000, 4000, 16000), options.repeats,
+                  options.limit)
+
+    print("{:<22} {:>9} {:>6} {:>10} {:>10} {:>9}".format(
+        'case', 'chars', 'envs', 'regex (s)', 'tokens (s)', 'speedup'))
+    for name, n_chars, n_envs, old_seconds, new_seconds in results:
+        if old_seconds is None:
+            print("{:<22} {:>9} {:>6} {:>10} {:>10.4f} {:>9}".format(
+                name, n_chars, n_envs, 'skipped', new_seconds, '-'))
+        else:
+            print("{:<22} {:>9} {:>6} {:>10.4f} {:>10.4f} {:>9.1f}".format(
+                name, n_chars, n_envs, old_seconds, new_seconds,
+                old_seconds / new_seconds))
+
+
+if __name__ == '__main__':
+    main()
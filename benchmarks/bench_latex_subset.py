@@ -0,0 +1,83 @@
+r"""
+`latex_subset.convert_latex_subset` against a Pandoc conversion.
+
+For environment bodies within the LaTeX subset (see `latex_subset`),
+this times (best of a few repeats) converting each body with the
+pure-Python fast path and with one Pandoc process, like the nested
+conversions in `LatexFilter.process_latex_envs` do.
+
+Run with:
+
+    python benchmarks/bench_latex_subset.py
+    python benchmarks/bench_latex_subset.py -b 50 -r 5
+"""
+import random
+import time
+from optparse import OptionParser
+
+import pypandoc
+
+from pynoweb_tools.latex_subset import convert_latex_subset
+from pynoweb_tools.pandoc_utils import nested_pandoc_format, nested_pandoc_args
+
+
+def make_body(rng, n_sentences=6):
+    sentences = []
+    for i in range(n_sentences):
+        sentences.append(rng.choice([
+            'If $x_{} > 0$ then \\cref{{eq:{}}} holds.'.format(i, i),
+            'The \\emph{{main}} result, see \\ref{{thm:{}}}.'.format(i),
+            'For all $n$ and $\\epsilon > 0$, we have a bound.',
+            'This is\nover two lines.\n\nAnd a new paragraph.']))
+    return ' '.join(sentences)
+
+
+def best_time(func, bodies, repeats):
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        for body in bodies:
+            func(body)
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def pandoc_convert(body):
+    return pypandoc.convert_text(body, 'json', format=nested_pandoc_format,
+                                 extra_args=nested_pandoc_args)
+
+
+def run(n_bodies=20, repeats=3, seed=0):
+    rng = random.Random(seed)
+    bodies = [make_body(rng) for _ in range(n_bodies)]
+
+    assert all(convert_latex_subset(b) is not None for b in bodies)
+
+    return (best_time(convert_latex_subset, bodies, repeats),
+            best_time(pandoc_convert, bodies, repeats))
+
+
+def main():
+    parser = OptionParser(
+        usage="python benchmarks/bench_latex_subset.py [options]")
+    parser.add_option("-b", "--bodies",
+                      dest="n_bodies", type="int", default=20,
+                      help="Number of environment bodies to convert")
+    parser.add_option("-r", "--repeats",
+                      dest="repeats", type="int", default=3,
+                      help="Timed runs per case (the best is kept)")
+
+    (options, args) = parser.parse_args()
+
+    subset_seconds, pandoc_seconds = run(options.n_bodies, options.repeats)
+
+    print("{:<10} {:>10} {:>12}".format('case', 'total (s)', 'body (us)'))
+    for name, seconds in (('subset', subset_seconds),
+                          ('pandoc', pandoc_seconds)):
+        print("{:<10} {:>10.4f} {:>12.1f}".format(
+            name, seconds, 1e6 * seconds / options.n_bodies))
+    print("speedup: {:.0f}x".format(pandoc_seconds / subset_seconds))
+
+
+if __name__ == '__main__':
+    main()
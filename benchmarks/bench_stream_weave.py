@@ -0,0 +1,122 @@
+r"""
+Weaving time, peak memory and time to the first output as the number of
+chunks grows, for `Pweb.weave` and `utils.stream_weave`.
+
+`Pweb.weave` formats and writes the document after all of its code has
+run, so its peak memory grows with the document's total output, and
+nothing is written until the end.  `stream_weave` writes each chunk as
+it's executed, so its peak memory should stay flat and its first output
+should come after one chunk.
+
+The code runs in a Python namespace instead of a kernel, so only the
+weaving itself is measured.
+
+Run with:
+
+    python benchmarks/bench_stream_weave.py
+"""
+import io
+import os
+import time
+import tempfile
+import contextlib
+import tracemalloc
+from functools import partial
+
+from pweave import Pweb
+from pweave.processors.base import PwebProcessorBase
+
+from pynoweb_tools.pweave_objs.formatters import PwebMintedPandocFormatter
+from pynoweb_tools.utils import stream_weave
+
+
+class NamespaceProcessor(PwebProcessorBase):
+
+    def __init__(self, *args):
+        super(NamespaceProcessor, self).__init__(*args)
+        self.ns = {}
+
+    def loadstring(self, code, chunk=None):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            exec(code, self.ns)
+        return [{'output_type': 'stream', 'name': 'stdout',
+                 'text': out.getvalue()}]
+
+
+def make_source(path, n_chunks, output_lines=200):
+    with open(path, 'w') as f:
+        for i in range(n_chunks):
+            f.write('Some text about chunk {0}.\n\n'
+                    '<<name="chunk_{0}">>=\n'
+                    'for i in range({1}):\n'
+                    '    print("line", i, "of chunk {0}")\n'
+                    '@\n\n'.format(i, output_lines))
+
+
+def weave(source, output, stream):
+    weaver = Pweb(source, doctype='tex', kernel='python3', output=output)
+    weaver.setformat(Formatter=PwebMintedPandocFormatter)
+    weaver._print = lambda msg: None
+
+    first_output = []
+    format_chunk = weaver.formatter.format_chunk
+
+    def timed_format_chunk(chunk):
+        res = format_chunk(chunk)
+        if not first_output:
+            first_output.append(time.perf_counter())
+        return res
+
+    weaver.formatter.format_chunk = timed_format_chunk
+
+    start_time = time.perf_counter()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        if stream:
+            stream_weave(weaver, Processor=NamespaceProcessor)
+        else:
+            weaver.run = partial(weaver.run, Processor=NamespaceProcessor)
+            weaver.weave()
+
+    end_time = time.perf_counter()
+
+    if not stream:
+        # Nothing is written before the whole document is formatted.
+        first_output = [end_time]
+
+    return end_time - start_time, first_output[0] - start_time
+
+
+def run(sizes=(100, 400, 1600)):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_chunks in sizes:
+            source = os.path.join(tmp_dir, 'doc_{}.texw'.format(n_chunks))
+            make_source(source, n_chunks)
+
+            for stream in (False, True):
+                output = os.path.join(tmp_dir, 'doc.tex')
+
+                seconds, first_seconds = weave(source, output, stream)
+
+                tracemalloc.start()
+                try:
+                    weave(source, output, stream)
+                    peak_bytes = tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+
+                results.append((n_chunks, 'stream' if stream else 'whole',
+                                seconds, first_seconds,
+                                peak_bytes / 2. ** 20))
+
+    return results
+
+
+if __name__ == '__main__':
+    print("{:>8} {:>8} {:>10} {:>12} {:>10}".format(
+        'chunks', 'mode', 'total (s)', 'first (s)', 'peak (MiB)'))
+    for n_chunks, mode, seconds, first_seconds, peak_mib in run():
+        print("{:>8} {:>8} {:>10.3f} {:>12.4f} {:>10.1f}".format(
+            n_chunks, mode, seconds, first_seconds, peak_mib))
@@ -0,0 +1,225 @@
+r"""
+Streaming Pandoc ASTs
+=====================
+Incremental reading and writing of Pandoc JSON AST documents, one
+top-level block at a time.
+
+Pandoc writes the `pandoc-api-version` and `meta` entries of a document
+before its `blocks`, so a filter can have the meta data in hand and then
+process the blocks as they arrive.  Peak memory is then bounded by the
+largest top-level block instead of the whole document.
+"""
+import json
+
+_decoder = json.JSONDecoder()
+
+_whitespace = ' \t\n\r'
+
+
+class JSONStreamReader(object):
+    r""" A minimal pull parser for the top-level structure of a JSON
+    document read from a text stream.
+
+    Values are decoded whole with `json.JSONDecoder.raw_decode`, reading
+    more of the stream whenever a value is incomplete.
+
+    Parameters
+    ==========
+    stream: file-like
+        A text stream.
+    chunk_size: int (Optional)
+        Number of characters to read from the stream at a time.
+    """
+
+    def __init__(self, stream, chunk_size=2 ** 16):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=None):
+        r''' Read more of the stream, dropping the consumed part of the
+        buffer.  Returns `False` at the end of the stream.
+        '''
+        if self.eof:
+            return False
+
+        data = self.stream.read(size or self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        r''' Return the next non-whitespace character without consuming it
+        (or an empty string at the end of the stream).
+        '''
+        while True:
+            while (self.pos < len(self.buffer) and
+                   self.buffer[self.pos] in _whitespace):
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                break
+
+        return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        r''' Consume the next non-whitespace character, which must be one of
+        `chars`, and return it.
+        '''
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of {!r} at stream position, "
+                             "found {!r}".format(chars, char))
+        self.pos += 1
+        return char
+
+    def read_value(self):
+        r''' Decode and consume the next complete JSON value.
+        '''
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                value, end = None, None
+
+            # A valid value is always followed by something (e.g. a `,` or
+            # closing bracket) in the larger document, so a value that ends
+            # the buffer might be truncated (e.g. a number).
+            if end is not None and (end < len(self.buffer) or self.eof):
+                self.pos = end
+                return value
+
+            # Read at least as much again as what's buffered, so that
+            # decoding a large value takes linear time overall.
+            if not self._fill(max(self.chunk_size, len(self.buffer))):
+                if end is not None:
+                    self.pos = end
+                    return value
+                raise ValueError("Truncated JSON value in stream")
+
+
+def iter_document(stream, chunk_size=2 ** 16):
+    r''' Iterate over the top-level entries of a Pandoc JSON document.
+
+    Yields
+    ======
+    Pairs of keys and values, except for the `blocks` entry, which is
+    yielded as a `('blocks', None)` pair, followed by a `('block', block)`
+    pair for each top-level block and an `('end_blocks', None)` pair.
+    '''
+    reader = JSONStreamReader(stream, chunk_size=chunk_size)
+
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+
+    while True:
+        key = reader.read_value()
+        reader.expect(':')
+
+        if key == 'blocks' and reader.peek() == '[':
+            yield key, None
+
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield 'block', reader.read_value()
+                    if reader.expect(',]') == ']':
+                        break
+
+            yield 'end_blocks', None
+        else:
+            yield key, reader.read_value()
+
+        if reader.expect(',}') == '}':
+            break
+
+
+def stream_filter(filter_blocks, input_stream, output_stream,
+                  filter_meta=None, chunk_size=2 ** 16):
+    r''' Filter a Pandoc JSON document one top-level block at a time.
+
+    Blocks are filtered and written as soon as they're read.  If the
+    document's meta data comes after its blocks (Pandoc doesn't write them
+    that way), the blocks are held in memory until the meta data is read.
+
+    Parameters
+    ==========
+    filter_blocks: callable
+        A function taking a list of blocks and the document's meta data
+        and returning the list of filtered blocks.
+    input_stream: file-like
+        Text stream with the Pandoc JSON document.
+    output_stream: file-like
+        Text stream for the filtered Pandoc JSON document.
+    filter_meta: callable (Optional)
+        A function taking the meta data and returning the filtered
+        meta data.
+    '''
+    meta = None
+    pending_blocks = None
+    first_entry = True
+    first_block = True
+
+    def write_entry(key):
+        if not first_entry:
+            output_stream.write(', ')
+        output_stream.write(json.dumps(key) + ': ')
+
+    def write_blocks(blocks):
+        nonlocal first_block
+        for block in filter_blocks(blocks, meta):
+            if not first_block:
+                output_stream.write(', ')
+            first_block = False
+            output_stream.write(json.dumps(block))
+
+    output_stream.write('{')
+
+    for key, value in iter_document(input_stream, chunk_size=chunk_size):
+
+        if key == 'block':
+            if pending_blocks is not None:
+                pending_blocks.append(value)
+            else:
+                write_blocks([value])
+            continue
+        elif key == 'end_blocks':
+            if pending_blocks is None:
+                output_stream.write(']')
+            continue
+
+        if key == 'blocks' and meta is None:
+            pending_blocks = []
+            continue
+
+        write_entry(key)
+        first_entry = False
+
+        if key == 'meta':
+            meta = value
+            if filter_meta is not None:
+                value = filter_meta(meta)
+        elif key == 'blocks':
+            output_stream.write('[')
+            continue
+
+        output_stream.write(json.dumps(value))
+
+    if pending_blocks is not None:
+        if meta is None:
+            meta = {}
+        write_entry('blocks')
+        output_stream.write('[')
+        write_blocks(pending_blocks)
+        output_stream.write(']')
+
+    output_stream.write('}')
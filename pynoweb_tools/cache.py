@@ -0,0 +1,235 @@
+r"""
+Disk Caches
+===========
+A small content-addressed, size-bounded cache of JSON values on disk.
+
+Entries are stored as individual files named after the hash of their key
+parts.  An entry's modification time is its last use, so eviction removes
+the least recently used entries once the cache outgrows its size limit.
+
+The total size of the entries is kept in a small file in the cache
+directory, so that a new process (e.g. a filter run) doesn't list the
+whole cache to find it.  Concurrent writers can lose each other's updates
+to it, so it's recounted from the entries every `size_recount_writes`
+writes, and on eviction.
+"""
+import os
+import json
+import errno
+import hashlib
+import logging
+import tempfile
+
+cache_logger = logging.getLogger('pynoweb_cache')
+cache_logger.addHandler(logging.NullHandler())
+
+r""" Environment variable for the root cache directory.  An empty value
+disables the caches.
+"""
+cache_dir_env_var = 'PYNOWEB_CACHE_DIR'
+
+r""" Environment variable for the size limit, in bytes, of each cache.
+"""
+cache_size_env_var = 'PYNOWEB_CACHE_SIZE'
+
+default_cache_size = 100 * 1024 ** 2
+
+r""" Number of writes after which a cache's stored total size is recounted.
+"""
+size_recount_writes = 1000
+
+
+def default_cache_dir(environ=None):
+    r''' The root cache directory, or `None` when caching is disabled.
+    '''
+    if environ is None:
+        environ = os.environ
+
+    cache_dir = environ.get(cache_dir_env_var, None)
+    if cache_dir is not None:
+        return cache_dir or None
+
+    xdg_cache_dir = environ.get('XDG_CACHE_HOME',
+                                os.path.join(os.path.expanduser('~'),
+                                             '.cache'))
+    return os.path.join(xdg_cache_dir, 'pynoweb_tools')
+
+
+class DiskCache(object):
+    r""" A content-addressed LRU cache of JSON values.
+
+    Parameters
+    ==========
+    directory: str
+        Directory for the cache entries.  It's created when needed.
+    max_size: int (Optional)
+        Maximum total size, in bytes, of the entries.
+
+    Attributes
+    ==========
+    stats: dict
+        Counts of cache `hits`, `misses`, `writes` and `evictions`.
+    """
+
+    def __init__(self, directory, max_size=default_cache_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+
+    @classmethod
+    def from_env(cls, name, environ=None):
+        r''' Create the cache `name` under the default cache directory, or
+        return `None` when caching is disabled.
+        '''
+        if environ is None:
+            environ = os.environ
+
+        cache_dir = default_cache_dir(environ)
+        if cache_dir is None:
+            return None
+
+        max_size = int(environ.get(cache_size_env_var,
+                                   default_cache_size))
+
+        return cls(os.path.join(cache_dir, name), max_size=max_size)
+
+    @staticmethod
+    def key(*parts):
+        r''' Hash JSON-serializable key parts into an entry key.
+        '''
+        key_str = json.dumps(parts, sort_keys=True)
+        return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:] + '.json')
+
+    def get(self, key, default=None):
+        r''' Return the value for `key`, or `default` when there isn't one.
+        '''
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            self.stats['misses'] += 1
+            return default
+
+        # Mark the entry as recently used.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        self.stats['hits'] += 1
+        return value
+
+    def set(self, key, value):
+        r''' Store `value` under `key` and evict old entries when the cache
+        is over its size limit.
+        '''
+        path = self._path(key)
+
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            cache_logger.warning("Couldn't write cache entry {}: {}\n".format(
+                path, e))
+            return
+
+        self.stats['writes'] += 1
+
+        size_info = self._load_size()
+        if size_info is None or size_info[1] >= size_recount_writes:
+            size, writes = sum(e[1] for e in self._entries()), 0
+        else:
+            try:
+                new_size = os.path.getsize(path)
+            except OSError:
+                new_size = 0
+            size, writes = size_info
+            size += new_size - old_size
+            writes += 1
+
+        if size > self.max_size:
+            self.evict()
+        else:
+            self._store_size(size, writes)
+
+    def _entries(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith('.json'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _size_path(self):
+        return os.path.join(self.directory, 'size')
+
+    def _load_size(self):
+        r''' The stored total size and the number of writes since it was
+        last counted, or `None` when there isn't one.
+        '''
+        try:
+            with open(self._size_path(), 'r', encoding='utf-8') as f:
+                size, writes = json.load(f)
+            return int(size), int(writes)
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _store_size(self, size, writes=0):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump([size, writes], f)
+            os.replace(tmp_path, self._size_path())
+        except OSError as e:
+            cache_logger.warning("Couldn't write the cache size: {}\n".format(
+                e))
+
+    def size(self):
+        r''' The total size of the entries, in bytes.
+        '''
+        size_info = self._load_size()
+        if size_info is not None:
+            return size_info[0]
+
+        size = sum(e[1] for e in self._entries())
+        self._store_size(size)
+        return size
+
+    def evict(self):
+        r''' Remove the least recently used entries until the cache is
+        within its size limit.
+        '''
+        entries = sorted(self._entries())
+        size = sum(e[1] for e in entries)
+
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            size -= entry_size
+            self.stats['evictions'] += 1
+
+        self._store_size(size)
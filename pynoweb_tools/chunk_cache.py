@@ -0,0 +1,602 @@
+r"""
+Incremental Weaving
+===================
+Re-execute only the chunks of a Pweave document that changed, and the
+chunks that depend on them.
+
+Each chunk that runs code (code chunks and documentation chunks with
+inline code) gets a key: the hash of its source and options and of the
+keys of the chunks it depends on.  By default, a chunk depends on every
+chunk before it in its execution group (i.e. on execution order; see
+`chunk_groups`); the chunk option `depends` narrows that to the named
+chunks, e.g. `<<name='plot', depends='data'>>=` (or `depends=''` for
+none).  The results of chunks with unchanged keys are
+replayed from a cache.
+
+Each cache entry records the cache format version, the hash of the chunk
+source it came from and its number of results, and the figure files it
+refers to must exist.  Entries that fail these checks are discarded--and
+reported, see `ChunkCache.validate`--and only their chunks run again.
+
+A changed chunk needs the kernel state left by the chunks it depends on.
+For IPython kernels, the names a chunk touches are pickled after it runs,
+so that state can be restored instead of re-running those chunks; that
+way execution starts at the first changed chunk.  Chunks whose state can't
+be pickled (or restored), chunks whose names can't be listed (e.g. star
+imports; see `code_names`), and chunks in other kernels, are re-run when a
+dependent chunk changes.
+
+Process state outside of the namespace (e.g. random seeds,
+`matplotlib.rcParams` or `sys.path`) isn't in the snapshots.  Chunks that
+use modules, or functions from them, can change that state, so they're
+re-run instead of restored--unless they declare `depends`, which is taken
+to mean that their state is in the names they touch.  Restoring such a
+chunk doesn't redo its other side effects.
+"""
+import os
+import re
+import ast
+import copy
+import json
+import pickle
+import hashlib
+import logging
+
+from pweave import rcParams
+
+from .chunk_groups import chunk_group
+
+chunk_logger = logging.getLogger('chunk_cache')
+chunk_logger.addHandler(logging.NullHandler())
+
+r""" Version of the cache file layout; older files are ignored.
+"""
+chunk_cache_version = 2
+
+inline_code_pattern = re.compile(r'<%=?([\w\s\W]*?)%>')
+
+restored_marker = 'PYNOWEBRESTORED'
+
+
+def chunk_code(chunk):
+    r''' The code a chunk runs, or `None` when it doesn't run any.
+    '''
+    if chunk['type'] == 'code':
+        return chunk['content']
+    elif chunk['type'] == 'doc':
+        inline_code = inline_code_pattern.findall(chunk['content'])
+        if inline_code:
+            return '\n'.join(c.strip() for c in inline_code)
+    return None
+
+
+def chunk_depends(chunk):
+    r''' The names of the chunks a chunk declares it depends on, or `None`
+    when it doesn't declare any.
+    '''
+    depends = chunk.get('options', {}).get('depends', None)
+    if depends is None:
+        return None
+    if isinstance(depends, str):
+        depends = depends.split(',')
+    return [d.strip() for d in depends if d.strip()]
+
+
+def chunk_dependencies(parsed):
+    r''' Get the chunks each chunk depends on.
+
+    Returns
+    =======
+    A dict mapping the indices of the chunks that run code to lists of the
+    indices of the chunks they depend on.
+    '''
+    names = dict()
+    dependencies = dict()
+    previous = []
+    previous_in_group = dict()
+
+    for i, chunk in enumerate(parsed):
+        if chunk_code(chunk) is None:
+            continue
+
+        group_previous = previous_in_group.setdefault(chunk_group(chunk), [])
+
+        depends = chunk_depends(chunk)
+        if depends is None or any(d not in names for d in depends):
+            if depends is not None:
+                chunk_logger.warning(
+                    "Unknown chunk dependencies {} in chunk {}; using all "
+                    "the chunks before it\n".format(depends, i))
+            deps = list(group_previous)
+        else:
+            deps = sorted(names[d] for d in depends)
+
+        # The code of an incomplete chunk runs with the next one.
+        if previous and not parsed[previous[-1]].get(
+                'options', {}).get('complete', True):
+            if previous[-1] not in deps:
+                deps.append(previous[-1])
+
+        dependencies[i] = deps
+
+        name = chunk.get('options', {}).get('name', None)
+        if name is not None:
+            names[name] = i
+        previous.append(i)
+        group_previous.append(i)
+
+    return dependencies
+
+
+def chunk_source_hash(chunk):
+    r''' Hash a chunk's type, source and options.
+    '''
+    options = sorted((k, repr(v))
+                     for k, v in chunk.get('options', {}).items()
+                     if k != 'option_string')
+    source_str = json.dumps([chunk['type'], chunk['content'], options])
+    return hashlib.sha256(source_str.encode('utf-8')).hexdigest()
+
+
+def chunk_keys(parsed, dependencies, salt=()):
+    r''' Hash the chunks that run code along with their dependencies.
+
+    Parameters
+    ==========
+    parsed: list of dict
+        The parsed chunks.
+    dependencies: dict
+        The output of `chunk_dependencies`.
+    salt: tuple (Optional)
+        Other values the results depend on (e.g. the kernel name).
+    '''
+    keys = dict()
+    for i in sorted(dependencies.keys()):
+        key_parts = [list(salt), chunk_source_hash(parsed[i]),
+                     [keys[d] for d in dependencies[i]]]
+        key_str = json.dumps(key_parts)
+        keys[i] = hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+    return keys
+
+
+r""" Builtins that can bind names the code doesn't list.
+"""
+namespace_builtins = frozenset(['exec', 'eval', 'globals', 'locals', 'vars',
+                                '__import__'])
+
+
+def code_names(code):
+    r''' The names used by a chunk's code, or `None` when they can't be
+    listed, i.e. when the code can't be parsed, has star imports, `%run`
+    or cell magics, or uses one of `namespace_builtins`.
+
+    The other IPython magics and shell escapes are ignored.
+    '''
+    lines = []
+    for line in code.splitlines():
+        stripped = line.lstrip()
+        if stripped.startswith(('%%', '%run')):
+            return None
+        elif not stripped.startswith(('%', '!')):
+            lines.append(line)
+    try:
+        tree = ast.parse('\n'.join(lines))
+    except SyntaxError:
+        return None
+
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if node.id in namespace_builtins:
+                return None
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                               ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.alias):
+            if node.name == '*':
+                return None
+            names.add((node.asname or node.name).split('.')[0])
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+
+    return sorted(names)
+
+
+_snapshot_code = r'''
+def _pynoweb_snapshot(names, path, modules, ns):
+    import pickle, types
+    module_functions = (types.FunctionType, types.BuiltinFunctionType,
+                        types.MethodType)
+    state = dict()
+    for name in names:
+        if name not in ns:
+            state[name] = ('deleted', None)
+        elif isinstance(ns[name], types.ModuleType):
+            if not modules:
+                return
+            state[name] = ('module', ns[name].__name__)
+        elif getattr(ns[name], '__module__', None) == '__main__':
+            # Functions and classes defined in the kernel can't be
+            # unpickled in another one.
+            return
+        elif not modules and isinstance(ns[name], module_functions):
+            return
+        else:
+            try:
+                state[name] = ('object', pickle.dumps(ns[name]))
+            except Exception:
+                return
+    with open(path, 'wb') as f:
+        pickle.dump(state, f)
+_pynoweb_snapshot({names}, {path}, {modules}, globals())
+del _pynoweb_snapshot
+'''
+
+_restore_code = r'''
+def _pynoweb_restore(path, ns):
+    import pickle, importlib
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    for name, (kind, value) in state.items():
+        if kind == 'deleted':
+            ns.pop(name, None)
+        elif kind == 'module':
+            ns[name] = importlib.import_module(value)
+        else:
+            ns[name] = pickle.loads(value)
+    print({marker})
+_pynoweb_restore({path}, globals()); del _pynoweb_restore
+'''
+
+
+def snapshot_code(names, path, modules=True):
+    r''' IPython code that pickles the kernel's values for `names` to `path`.
+
+    When `modules` is false, nothing is written if one of the names is a
+    module, or a function or method from one, since calls through them can
+    change process state that isn't in the namespace (e.g. `random.seed`,
+    `matplotlib.rcParams` or `sys.path`).
+    '''
+    return _snapshot_code.format(names=json.dumps(names),
+                                 path=json.dumps(path),
+                                 modules=repr(bool(modules)))
+
+
+def restore_code(path):
+    r''' IPython code that restores the values pickled by `snapshot_code`.
+    '''
+    return _restore_code.format(path=json.dumps(path),
+                                marker=json.dumps(restored_marker))
+
+
+class ChunkCache(object):
+    r""" The cached results, and kernel state snapshots, of a document's
+    chunks.
+
+    Parameters
+    ==========
+    path: str
+        The cache file.  The kernel state snapshots go in a directory of
+        the same name (without extension).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state_dir = os.path.splitext(path)[0]
+        self.entries = dict()
+        self.load_problem = None
+
+    @classmethod
+    def for_source(cls, source):
+        r''' The cache for the document `source`, in Pweave's cache
+        directory.
+        '''
+        source = os.path.abspath(source)
+        cache_dir = os.path.join(os.path.dirname(source),
+                                 rcParams["cachedir"])
+        basename = os.path.basename(source).split(".")[0]
+        return cls(os.path.join(cache_dir, basename + '.chunks.pkl'))
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return self
+
+        try:
+            with open(self.path, 'rb') as f:
+                version, entries = pickle.load(f)
+        except Exception as e:
+            self.load_problem = "unreadable cache file ({})".format(e)
+            return self
+
+        if version != chunk_cache_version:
+            self.load_problem = "cache format version {} (not {})".format(
+                version, chunk_cache_version)
+        else:
+            self.entries = entries
+
+        return self
+
+    def set(self, key, chunk, results):
+        self.entries[key] = {'version': chunk_cache_version,
+                             'source_hash': chunk_source_hash(chunk),
+                             'count': len(results),
+                             'results': results}
+
+    def results(self, key):
+        return self.entries[key]['results']
+
+    def entry_problem(self, key, chunk, wd=''):
+        r''' Check the entry for `key` against the chunk it's for.
+
+        Returns
+        =======
+        A description of what's wrong with the entry, or `None`.
+        '''
+        entry = self.entries[key]
+
+        if not isinstance(entry, dict) or not {
+                'version', 'source_hash', 'count',
+                'results'}.issubset(entry.keys()):
+            return "unreadable entry"
+
+        if entry['version'] != chunk_cache_version:
+            return "entry format version {} (not {})".format(
+                entry['version'], chunk_cache_version)
+
+        if entry['source_hash'] != chunk_source_hash(chunk):
+            return "entry is for a different chunk source"
+
+        results = entry['results']
+        if not isinstance(results, list) or len(results) != entry['count']:
+            return "entry has {} results (not {})".format(
+                len(results) if isinstance(results, list) else None,
+                entry['count'])
+
+        for result in results:
+            if not isinstance(result, dict) or (
+                    result.get('type', None) != chunk['type']):
+                return "entry has a result of the wrong type"
+
+            for fig in result.get('figure', None) or []:
+                if not os.path.exists(os.path.join(wd, fig)):
+                    return "missing figure {}".format(fig)
+
+        return None
+
+    def validate(self, parsed, keys, wd=''):
+        r''' Discard the entries that fail their integrity checks.
+
+        Parameters
+        ==========
+        parsed: list of dict
+            The document's parsed chunks.
+        keys: dict
+            The output of `chunk_keys`.
+        wd: str (Optional)
+            The directory the figure files are relative to.
+
+        Returns
+        =======
+        A list with a dict for each discarded entry: the `chunk` index, its
+        `name` and the `reason`.
+        '''
+        discarded = []
+        for i, key in sorted(keys.items()):
+            if key in self.entries:
+                reason = self.entry_problem(key, parsed[i], wd)
+                if reason is None:
+                    continue
+                del self.entries[key]
+            elif self.load_problem is not None:
+                reason = self.load_problem
+            else:
+                continue
+
+            discarded.append(
+                {'chunk': i,
+                 'name': parsed[i].get('options', {}).get('name', None),
+                 'reason': reason})
+
+        return discarded
+
+    def save(self, keys):
+        r''' Write the entries for `keys` (i.e. the current chunks) and
+        remove the rest.
+        '''
+        keys = set(keys)
+        self.entries = {k: v for k, v in self.entries.items() if k in keys}
+
+        if os.path.isdir(self.state_dir):
+            for fname in os.listdir(self.state_dir):
+                if os.path.splitext(fname)[0] not in keys:
+                    os.unlink(os.path.join(self.state_dir, fname))
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((chunk_cache_version, self.entries), f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def state_path(self, key):
+        return os.path.join(self.state_dir, key + '.pkl')
+
+    def has_state(self, key):
+        return os.path.exists(self.state_path(key))
+
+
+def plan_run(dependencies, keys, cache):
+    r''' Decide which chunks to run and which to restore.
+
+    Returns
+    =======
+    The sets of indices of the chunks to run and of the chunks whose kernel
+    state to restore.  The rest are replayed from the cache.
+    '''
+    to_run = set(i for i, key in keys.items() if key not in cache.entries)
+
+    # Walk back from the changed chunks through all their (transitive)
+    # dependencies, since a restored chunk's snapshot only has the names it
+    # touches; the unchanged ones are restored when possible, and run
+    # otherwise.
+    to_restore = set()
+    pending = sorted(to_run, reverse=True)
+    while pending:
+        i = pending.pop()
+        for d in dependencies[i]:
+            if d in to_run or d in to_restore:
+                continue
+            if cache.has_state(keys[d]):
+                to_restore.add(d)
+            else:
+                to_run.add(d)
+            pending.append(d)
+
+    return to_run, to_restore
+
+
+class _RestoreError(Exception):
+    pass
+
+
+def _skip_calls(func, count):
+    calls = [0]
+
+    def skipping_func(*args):
+        calls[0] += 1
+        if calls[0] > count:
+            return func(*args)
+
+    return skipping_func
+
+
+def incremental_run(weaver, Processor=None, on_chunk=None):
+    r''' Run a `Pweb` document's code incrementally.
+
+    This takes the place of `Pweb.run`, e.g.
+    `weaver.run = partial(incremental_run, weaver)`.  The kernel is only
+    started when a chunk needs to run.
+
+    When `on_chunk` is given, it's called with the executed chunks of each
+    source chunk, in order, as soon as they're ready, and
+    `weaver.executed` is only kept when the results are stored.
+
+    In documentation mode, inline code is hidden instead of run.
+
+    The cache entries that were discarded are listed in
+    `weaver.discarded_chunks` (see `ChunkCache.validate`).
+    '''
+    from pweave import PwebProcessors
+
+    parsed = copy.deepcopy(weaver.parsed)
+
+    if weaver.documentationmode:
+        for chunk in parsed:
+            if chunk['type'] == 'doc':
+                chunk['content'] = inline_code_pattern.sub(
+                    '', chunk['content'])
+
+    dependencies = chunk_dependencies(parsed)
+    keys = chunk_keys(parsed, dependencies,
+                      salt=(weaver.kernel, weaver.figdir))
+
+    cache = ChunkCache.for_source(weaver.source).load()
+
+    discarded = cache.validate(parsed, keys, weaver.wd)
+    for d in discarded:
+        chunk_logger.warning(
+            "{}: discarded the cached results of chunk {} ({}): "
+            "{}\n".format(weaver.source, d['chunk'], d['name'],
+                          d['reason']))
+    weaver.discarded_chunks = getattr(weaver, 'discarded_chunks',
+                                      []) + discarded
+
+    to_run, to_restore = plan_run(dependencies, keys, cache)
+
+    chunk_logger.info(
+        "{}: running {}, restoring {} and replaying {} chunks\n".format(
+            weaver.source, len(to_run), len(to_restore),
+            len(keys) - len(to_run)))
+
+    results = dict((i, cache.results(k)) for i, k in keys.items()
+                   if i not in to_run)
+
+    proc = None
+    if to_run:
+        if Processor is None:
+            Processor = PwebProcessors.getprocessor(weaver.kernel)
+
+        proc = Processor(copy.deepcopy(parsed), weaver.kernel, weaver.source,
+                         False, weaver.figdir, weaver.wd)
+        proc.ensureDirectoryExists(proc.getFigDirectory())
+
+    snapshots = proc is not None and "python" in weaver.kernel
+    if snapshots:
+        os.makedirs(cache.state_dir, exist_ok=True)
+
+    keep_executed = on_chunk is None or rcParams["storeresults"]
+
+    executed = []
+    pending_code = ''
+    try:
+        for i, chunk in enumerate(parsed):
+            if i in to_restore:
+                outputs = proc.loadstring(restore_code(
+                    cache.state_path(keys[i])))
+                if not any(restored_marker in o.get('text', '')
+                           for o in outputs):
+                    # Start over, running this chunk (and what it depends
+                    # on) instead.
+                    chunk_logger.warning(
+                        "Couldn't restore the state of chunk {}\n".format(i))
+                    os.unlink(cache.state_path(keys[i]))
+                    raise _RestoreError()
+
+            if i in to_run:
+                res = proc._runcode(copy.deepcopy(chunk))
+                res = res if isinstance(res, list) else [res]
+                cache.set(keys[i], chunk, res)
+                results[i] = res
+
+                code = pending_code + chunk_code(chunk)
+                if not chunk.get('options', {}).get('complete', True):
+                    # The code runs with the next chunk, so there's no
+                    # state to keep yet.
+                    pending_code = code + '\n'
+                else:
+                    pending_code = ''
+                    names = code_names(code) if snapshots else None
+                    if names is not None:
+                        proc.loadstring(snapshot_code(
+                            names, cache.state_path(keys[i]),
+                            modules=chunk_depends(chunk) is not None))
+
+            chunk_executed = (copy.deepcopy(results[i]) if i in results
+                              else [chunk])
+            if keep_executed:
+                executed += chunk_executed
+            if on_chunk is not None:
+                on_chunk(chunk_executed)
+    except _RestoreError:
+        proc.close()
+        proc = None
+        cache.save(keys.values())
+
+        if on_chunk is not None:
+            # The chunks before this one were already handed over.
+            on_chunk = _skip_calls(on_chunk, i)
+
+        return incremental_run(weaver, Processor=Processor,
+                               on_chunk=on_chunk)
+    finally:
+        if proc is not None:
+            proc.close()
+
+    cache.save(keys.values())
+
+    if rcParams["storeresults"] and proc is not None:
+        proc.store(executed)
+
+    weaver.executed = executed
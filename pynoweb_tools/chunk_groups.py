@@ -0,0 +1,156 @@
+r"""
+Chunk Groups
+============
+Run independent groups of chunks concurrently, each in its own kernel.
+
+The chunk option `group` puts a code chunk in an execution group, e.g.
+`<<name='fit', group='study_1'>>=`.  Chunks without one--and the inline
+code of documentation chunks--are in the main group.  Each group runs in
+order in its own kernel, so a group can't use the state of another, and
+the groups run concurrently.  Their results are merged back in document
+order for the formatter.
+
+In incremental mode (see `chunk_cache`), groups only narrow the chunks a
+chunk depends on by default; the chunks still run in one kernel.
+"""
+import os
+import sys
+import copy
+import logging
+import threading
+
+from pweave import rcParams
+
+group_logger = logging.getLogger('chunk_groups')
+group_logger.addHandler(logging.NullHandler())
+
+
+def chunk_group(chunk):
+    r''' The name of a chunk's execution group, or `None` for the main
+    group.
+    '''
+    if chunk['type'] != 'code':
+        return None
+    group = chunk.get('options', {}).get('group', None)
+    if group is not None:
+        group = str(group).strip() or None
+    return group
+
+
+def group_chunks(parsed):
+    r''' Split a document's chunks into execution groups.
+
+    Returns
+    =======
+    A dict mapping group names (`None` for the main group) to lists of
+    chunk indices, in document order.  Chunks that don't run (e.g. raw
+    chunks) aren't in any group.
+    '''
+    groups = dict()
+    for i, chunk in enumerate(parsed):
+        if chunk['type'] not in ('code', 'doc'):
+            continue
+        groups.setdefault(chunk_group(chunk), []).append(i)
+    return groups
+
+
+def grouped_run(weaver, Processor=None, GroupProcessor=None,
+                on_chunk=None):
+    r''' Run a `Pweb` document's code with each chunk group in its own
+    kernel.
+
+    This takes the place of `Pweb.run`, e.g.
+    `weaver.run = partial(grouped_run, weaver)`.
+
+    Parameters
+    ==========
+    weaver: Pweb
+        The document.
+    Processor: class (Optional)
+        The processor class for the main group.
+    GroupProcessor: class (Optional)
+        The processor class for the other groups.  Defaults to
+        `Processor`; it must start its own kernel.
+    on_chunk: callable (Optional)
+        Called with the executed chunks of each source chunk, in document
+        order, as soon as they're ready (see `utils.stream_weave`).
+        `weaver.executed` is then only kept when the results are stored.
+    '''
+    from pweave import PwebProcessors
+
+    if Processor is None:
+        Processor = PwebProcessors.getprocessor(weaver.kernel)
+    if GroupProcessor is None:
+        GroupProcessor = Processor
+
+    parsed = copy.deepcopy(weaver.parsed)
+    groups = group_chunks(parsed)
+
+    group_logger.info("{}: running {} chunk groups\n".format(
+        weaver.source, len(groups)))
+
+    results = dict()
+    errors = []
+    processors = dict()
+    done = threading.Condition()
+
+    def run_group(group, indices):
+        try:
+            processor_class = Processor if group is None else GroupProcessor
+            proc = processor_class(
+                copy.deepcopy([parsed[i] for i in indices]), weaver.kernel,
+                weaver.source, False, weaver.figdir, weaver.wd)
+            processors[group] = proc
+            try:
+                # `ensureDirectoryExists` races with the other groups.
+                os.makedirs(proc.getFigDirectory(), exist_ok=True)
+                for i in indices:
+                    res = proc._runcode(copy.deepcopy(parsed[i]))
+                    res = res if isinstance(res, list) else [res]
+                    with done:
+                        results[i] = res
+                        done.notify_all()
+            finally:
+                proc.close()
+        except Exception:
+            with done:
+                errors.append(sys.exc_info()[1])
+                done.notify_all()
+
+    threads = [threading.Thread(target=run_group, args=(group, indices))
+               for group, indices in groups.items()]
+    for thread in threads:
+        thread.start()
+
+    keep_executed = on_chunk is None or rcParams["storeresults"]
+    grouped = set(i for indices in groups.values() for i in indices)
+
+    executed = []
+    try:
+        for i, chunk in enumerate(parsed):
+            if i in grouped:
+                with done:
+                    while i not in results and not errors:
+                        done.wait()
+                    if errors:
+                        break
+                    chunk_executed = results.pop(i)
+            else:
+                chunk_executed = [chunk]
+
+            if keep_executed:
+                executed += chunk_executed
+            if on_chunk is not None:
+                on_chunk(chunk_executed)
+    finally:
+        # Let the other groups finish, so that their kernels are closed.
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+    if rcParams["storeresults"] and processors:
+        processors.get(None, next(iter(processors.values()))).store(executed)
+
+    weaver.executed = executed
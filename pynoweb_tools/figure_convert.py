@@ -0,0 +1,351 @@
+r"""
+Figure Conversion
+=================
+Convert a document's figures to the extension the LaTeX prefilter
+rewrites their names to (the meta data field `figure_ext`), e.g. PDF
+figures from LaTeX to PNG or SVG for HTML.
+
+Every referenced figure (`Image` elements and `\includegraphics`
+commands) is looked up in the document's figure directories, and a
+target file with the `figure_ext` extension is written where the
+prefilter looks for it (see `figure_target`) when it's missing or older
+than the source.  Conversions
+run concurrently with the locally installed tools in `figure_converters`,
+and their output is cached by the source file's content hash (see
+`cache.DiskCache`), so a figure is only converted again when its content
+changes.
+
+The prefilter does this before its walk when the meta data field
+`convert_figures` or the environment variable `PYNOWEB_CONVERT_FIGURES`
+is set; see `LatexFilter.convert_figures`.
+"""
+import os
+import base64
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from pandocfilters import stringify
+
+from .cache import DiskCache
+
+figure_logger = logging.getLogger('figure_convert')
+figure_logger.addHandler(logging.NullHandler())
+
+r""" Environment variable that enables figure conversion.
+"""
+convert_env_var = 'PYNOWEB_CONVERT_FIGURES'
+
+r""" Conversion commands, in order of preference, as tuples of the source
+extension, the target extension (`None` matches any) and the command.
+The command's fields are `{source}`, `{target}`, `{target_base}` (the
+target without its extension), `{target_ext}` and `{dpi}`.  The first
+command for the extensions whose program is installed is used.
+"""
+figure_converters = [
+    ('pdf', 'png', ['pdftoppm', '-png', '-singlefile', '-r', '{dpi}',
+                    '{source}', '{target_base}']),
+    ('pdf', 'svg', ['pdftocairo', '-svg', '{source}', '{target}']),
+    ('pdf', 'svg', ['pdf2svg', '{source}', '{target}']),
+    ('eps', 'pdf', ['epstopdf', '--outfile={target}', '{source}']),
+    ('svg', 'png', ['rsvg-convert', '-f', 'png', '-o', '{target}',
+                    '{source}']),
+    ('svg', 'pdf', ['rsvg-convert', '-f', 'pdf', '-o', '{target}',
+                    '{source}']),
+    (None, None, ['magick', '-density', '{dpi}', '{source}', '{target}']),
+    (None, None, ['convert', '-density', '{dpi}', '{source}', '{target}']),
+]
+
+r""" Extensions of the files figures are converted from, in order of
+preference.
+"""
+source_exts = ['pdf', 'eps', 'svg', 'png', 'jpg', 'jpeg']
+
+default_dpi = 150
+
+
+def convert_figures_enabled(meta, environ=None):
+    r''' Whether the meta data or the environment enable figure
+    conversion.
+    '''
+    if environ is None:
+        environ = os.environ
+
+    meta_value = meta.get('convert_figures', None)
+    if meta_value is None:
+        value = environ.get(convert_env_var, '')
+    elif meta_value.get('t') == 'MetaBool':
+        return bool(meta_value['c'])
+    elif meta_value.get('t') == 'MetaString':
+        value = meta_value['c']
+    else:
+        value = stringify(meta_value['c'])
+
+    return value.strip().lower() in ('1', 'true', 'yes')
+
+
+def figure_references(blocks):
+    r''' Collect the figure names referenced in `blocks`, and the
+    directories in LaTeX `\graphicspath` commands.
+
+    Returns
+    =======
+    A tuple of the figure names (in document order and without duplicates)
+    and a set of directories.
+    '''
+    from .pandoc_utils import (graphics_pattern, gpath_pattern_1,
+                               gpath_pattern_2, walk_ast)
+
+    names = []
+    dirs = set()
+
+    def collect(key, value, oformat, meta):
+        new_names = []
+        if key == 'Image':
+            new_names = [value[-1][0]]
+        elif key == 'RawInline' and value[0] == 'latex':
+            new_names = graphics_pattern.findall(value[1])
+            gpaths_matches = gpath_pattern_1.search(value[1])
+            if gpaths_matches is not None:
+                for gpaths in gpaths_matches.groups():
+                    dirs.update(gpath_pattern_2.findall(gpaths))
+        for name in new_names:
+            if name not in names:
+                names.append(name)
+
+    walk_ast(blocks, {'Image': collect, 'RawInline': collect}, '', {})
+
+    return names, dirs
+
+
+def find_figure_source(fig_name, fig_dirs, fig_ext, index=None):
+    r''' Find the file to convert for a figure.
+
+    That's the first file with the figure's base name and one of
+    `source_exts` (its own extension first) in the figure directories,
+    like `pandoc_utils.rename_find_fig` looks for figures, or else the
+    figure's own file, when it exists and doesn't already have the target
+    extension.
+
+    Returns
+    =======
+    The source file's path, or `None` when there's nothing to convert.
+    '''
+    from .figures import figure_index
+
+    if index is None:
+        index = figure_index
+
+    fig_base, ext = os.path.splitext(os.path.basename(fig_name))
+    if ext[1:] == fig_ext:
+        ext = ''
+
+    candidates = [d for d in fig_dirs if d] or [os.curdir]
+
+    exts = [e for e in source_exts if e != fig_ext]
+    if ext:
+        exts = [ext[1:]] + [e for e in exts if e != ext[1:]]
+
+    source = index.find_first(fig_base, candidates, exts)
+    if source is None and ext and os.path.isfile(fig_name):
+        source = fig_name
+
+    return source
+
+
+def figure_target(fig_name, source, fig_dirs, fig_ext, index=None):
+    r''' The file to write a figure's conversion to, i.e. the one
+    `pandoc_utils.rename_find_fig` renames the figure to.
+
+    When that's a new file outside of the several figure directories,
+    and `source` is in one of them, the target goes next to `source`
+    instead, where `rename_find_fig` finds it once it's written.
+    '''
+    from .pandoc_utils import rename_find_fig
+
+    target = rename_find_fig(fig_name, fig_dirs, fig_ext, index=index)
+
+    source_dir = os.path.normpath(os.path.dirname(source))
+    if (len(fig_dirs) > 1 and not os.path.dirname(target) and
+            any(os.path.normpath(d) == source_dir for d in fig_dirs if d)):
+        target = os.path.join(os.path.dirname(source), target)
+
+    return target
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 16), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class FigureConverter(object):
+    r""" Converts figure files with local tools and caches the results.
+
+    Parameters
+    ==========
+    converters: list (Optional)
+        The conversion commands; see `figure_converters`.
+    cache: cache.DiskCache (Optional)
+        The cache of converted files.  Defaults to the `figures` cache
+        (see `DiskCache.from_env`); `False` disables caching.
+    dpi: int (Optional)
+        Resolution for the conversions to raster formats.
+    workers: int (Optional)
+        Number of concurrent conversions.  Defaults to the number of CPUs.
+
+    Attributes
+    ==========
+    stats: dict
+        Counts of the figures that were `current`, restored from the
+        cache (`cached`), `converted` and `failed`.
+    """
+
+    def __init__(self, converters=None, cache=None, dpi=default_dpi,
+                 workers=None):
+        self.converters = (figure_converters if converters is None
+                           else converters)
+        if cache is None:
+            cache = DiskCache.from_env('figures')
+        self.cache = cache or None
+        self.dpi = dpi
+        self.workers = workers or os.cpu_count() or 1
+
+        self.stats = {'current': 0, 'cached': 0, 'converted': 0,
+                      'failed': 0}
+        self._stats_lock = threading.Lock()
+
+    def command(self, source_ext, target_ext):
+        r''' The first conversion command for the extensions whose program
+        is installed, or `None`.
+        '''
+        for from_ext, to_ext, command in self.converters:
+            if from_ext is not None and from_ext != source_ext:
+                continue
+            if to_ext is not None and to_ext != target_ext:
+                continue
+            if shutil.which(command[0]) is not None:
+                return command
+        return None
+
+    def run_command(self, command, source, target_ext):
+        r''' Run a conversion command in a temporary directory.
+
+        Returns
+        =======
+        The converted file's content.
+        '''
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            target_base = os.path.join(tmp_dir, 'figure')
+            target = target_base + os.path.extsep + target_ext
+            args = [arg.format(source=source, target=target,
+                               target_base=target_base,
+                               target_ext=target_ext, dpi=self.dpi)
+                    for arg in command]
+
+            subprocess.run(args, check=True, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE)
+
+            with open(target, 'rb') as f:
+                return f.read()
+
+    def _convert(self, source, target, result):
+        source_ext = os.path.splitext(source)[1][1:].lower()
+        target_ext = os.path.splitext(target)[1][1:].lower()
+
+        command = self.command(source_ext, target_ext)
+        if command is None:
+            raise RuntimeError("No installed converter from {} to {}".format(
+                source_ext, target_ext))
+
+        key = None
+        data = None
+        if self.cache is not None:
+            key = DiskCache.key(file_hash(source), target_ext, command,
+                                self.dpi)
+            entry = self.cache.get(key)
+            if entry is not None:
+                data = base64.b64decode(entry['data'])
+                result['status'] = 'cached'
+
+        if data is None:
+            data = self.run_command(command, source, target_ext)
+            result['status'] = 'converted'
+            if self.cache is not None:
+                self.cache.set(key, {'data': base64.b64encode(
+                    data).decode('ascii')})
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(target) or os.curdir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, target)
+
+    def convert(self, source, target):
+        r''' Convert `source` to `target`, unless `target` is newer.
+
+        Returns
+        =======
+        A dict with the `source` and `target` paths, the `status`
+        (`current`, `cached`, `converted` or `failed`) and, for failures,
+        the `error`.
+        '''
+        result = {'source': source, 'target': target, 'status': None,
+                  'error': None}
+
+        try:
+            if (os.path.exists(target) and
+                    os.path.getmtime(target) >= os.path.getmtime(source)):
+                result['status'] = 'current'
+            else:
+                self._convert(source, target, result)
+        except Exception as e:
+            if isinstance(e, subprocess.CalledProcessError) and e.stderr:
+                e = e.stderr.decode('utf-8', 'replace').strip()
+            result['status'] = 'failed'
+            result['error'] = str(e)
+            figure_logger.warning("Couldn't convert {} to {}: {}\n".format(
+                source, target, result['error']))
+
+        with self._stats_lock:
+            self.stats[result['status']] += 1
+
+        return result
+
+    def convert_all(self, pairs):
+        r''' Convert `(source, target)` pairs concurrently.
+
+        Returns
+        =======
+        The `convert` results, in the order of `pairs`.
+        '''
+        pairs = list(pairs)
+        if not pairs:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(self.workers,
+                                                len(pairs))) as executor:
+            return list(executor.map(lambda p: self.convert(*p), pairs))
+
+
+def figure_targets(fig_names, fig_dirs, fig_ext, index=None):
+    r''' The `(source, target)` pairs for the figures that can be
+    converted to `fig_ext`.
+
+    See `find_figure_source` and `figure_target`.
+    '''
+    pairs = []
+    for fig_name in fig_names:
+        source = find_figure_source(fig_name, fig_dirs, fig_ext, index)
+        if source is None:
+            continue
+        target = figure_target(fig_name, source, fig_dirs, fig_ext, index)
+        if (source, target) not in pairs:
+            pairs.append((source, target))
+    return pairs
@@ -0,0 +1,143 @@
+r"""
+Figure Indexing
+===============
+Figure file lookup for the LaTeX prefilter.
+
+Each figure directory is listed once and indexed by the figures' base
+names, instead of probing for every candidate path of every figure.  A
+directory is listed again only when its modification time changes, and
+its modification time is checked at most once every `refresh_interval`
+seconds.  Since modification times can be too coarse to show a file
+written right after a listing, a lookup that finds nothing lists the
+directories again before giving up (see `FigureIndex.find_first`)--but
+not those listed within the last `refresh_interval` seconds, so that
+missing figures don't cost a listing each.
+"""
+import os
+import time
+import threading
+
+
+class FigureIndex(object):
+    r""" An index of the files in figure directories by base name and
+    extension.
+
+    Parameters
+    ==========
+    refresh_interval: float (Optional)
+        Seconds between checks of a directory's modification time, and
+        between the listings of a directory requested by lookups that find
+        nothing.
+    """
+
+    def __init__(self, refresh_interval=1.0):
+        self.refresh_interval = refresh_interval
+        self.stats = {'scans': 0}
+
+        self._dirs = dict()
+        self._lock = threading.Lock()
+
+    def scan(self, fig_dir):
+        r''' List `fig_dir`.
+
+        Returns
+        =======
+        A dict mapping base file names to dicts of extensions (without
+        the separator) and file names.
+        '''
+        self.stats['scans'] += 1
+
+        entries = dict()
+        try:
+            with os.scandir(fig_dir) as it:
+                for entry in it:
+                    if not entry.is_file():
+                        continue
+                    base, ext = os.path.splitext(entry.name)
+                    entries.setdefault(base, dict())[ext[1:]] = entry.name
+        except OSError:
+            pass
+
+        return entries
+
+    def directory(self, fig_dir, rescan=False):
+        r''' Get the index entries for `fig_dir`, listing it again when it
+        has changed (or when `rescan` is true and it wasn't listed within
+        the last `refresh_interval` seconds).
+        '''
+        now = time.monotonic()
+
+        with self._lock:
+            dir_index = self._dirs.get(fig_dir, None)
+
+            if dir_index is not None:
+                if rescan:
+                    rescan = now - dir_index[3] >= self.refresh_interval
+                if not rescan and now - dir_index[1] < self.refresh_interval:
+                    return dir_index[2]
+
+            try:
+                mtime = os.stat(fig_dir).st_mtime_ns
+            except OSError:
+                mtime = None
+
+            if rescan or dir_index is None or dir_index[0] != mtime:
+                entries = self.scan(fig_dir) if mtime is not None else {}
+                listed = now
+            else:
+                entries = dir_index[2]
+                listed = dir_index[3]
+
+            self._dirs[fig_dir] = (mtime, now, entries, listed)
+
+            return entries
+
+    def find(self, fig_base, fig_dir, fig_exts, rescan=False):
+        r''' Find the file for `fig_base` in `fig_dir` with the first
+        available extension in `fig_exts`.
+
+        Returns
+        =======
+        The file's path, or `None` when there isn't one.
+        '''
+        fig_files = self.directory(fig_dir, rescan).get(fig_base, None)
+        if not fig_files:
+            return None
+
+        for fig_ext in fig_exts:
+            fig_file = fig_files.get(fig_ext, None)
+            if fig_file is not None:
+                return os.path.join(fig_dir, fig_file)
+
+        return None
+
+    def find_first(self, fig_base, fig_dirs, fig_exts):
+        r''' Find the file for `fig_base` in the first of `fig_dirs` with a
+        file for any of `fig_exts` (see `find`).
+
+        When there's none, the directories are listed again and searched
+        once more, in case a file was written within the resolution of
+        their modification times.  Each directory is listed again at most
+        once every `refresh_interval` seconds, though; a figure converted
+        in the meantime is found after `clear`.
+
+        Returns
+        =======
+        The file's path, or `None` when there isn't one.
+        '''
+        for rescan in (False, True):
+            for fig_dir in fig_dirs:
+                fig_file = self.find(fig_base, fig_dir, fig_exts, rescan)
+                if fig_file is not None:
+                    return fig_file
+
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._dirs = dict()
+
+
+r""" The figure index used by `pandoc_utils.rename_find_fig`.
+"""
+figure_index = FigureIndex()
@@ -0,0 +1,190 @@
+r"""
+Filter Profiling
+================
+Opt-in instrumentation of the LaTeX prefilter: counts and cumulative
+times per AST node type and per handler, the durations of the nested
+Pandoc conversions, environment cache hits and figure lookups.
+
+The `env_cache` counts are the environment bodies converted without
+Pandoc (`fast_path`, see `latex_subset`) and those outside the subset
+(`fast_path_fallbacks`), the bodies converted in batches (`batched`), the
+environments whose bodies were found among those (`batch_hits`), the
+on-disk cache hits and misses, and the bodies that needed their own
+conversion (`single_conversions`).  With incremental filtering (see
+`incremental`), they also count the stored top-level blocks that were
+reused (`block_hits`)--and of those, the ones that were renumbered
+(`block_renumbered`)--and those that were filtered (`block_misses`).
+
+Profiling is enabled with the environment variable
+`PYNOWEB_FILTER_PROFILE` or the document meta data field `filter_profile`
+(e.g. `pandoc -M filter_profile=doc.profile.json`), set to the path of
+the JSON report, or to `1`/`true` for the default path.  That's the
+document file's path with the extension `.profile.json`, when the file is
+known (e.g. in batch filtering or watch mode), so that each document gets
+its own report, and `default_profile_path` otherwise (i.e. for a single
+document on standard input).  The report is written when the document has
+been filtered.
+
+Times are inclusive (`seconds`) and exclusive of the nested filter walks
+within environment bodies (`self_seconds`).  When profiling is disabled,
+the filter doesn't touch any of this.
+"""
+import os
+import json
+import time
+
+from pandocfilters import stringify
+
+r""" Environment variable that enables profiling.
+"""
+profile_env_var = 'PYNOWEB_FILTER_PROFILE'
+
+r""" The report's path when profiling is enabled without one, for a
+document that isn't read from a file.
+"""
+default_profile_path = 'pynoweb_filter_profile.json'
+
+
+def get_profile_path(meta, environ=None, source=None):
+    r''' The report path set by the meta data or the environment, or
+    `None` when profiling is disabled.
+
+    Parameters
+    ==========
+    meta: dict
+        The document's Pandoc meta data.
+    environ: dict (Optional)
+        The environment variables.
+    source: str (Optional)
+        The document's file, when it's known; the default report goes next
+        to it.
+    '''
+    if environ is None:
+        environ = os.environ
+
+    value = None
+    meta_value = meta.get('filter_profile', None)
+    if meta_value is not None:
+        if meta_value.get('t') == 'MetaBool':
+            value = 'true' if meta_value['c'] else ''
+        elif meta_value.get('t') == 'MetaString':
+            value = meta_value['c']
+        else:
+            value = stringify(meta_value['c'])
+    else:
+        value = environ.get(profile_env_var, '')
+
+    value = value.strip()
+    if value.lower() in ('', '0', 'false', 'no'):
+        return None
+    if value.lower() in ('1', 'true', 'yes'):
+        if source is not None:
+            return os.path.splitext(source)[0] + '.profile.json'
+        return default_profile_path
+
+    return value
+
+
+def node_handler(key, value):
+    r''' The name of the `LatexFilter` handler for a node.
+    '''
+    if key == 'RawInline' and value[0] == 'latex':
+        return 'inline_tex'
+    elif key == 'Image':
+        return 'process_image'
+    elif key == 'Math' and value[0]['t'] == 'DisplayMath':
+        return 'display_math'
+    elif key == 'RawBlock' and value[0] == 'latex':
+        return 'process_latex_envs'
+    elif 'Raw' in key:
+        return 'drop_raw'
+    return 'none'
+
+
+class FilterProfile(object):
+    r""" Profile data for one document.
+
+    Parameters
+    ==========
+    path: str (Optional)
+        Where `write` puts the report.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+        self.nodes = dict()
+        self.handlers = dict()
+        self.nested_conversions = []
+        self.cache = {'fast_path': 0, 'fast_path_fallbacks': 0,
+                      'batched': 0, 'batch_hits': 0, 'disk_hits': 0,
+                      'disk_misses': 0, 'single_conversions': 0,
+                      'block_hits': 0, 'block_misses': 0,
+                      'block_renumbered': 0}
+        self.figure_lookups = {'count': 0, 'seconds': 0.0}
+
+        # Time spent in nested calls, for each active call.
+        self._child_seconds = []
+
+    def _add(self, table, name, elapsed, self_elapsed):
+        entry = table.get(name, None)
+        if entry is None:
+            entry = table[name] = {'count': 0, 'seconds': 0.0,
+                                   'self_seconds': 0.0}
+        entry['count'] += 1
+        entry['seconds'] += elapsed
+        entry['self_seconds'] += self_elapsed
+
+    def call_node(self, func, key, value, *args):
+        r''' Call the filter action `func` on a node and record its time.
+        '''
+        self._child_seconds.append(0.0)
+        start_time = time.perf_counter()
+        try:
+            return func(key, value, *args)
+        finally:
+            elapsed = time.perf_counter() - start_time
+            self_elapsed = elapsed - self._child_seconds.pop()
+            if self._child_seconds:
+                self._child_seconds[-1] += elapsed
+
+            self._add(self.nodes, key, elapsed, self_elapsed)
+            self._add(self.handlers, node_handler(key, value), elapsed,
+                      self_elapsed)
+
+    def add_conversion(self, bodies, seconds, batched):
+        r''' Record a nested Pandoc conversion of `bodies` environment
+        bodies.
+        '''
+        self.nested_conversions.append({'bodies': bodies,
+                                        'seconds': seconds,
+                                        'batched': batched})
+
+    def add_figure_lookup(self, seconds):
+        self.figure_lookups['count'] += 1
+        self.figure_lookups['seconds'] += seconds
+
+    def report(self, figure_scans=None):
+        r''' The profile data as a JSON-serializable dict.
+        '''
+        report = {'nodes': self.nodes,
+                  'handlers': self.handlers,
+                  'nested_conversions': {
+                      'count': len(self.nested_conversions),
+                      'seconds': sum(c['seconds']
+                                     for c in self.nested_conversions),
+                      'calls': self.nested_conversions},
+                  'env_cache': self.cache,
+                  'figure_lookups': dict(self.figure_lookups)}
+
+        if figure_scans is not None:
+            report['figure_lookups']['directory_scans'] = figure_scans
+
+        return report
+
+    def write(self, figure_scans=None):
+        r''' Write the report to `path`.
+        '''
+        with open(self.path, 'w') as f:
+            json.dump(self.report(figure_scans), f, indent=2,
+                      sort_keys=True)
@@ -0,0 +1,172 @@
+r"""
+Incremental Filtering
+=====================
+Filter only the top-level blocks of a document that changed since it was
+last filtered, and reuse the filtered blocks of the rest from a local
+store (see `cache.DiskCache`).
+
+The top-level blocks with LaTeX environments (see `stored_block`), which
+need the nested conversions, are looked up by the hash of the block itself
+and of the document-level configuration (`config_key`), i.e. the meta
+data, the module-level filter settings, the target format, the Pandoc
+version of the nested conversions and our version.  The other blocks are
+cheaper to filter again than to hash and read back, so they're always
+filtered.
+
+A stored result is only reused when the state it depends on from the
+blocks before it is the same:  the figure directories (`\graphicspath`
+adds to them), the figure files its figure names were found at, and which
+of its figures were already processed by an earlier block.  Otherwise,
+the block is filtered again.
+
+Environment and figure numbers depend on all the blocks before, so they
+aren't part of the key:  a reused block that's now preceded by a
+different number of environments or labeled figures is renumbered in
+place (see `renumber_blocks`), which is much cheaper than filtering it.
+
+Incremental filtering is enabled with the meta data field `incremental`
+or the environment variable `PYNOWEB_INCREMENTAL` (e.g. `1`/`true`), and
+needs the on-disk caches (see `cache.default_cache_dir`).  See
+`pandoc_utils.LatexFilter.apply`.
+"""
+import os
+
+from pandocfilters import Para, stringify
+
+from . import get_version
+from .cache import DiskCache
+
+r""" Environment variable that enables incremental filtering.
+"""
+incremental_env_var = 'PYNOWEB_INCREMENTAL'
+
+
+def incremental_enabled(meta, environ=None):
+    r''' Whether the meta data or the environment enable incremental
+    filtering.
+    '''
+    if environ is None:
+        environ = os.environ
+
+    meta_value = meta.get('incremental', None)
+    if meta_value is None:
+        value = environ.get(incremental_env_var, '')
+    elif meta_value.get('t') == 'MetaBool':
+        return bool(meta_value['c'])
+    elif meta_value.get('t') == 'MetaString':
+        value = meta_value['c']
+    else:
+        value = stringify(meta_value['c'])
+
+    return value.strip().lower() in ('1', 'true', 'yes')
+
+
+def callable_name(to_):
+    return '{}.{}'.format(getattr(to_, '__module__', ''),
+                          getattr(to_, '__qualname__', repr(to_)))
+
+
+def config_key(config, oformat, pandoc_version):
+    r''' The part of the block keys that covers the document-level
+    configuration.
+
+    Parameters
+    ==========
+    config: pandoc_utils.FilterConfig
+        The document's filter configuration.
+    oformat: str
+        The target format passed to the filter.
+    pandoc_version: str
+        The Pandoc version of the nested conversions.
+    '''
+    custom_inline_math = sorted(
+        (from_, callable_name(to_) if callable(to_) else to_)
+        for from_, to_ in config.custom_inline_math.items())
+
+    return DiskCache.key(get_version(), oformat, pandoc_version,
+                         config.meta, config.preserved_tex,
+                         config.env_conversions, custom_inline_math,
+                         config.latex_fast_path)
+
+
+def stored_block(block):
+    r''' Whether a top-level block's filtered blocks are stored, i.e.
+    whether it's raw LaTeX with an environment.
+    '''
+    return (block['t'] == 'RawBlock' and block['c'][0] == 'latex' and
+            '\\begin{' in block['c'][1])
+
+
+def block_key(config_key, block):
+    r''' The store key of a top-level block.
+    '''
+    return DiskCache.key(config_key, block)
+
+
+def env_div_number(div_attr):
+    r''' The environment number of a Div produced by
+    `pandoc_utils.LatexFilter.process_latex_envs`, or `None` for other
+    Div's.
+    '''
+    key_values = div_attr[2]
+    if (len(key_values) == 3 and key_values[0] == ['markdown', ''] and
+            key_values[1][0] == 'env-number'):
+        return key_values[1]
+    return None
+
+
+def renumber_blocks(blocks, env_offsets, figure_numbers):
+    r''' Renumber the environments and labeled figures in filtered blocks,
+    in place.
+
+    Environments are numbered in document order, starting after their
+    offsets--like `LatexFilter.process_latex_envs` numbers them--and
+    figures get the numbers in `figure_numbers`.  Their Div and Span
+    attributes and the MathJax labels (see
+    `pandoc_utils.label_to_mathjax`) are rewritten.
+
+    Parameters
+    ==========
+    blocks: list
+        The filtered blocks.
+    env_offsets: dict
+        The number of environments of each name before `blocks`.
+    figure_numbers: dict
+        The numbers of the labeled figures by figure filename.
+    '''
+    from .pandoc_utils import label_to_mathjax, walk_ast
+
+    env_counters = dict(env_offsets)
+
+    def renumber_env(key, value, oformat, meta):
+        div_attr, div_blocks = value
+        env_number = env_div_number(div_attr)
+        if env_number is None:
+            return None
+
+        env_name = div_attr[1][0]
+        env_num = env_counters.get(env_name, 0) + 1
+        env_counters[env_name] = env_num
+        env_number[1] = str(env_num)
+
+        env_label = div_attr[0]
+        if env_label and div_blocks and div_blocks[0]['t'] == 'Para':
+            label_span = div_blocks[0]['c'][:1]
+            if (label_span and label_span[0]['t'] == 'Span' and
+                    label_span[0]['c'][0][0] == env_label + '_span'):
+                div_blocks[0] = Para([label_to_mathjax(env_label,
+                                                       env_tag=env_num)])
+
+    def renumber_figure(key, value, oformat, meta):
+        span_attr, inlines = value
+        if (len(inlines) != 2 or inlines[0]['t'] != 'Span' or
+                inlines[1]['t'] != 'Image'):
+            return None
+
+        fig_label = span_attr[0]
+        fig_num = figure_numbers.get(inlines[1]['c'][2][0], None)
+        if (fig_num is not None and
+                inlines[0]['c'][0][0] == fig_label + '_span'):
+            inlines[0] = label_to_mathjax(fig_label, env_tag=fig_num)
+
+    walk_ast(blocks, {'Div': renumber_env, 'Span': renumber_figure}, '', {})
@@ -0,0 +1,277 @@
+r"""
+Warm Kernel Pools
+=================
+A daemon that keeps pools of started (and, optionally, preloaded) Jupyter
+kernels for `PynowebWeave` to use, so that a weave doesn't wait for a
+kernel to start and import its libraries.
+
+The pools are directories of kernel connection files:
+`<pool_dir>/<kernel_name>/ready/` holds the kernels that are free to use.
+A weave claims a kernel by moving its connection file into the
+`claimed/` directory--an atomic rename, so that no two weaves get the
+same kernel--and releases it, after resetting its namespace, by moving
+the file back.  The daemon (see `KernelDaemon` and the
+`PynowebKernelDaemon` script) restarts kernels that die.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import tempfile
+from optparse import OptionParser
+
+kernel_logger = logging.getLogger('kernel_daemon')
+kernel_logger.addHandler(logging.NullHandler())
+
+r""" Environment variable for the kernel pool directory.
+"""
+pool_dir_env_var = 'PYNOWEB_KERNEL_POOL'
+
+
+def default_pool_dir(environ=None):
+    r''' The kernel pool directory: `PYNOWEB_KERNEL_POOL` or a directory in
+    the Jupyter runtime directory.
+    '''
+    if environ is None:
+        environ = os.environ
+
+    pool_dir = environ.get(pool_dir_env_var, None)
+    if pool_dir:
+        return pool_dir
+
+    from jupyter_core.paths import jupyter_runtime_dir
+    return os.path.join(jupyter_runtime_dir(), 'pynoweb_kernels')
+
+
+def _ready_dir(pool_dir, kernel_name):
+    return os.path.join(pool_dir, kernel_name, 'ready')
+
+
+def _claimed_dir(pool_dir, kernel_name):
+    return os.path.join(pool_dir, kernel_name, 'claimed')
+
+
+def claim_kernel(kernel_name, pool_dir=None):
+    r''' Claim a ready kernel from the pool.
+
+    Returns
+    =======
+    The path of the claimed kernel's connection file, or `None` when no
+    kernel is ready.
+    '''
+    if pool_dir is None:
+        pool_dir = default_pool_dir()
+
+    ready_dir = _ready_dir(pool_dir, kernel_name)
+    claimed_dir = _claimed_dir(pool_dir, kernel_name)
+
+    try:
+        fnames = sorted(os.listdir(ready_dir))
+    except OSError:
+        return None
+
+    for fname in fnames:
+        if not fname.endswith('.json'):
+            continue
+        claimed_path = os.path.join(claimed_dir, fname)
+        try:
+            os.rename(os.path.join(ready_dir, fname), claimed_path)
+        except OSError:
+            # Someone else claimed it first.
+            continue
+        return claimed_path
+
+    return None
+
+
+def release_kernel(connection_file):
+    r''' Return a claimed kernel to its pool.
+    '''
+    claimed_dir, fname = os.path.split(connection_file)
+    ready_dir = os.path.join(os.path.dirname(claimed_dir), 'ready')
+    try:
+        os.rename(connection_file, os.path.join(ready_dir, fname))
+    except OSError as e:
+        kernel_logger.warning("Couldn't release kernel {}: {}\n".format(
+            connection_file, e))
+
+
+def reset_code(preload=None):
+    r''' IPython code that clears a kernel's namespace and runs the preload
+    script again.
+
+    The modules imported by the preload script stay loaded, so running it
+    again is cheap.
+    '''
+    code = "%reset -f\n"
+    if preload is not None:
+        code += "%run -i {}\n".format(json.dumps(os.path.abspath(preload)))
+    return code
+
+
+class KernelDaemon(object):
+    r""" Keeps pools of started Jupyter kernels.
+
+    Parameters
+    ==========
+    kernels: dict
+        Number of kernels to keep, by kernel (spec) name.
+    pool_dir: str (Optional)
+        The pool directory.  Defaults to `default_pool_dir()`.
+    preload: str (Optional)
+        A script to run in each (IPython) kernel after it starts, e.g. to
+        import libraries.
+    """
+
+    def __init__(self, kernels, pool_dir=None, preload=None):
+        self.kernels = kernels
+        self.pool_dir = pool_dir or default_pool_dir()
+        self.preload = preload
+
+        self.managers = dict()
+
+    def _write_connection_file(self, kernel_id, kernel_name, info):
+        ready_dir = _ready_dir(self.pool_dir, kernel_name)
+        fd, tmp_path = tempfile.mkstemp(dir=ready_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(info, f)
+        os.replace(tmp_path, os.path.join(ready_dir, kernel_id + '.json'))
+
+    def start_kernel(self, kernel_name):
+        r''' Start a kernel, run the preload script in it and add it to the
+        kernel's pool.
+        '''
+        from jupyter_client import KernelManager
+
+        start_time = time.monotonic()
+
+        km = KernelManager(kernel_name=kernel_name)
+        km.start_kernel(stderr=open(os.devnull, 'w'))
+        kc = km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=60)
+            if self.preload is not None:
+                kc.execute_interactive(reset_code(self.preload),
+                                       store_history=False, timeout=300)
+        finally:
+            kc.stop_channels()
+
+        startup_seconds = time.monotonic() - start_time
+
+        kernel_id = uuid.uuid4().hex
+        self.managers[kernel_id] = (kernel_name, km)
+
+        info = km.get_connection_info(session=False)
+        info = {k: (v.decode('ascii') if isinstance(v, bytes) else v)
+                for k, v in info.items()}
+        info['kernel_name'] = kernel_name
+        info['pynoweb_preload'] = (os.path.abspath(self.preload)
+                                   if self.preload is not None else None)
+        info['pynoweb_startup_seconds'] = startup_seconds
+        self._write_connection_file(kernel_id, kernel_name, info)
+
+        kernel_logger.info("Started {} kernel {} in {:.3f}s\n".format(
+            kernel_name, kernel_id, startup_seconds))
+
+        return kernel_id
+
+    def _remove_connection_files(self, kernel_id, kernel_name):
+        for fdir in (_ready_dir(self.pool_dir, kernel_name),
+                     _claimed_dir(self.pool_dir, kernel_name)):
+            try:
+                os.unlink(os.path.join(fdir, kernel_id + '.json'))
+            except OSError:
+                pass
+
+    def start(self):
+        for kernel_name, count in self.kernels.items():
+            for fdir in (_ready_dir(self.pool_dir, kernel_name),
+                         _claimed_dir(self.pool_dir, kernel_name)):
+                os.makedirs(fdir, exist_ok=True)
+                # Remove the connection files left by an earlier daemon.
+                for fname in os.listdir(fdir):
+                    os.unlink(os.path.join(fdir, fname))
+
+            for _ in range(count):
+                self.start_kernel(kernel_name)
+
+        return self
+
+    def check_health(self):
+        r''' Replace the kernels that have died.
+
+        Returns
+        =======
+        The IDs of the replaced kernels.
+        '''
+        replaced = []
+        for kernel_id, (kernel_name, km) in list(self.managers.items()):
+            if km.is_alive():
+                continue
+
+            kernel_logger.warning("Replacing dead {} kernel {}\n".format(
+                kernel_name, kernel_id))
+            self._remove_connection_files(kernel_id, kernel_name)
+            km.cleanup_resources()
+            del self.managers[kernel_id]
+
+            self.start_kernel(kernel_name)
+            replaced.append(kernel_id)
+
+        return replaced
+
+    def stop(self):
+        for kernel_id, (kernel_name, km) in self.managers.items():
+            self._remove_connection_files(kernel_id, kernel_name)
+            km.shutdown_kernel(now=True)
+        self.managers = dict()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def serve():
+    r""" A callable script that keeps pools of warm Jupyter kernels for
+    `PynowebWeave --kernel-pool`.
+    """
+    parser = OptionParser(usage="PynowebKernelDaemon [options]")
+    parser.add_option("-k", "--kernel",
+                      dest="kernels", action="append", default=[],
+                      help=("Kernel name and pool size, as NAME[:COUNT]; "
+                            "can be repeated: Default python3:1"))
+    parser.add_option("-p", "--preload",
+                      dest="preload", default=None,
+                      help="Script to run in each new (IPython) kernel")
+    parser.add_option("-d", "--pool-directory",
+                      dest="pool_dir", default=None,
+                      help=("Directory for the pools' connection files: "
+                            "Default ${}".format(pool_dir_env_var)))
+    parser.add_option("-i", "--health-interval",
+                      dest="health_interval", type="float", default=5.0,
+                      help="Seconds between kernel health checks")
+
+    (options, args) = parser.parse_args()
+
+    kernels = dict()
+    for kernel in options.kernels or ['python3']:
+        kernel_name, _, count = kernel.partition(':')
+        kernels[kernel_name] = int(count or 1)
+
+    daemon = KernelDaemon(kernels, pool_dir=options.pool_dir,
+                          preload=options.preload)
+
+    with daemon:
+        print("{}={}".format(pool_dir_env_var, daemon.pool_dir))
+        sys.stdout.flush()
+        try:
+            while True:
+                time.sleep(options.health_interval)
+                daemon.check_health()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,148 @@
+r"""
+LaTeX Environments
+==================
+A single-pass tokenizer for the `\begin{...}`/`\end{...}` pairs in LaTeX
+source, e.g. the raw LaTeX blocks the prefilter turns into Div's (see
+`pandoc_utils.LatexFilter.process_latex_envs`).
+
+`iter_latex_envs` yields every top-level environment in the source, in
+order, with its optional argument, label and body.  It tracks the nesting
+depth with a stack of open environments, so a nested environment with the
+same name doesn't end its parent, and each token is looked at once, so it
+runs in time linear in the length of the source.
+
+Comments are skipped, and the bodies of the environments in
+`verbatim_envs` aren't tokenized.  An `\end` that doesn't match the
+innermost open environment closes the open environments up to the one it
+matches (or is ignored when there's none), and environments that are
+never closed are treated as text, i.e. the environments within them can
+still be top-level.
+"""
+import re
+from collections import namedtuple
+
+r""" Environments whose bodies are taken as they are, up to their `\end`.
+"""
+verbatim_envs = frozenset(['verbatim', 'Verbatim', 'lstlisting', 'minted',
+                           'comment'])
+
+token_pattern = re.compile(
+    r'\\(?:(begin|end)\{([^{}\\%\s]+)\}|label\{(\w*:?\w+)\}|.)|%', re.S)
+
+# An optional argument ends at the first `]` outside of braces, and it
+# can't contain another environment, which keeps a missing `]` from making
+# us scan the rest of the source for each environment.
+title_pattern = re.compile(
+    r'\[(?:[^\[\]{}\\]|\\(?!begin\{|end\{)|\{[^{}]*\})*\]', re.S)
+
+r""" A top-level LaTeX environment.
+
+`name` is the environment's name, `title` its optional argument, with its
+brackets (an empty string when absent), `body` the source between its
+`\begin` (and optional argument) and its `\end`, with the first `\label`
+in it--and the whitespace before that--removed, and `label` that label
+(`None` when absent).  `span` and `body_span` are the start and end of
+the environment and of its body (with the label) in the source.
+"""
+LatexEnv = namedtuple('LatexEnv',
+                      ['name', 'title', 'body', 'label', 'span', 'body_span'])
+
+
+def make_latex_env(source, frame, body_end, end):
+    name, start, title, body_start, label, label_start, label_end = frame
+
+    if label is None:
+        body = source[body_start:body_end]
+    else:
+        body = source[body_start:label_start] + source[label_end:body_end]
+
+    return LatexEnv(name, title, body, label, (start, end),
+                    (body_start, body_end))
+
+
+def iter_latex_envs(source):
+    r''' Tokenize the `\begin{...}`/`\end{...}` pairs in LaTeX source.
+
+    Parameters
+    ==========
+    source: str
+        The LaTeX source.
+
+    Returns
+    =======
+    A generator of the top-level environments in `source`, as `LatexEnv`
+    tuples, in order.
+    '''
+    # Each frame is an open environment's name, start, title, body start
+    # and the label directly within it, with the label's start and end.
+    stack = []
+    open_names = dict()
+    # The closed environments that aren't within a closed environment, while
+    # there are open environments (that might never be closed).
+    pending = []
+    pos = 0
+
+    while True:
+        ma = token_pattern.search(source, pos)
+        if ma is None:
+            break
+
+        pos = ma.end()
+        kind, name, label = ma.groups()
+
+        if kind == 'begin':
+            title = ''
+            title_info = title_pattern.match(source, pos)
+            if title_info is not None:
+                title = title_info.group(0)
+                pos = title_info.end()
+
+            stack.append([name, ma.start(), title, pos, None, None, None])
+            open_names[name] = open_names.get(name, 0) + 1
+
+            if name in verbatim_envs:
+                verbatim_end = source.find('\\end{' + name + '}', pos)
+                if verbatim_end < 0:
+                    break
+                pos = verbatim_end
+
+        elif kind == 'end':
+            if not open_names.get(name, 0):
+                continue
+
+            while True:
+                frame = stack.pop()
+                open_names[frame[0]] -= 1
+                if frame[0] == name:
+                    break
+
+            # The bodies are only sliced for the environments we yield, since
+            # those of nested environments add up to more than the source.
+            closed = (frame, ma.start(), pos)
+
+            while pending and pending[-1][0][1] > frame[1]:
+                pending.pop()
+            pending.append(closed)
+
+            if not stack:
+                for closed in pending:
+                    yield make_latex_env(source, *closed)
+                del pending[:]
+
+        elif label is not None:
+            if stack and stack[-1][4] is None:
+                frame = stack[-1]
+                label_start = ma.start()
+                while (label_start > frame[3] and
+                       source[label_start - 1].isspace()):
+                    label_start -= 1
+                frame[4:] = [label, label_start, pos]
+
+        elif ma.group(0) == '%':
+            comment_end = source.find('\n', pos)
+            if comment_end < 0:
+                break
+            pos = comment_end + 1
+
+    for closed in pending:
+        yield make_latex_env(source, *closed)
@@ -0,0 +1,189 @@
+r"""
+LaTeX Subset
+============
+A pure-Python conversion of simple LaTeX environment bodies to Pandoc
+JSON AST blocks, so that they don't need a nested Pandoc call (see
+`pandoc_utils.LatexFilter.batch_convert_latex_envs`).
+
+The subset is paragraphs of plain text with inline `$...$` math, the
+reference commands in `ref_commands` (which Pandoc keeps as raw LaTeX) and
+the emphasis commands in `emph_commands`.  For these, the conversion
+produces the same `Para`, `Str`, `Space`, `SoftBreak`, `Math`,
+`RawInline` and `Emph` elements as Pandoc's LaTeX reader with raw TeX
+enabled and `--wrap=none` (i.e. the nested conversions).  Anything else--
+other commands, groups, comments, display math, quotes, dashes, ties,
+non-ASCII text, adjacent emphasis that joins two words, etc.--is left to
+Pandoc.
+
+The fast path is enabled by default; the meta data field
+`latex_fast_path` or the environment variable `PYNOWEB_LATEX_FAST_PATH`
+set to `0`/`false` disables it.  `stats` counts the bodies it converted
+and those it left to Pandoc.
+"""
+import os
+import re
+
+from pandocfilters import (Para, Str, Space, SoftBreak, Math, Emph,
+                           RawInline, stringify)
+
+r""" Environment variable that disables the fast path.
+"""
+fast_path_env_var = 'PYNOWEB_LATEX_FAST_PATH'
+
+r""" Commands that Pandoc keeps as `RawInline` LaTeX.
+"""
+ref_commands = ('ref', 'cref', 'Cref', 'eqref')
+
+r""" Commands that Pandoc turns into `Emph`.
+"""
+emph_commands = ('emph', 'textit')
+
+r""" Counts of the bodies that were converted, and of those that were
+outside the subset.
+"""
+stats = {'converted': 0, 'fallbacks': 0}
+
+paragraph_pattern = re.compile(r'\n[ \t]*(?:\n[ \t]*)+')
+
+space_pattern = re.compile(r'[ \t\n]+')
+
+# Characters that Pandoc's LaTeX reader passes through as they are.
+text_pattern = re.compile(r'[A-Za-z0-9.,;:!?()\[\]/+=*@|<>-]+')
+
+command_pattern = re.compile(r'\\([A-Za-z]+)\{')
+
+ref_arg_pattern = re.compile(r'[^{}\\$%\n]*\}')
+
+
+class OutsideSubset(Exception):
+    pass
+
+
+def fast_path_enabled(meta, environ=None):
+    r''' Whether the meta data and the environment leave the fast path
+    enabled.
+    '''
+    if environ is None:
+        environ = os.environ
+
+    meta_value = meta.get('latex_fast_path', None)
+    if meta_value is None:
+        value = environ.get(fast_path_env_var, '')
+    elif meta_value.get('t') == 'MetaBool':
+        return bool(meta_value['c'])
+    elif meta_value.get('t') == 'MetaString':
+        value = meta_value['c']
+    else:
+        value = stringify(meta_value['c'])
+
+    return value.strip().lower() not in ('0', 'false', 'no')
+
+
+def parse_inlines(source, pos, in_group):
+    r''' Parse the inline elements in `source` from `pos` up to the end, or
+    up to the closing brace when `in_group`.
+
+    Returns
+    =======
+    A tuple of the inline elements and the position after them (after the
+    closing brace when `in_group`).
+    '''
+    inlines = []
+    space = None
+    end = len(source)
+
+    while pos < end:
+        c = source[pos]
+
+        if c in ' \t\n':
+            ma = space_pattern.match(source, pos)
+            space = ma.group(0)
+            pos = ma.end()
+            continue
+
+        if c == '}':
+            if not in_group or space is not None:
+                raise OutsideSubset()
+            return inlines, pos + 1
+
+        if space is not None:
+            if not inlines:
+                if in_group:
+                    raise OutsideSubset()
+            else:
+                inlines.append(SoftBreak() if '\n' in space else Space())
+            space = None
+
+        if c == '$':
+            close = source.find('$', pos + 1)
+            if close <= pos + 1:
+                # Display math, or no closing `$`.
+                raise OutsideSubset()
+            math = source[pos + 1:close]
+            if math.endswith('\\') or '%' in math or not math.strip():
+                raise OutsideSubset()
+            inlines.append(Math({'t': 'InlineMath', 'c': []}, math.strip()))
+            pos = close + 1
+
+        elif c == '\\':
+            ma = command_pattern.match(source, pos)
+            if ma is None:
+                raise OutsideSubset()
+            command = ma.group(1)
+            if command in ref_commands:
+                arg = ref_arg_pattern.match(source, ma.end())
+                if arg is None:
+                    raise OutsideSubset()
+                inlines.append(RawInline('latex', source[pos:arg.end()]))
+                pos = arg.end()
+            elif command in emph_commands:
+                group, pos = parse_inlines(source, ma.end(), True)
+                if inlines and inlines[-1]['t'] == 'Emph':
+                    # Pandoc joins adjacent emphasis, but whether it also
+                    # merges the text at the join depends on its version.
+                    joined = inlines[-1]['c']
+                    if (joined and group and joined[-1]['t'] == 'Str' and
+                            group[0]['t'] == 'Str'):
+                        raise OutsideSubset()
+                    joined.extend(group)
+                else:
+                    inlines.append(Emph(group))
+            else:
+                raise OutsideSubset()
+
+        else:
+            ma = text_pattern.match(source, pos)
+            if ma is None or '--' in ma.group(0):
+                raise OutsideSubset()
+            inlines.append(Str(ma.group(0)))
+            pos = ma.end()
+
+    if in_group:
+        # No closing brace.
+        raise OutsideSubset()
+
+    return inlines, pos
+
+
+def convert_latex_subset(env_body):
+    r''' Convert a LaTeX environment body within the subset to Pandoc JSON
+    AST blocks.
+
+    Returns
+    =======
+    A document with the body's `blocks` (and empty `meta`), like the nested
+    Pandoc conversions produce, or `None` when the body is outside the
+    subset.
+    '''
+    blocks = []
+    try:
+        for paragraph in paragraph_pattern.split(env_body):
+            inlines, _ = parse_inlines(paragraph, 0, False)
+            if inlines:
+                blocks.append(Para(inlines))
+    except OutsideSubset:
+        stats['fallbacks'] += 1
+        return None
+
+    stats['converted'] += 1
+    return {'meta': {}, 'blocks': blocks}
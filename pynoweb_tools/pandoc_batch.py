@@ -0,0 +1,146 @@
+r"""
+Batch Filtering
+===============
+Apply the LaTeX prefilter to many Pandoc JSON AST files in one process
+pool, instead of starting a `PynowebFilter` process for each document.
+
+The ASTs are produced ahead of time (e.g. `pandoc -t json -o doc.json
+doc.tex`), filtered here, and written next to their inputs as
+`<name>.filtered.json`, which Pandoc can then read with `-f json`.
+
+Each document gets its own `LatexFilter`, so no figure or numbering
+state is shared between them, and a document that fails is reported
+without stopping the rest of the batch.
+"""
+import os
+import json
+import time
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from .pandoc_utils import LatexFilter
+
+batch_logger = logging.getLogger('pandoc_batch')
+batch_logger.addHandler(logging.NullHandler())
+
+filtered_suffix = '.filtered.json'
+
+
+def filtered_path(path):
+    r''' The output path for the Pandoc JSON AST file `path`.
+    '''
+    base, ext = os.path.splitext(path)
+    if ext != '.json':
+        base = path
+    return base + filtered_suffix
+
+
+def read_manifest(manifest_path):
+    r''' Read a manifest of files (e.g. Pandoc JSON AST files).
+
+    A manifest lists one file per line; blank lines and lines starting
+    with `#` are ignored, and relative paths are relative to the
+    manifest's directory.
+    '''
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+    paths = []
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            paths.append(os.path.join(manifest_dir, line))
+
+    return paths
+
+
+def filter_file(in_path, oformat='', out_path=None):
+    r''' Filter one Pandoc JSON AST file.
+
+    Parameters
+    ==========
+    in_path: str
+        The Pandoc JSON AST file.
+    oformat: str (Optional)
+        The target format, as Pandoc would pass it to the filter.
+    out_path: str (Optional)
+        The output file.  Defaults to `filtered_path(in_path)`.
+
+    Returns
+    =======
+    A dict with the `input` and `output` paths, the wall time in `seconds`
+    and, when the document couldn't be filtered, the `error`.
+    '''
+    if out_path is None:
+        out_path = filtered_path(in_path)
+
+    result = {'input': in_path, 'output': out_path, 'seconds': None,
+              'error': None}
+
+    start_time = time.perf_counter()
+    try:
+        with open(in_path, 'r', encoding='utf-8') as f:
+            doc = json.load(f)
+
+        doc = LatexFilter(source=in_path).apply(doc, oformat)
+
+        with open(out_path, 'w', encoding='utf-8') as f:
+            json.dump(doc, f)
+    except Exception:
+        result['output'] = None
+        result['error'] = traceback.format_exc()
+        batch_logger.warning("Couldn't filter {}:\n{}".format(
+            in_path, result['error']))
+
+    result['seconds'] = time.perf_counter() - start_time
+
+    return result
+
+
+def filter_files(paths, oformat='', workers=None):
+    r''' Filter many Pandoc JSON AST files across a process pool.
+
+    Parameters
+    ==========
+    paths: list of str
+        The Pandoc JSON AST files.
+    oformat: str (Optional)
+        The target format, as Pandoc would pass it to the filter.
+    workers: int (Optional)
+        Number of worker processes.  Defaults to the number of CPUs; with
+        `1`, the files are filtered in this process.
+
+    Returns
+    =======
+    The `filter_file` results, in the order of `paths`.
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    workers = max(1, min(workers, len(paths)))
+
+    if workers == 1:
+        return [filter_file(path, oformat) for path in paths]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(filter_file, paths,
+                                 [oformat] * len(paths)))
+
+
+def format_report(results, action='filtering'):
+    r''' A plain-text table of the per-document timings and failures.
+    '''
+    lines = []
+    for result in results:
+        status = 'ok' if result['error'] is None else 'FAILED'
+        lines.append("{:>9.3f}s  {:<6}  {}".format(result['seconds'],
+                                                   status, result['input']))
+
+    failed = sum(1 for result in results if result['error'] is not None)
+    total = sum(result['seconds'] for result in results)
+    lines.append("{} documents, {} failed, {:.3f}s {}".format(
+        len(results), failed, total, action))
+
+    return '\n'.join(lines)
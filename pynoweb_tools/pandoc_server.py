@@ -0,0 +1,337 @@
+r"""
+Long-lived Pandoc Workers
+=========================
+Nested Pandoc conversions through long-lived `pandoc server` processes.
+
+Each `PynowebFilter` run--and each of its nested environment
+conversions--would otherwise start a new Pandoc process.  With a pool of
+warm `pandoc server` workers (see `PandocServerPool` or the
+`PynowebPandocServer` script) and the environment variable
+`PYNOWEB_PANDOC_SERVER` set to their comma-separated URLs, the nested
+conversions in `pandoc_utils` are sent over HTTP instead.  Anything that
+goes wrong on that route falls back to a regular Pandoc subprocess.
+
+See https://pandoc.org/pandoc-server.html for the server's API.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import itertools
+import subprocess
+from optparse import OptionParser
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pypandoc
+
+server_logger = logging.getLogger('pandoc_server')
+server_logger.addHandler(logging.NullHandler())
+
+r""" Environment variable with the comma-separated URLs of the Pandoc
+servers to use for nested conversions.
+"""
+server_urls_env_var = 'PYNOWEB_PANDOC_SERVER'
+
+
+class PandocServerError(RuntimeError):
+    r""" A conversion couldn't be performed by any Pandoc server.
+    """
+    pass
+
+
+def server_options(to, format, extra_args=()):
+    r''' Translate `pypandoc.convert_text`-style arguments into the JSON
+    options understood by `pandoc server`.
+
+    Only the handful of command-line arguments used by this package are
+    supported; anything else raises a `PandocServerError`, so that the
+    caller can fall back to a Pandoc subprocess.
+    '''
+    options = {'from': format, 'to': to}
+
+    for arg in extra_args:
+        if arg in ('-s', '--standalone'):
+            options['standalone'] = True
+        elif arg in ('-R', '--parse-raw'):
+            # Pandoc 2+ spells this as an extension on the reader.
+            options['from'] += '+raw_tex'
+        elif arg.startswith('--wrap='):
+            options['wrap'] = arg.split('=', 1)[1]
+        else:
+            raise PandocServerError(
+                "Unsupported Pandoc server argument: {}".format(arg))
+
+    return options
+
+
+class PandocServerClient(object):
+    r""" Round-robin client for one or more Pandoc servers.
+
+    Servers that fail a request (or a health check) are skipped until
+    `health_interval` seconds have passed, after which they're checked
+    again before use.
+
+    Parameters
+    ==========
+    urls: list of str
+        Base URLs of the Pandoc servers (e.g. `http://127.0.0.1:3030`).
+    timeout: float (Optional)
+        Timeout, in seconds, for each conversion request.
+    health_interval: float (Optional)
+        Seconds between health checks of a server.
+    """
+
+    def __init__(self, urls, timeout=30.0, health_interval=30.0):
+        self.urls = [url.rstrip('/') for url in urls]
+        self.timeout = timeout
+        self.health_interval = health_interval
+
+        self._last_checked = dict()
+        self._healthy = dict()
+        self._cycle = itertools.cycle(self.urls)
+
+    @classmethod
+    def from_env(cls, environ=None, **kwargs):
+        r''' Create a client from `PYNOWEB_PANDOC_SERVER`, or return `None`
+        when it isn't set.
+        '''
+        if environ is None:
+            environ = os.environ
+
+        urls = environ.get(server_urls_env_var, '')
+        urls = [url.strip() for url in urls.split(',') if url.strip()]
+
+        if not urls:
+            return None
+
+        return cls(urls, **kwargs)
+
+    def check_health(self, url):
+        r''' Check that the server at `url` answers its `/version` endpoint.
+        '''
+        try:
+            with urlopen(url + '/version',
+                         timeout=min(self.timeout, 5.0)) as response:
+                healthy = response.status == 200
+        except (OSError, ValueError) as e:
+            server_logger.warning(
+                "Pandoc server {} failed its health check: {}\n".format(
+                    url, e))
+            healthy = False
+
+        self._healthy[url] = healthy
+        self._last_checked[url] = time.monotonic()
+
+        return healthy
+
+    def is_healthy(self, url):
+        r''' Return the server's last known health, re-checking it if
+        that's older than `health_interval`.
+        '''
+        last_checked = self._last_checked.get(url, None)
+        if (last_checked is None or
+                time.monotonic() - last_checked > self.health_interval):
+            return self.check_health(url)
+
+        return self._healthy[url]
+
+    def healthy_urls(self):
+        r''' The URLs of the healthy servers, in round-robin order.
+        '''
+        urls = [next(self._cycle) for _ in self.urls]
+        return [url for url in urls if self.is_healthy(url)]
+
+    def request(self, url, options):
+        data = json.dumps(options).encode('utf-8')
+        request = Request(url + '/', data=data,
+                          headers={'Content-Type': 'application/json',
+                                   'Accept': 'application/json'})
+
+        with urlopen(request, timeout=self.timeout) as response:
+            res = json.loads(response.read().decode('utf-8'))
+
+        if res.get('error', None) is not None:
+            raise PandocServerError(res['error'])
+
+        for message in res.get('messages', []):
+            server_logger.debug("Pandoc server message: {}\n".format(
+                message))
+
+        return res['output']
+
+    def convert_text(self, source, to, format, extra_args=()):
+        r''' Convert `source` like `pypandoc.convert_text` does, but on one
+        of the Pandoc servers.
+
+        Raises
+        ======
+        PandocServerError
+            When no server could perform the conversion.
+        '''
+        options = server_options(to, format, extra_args)
+        options['text'] = source
+
+        for url in self.healthy_urls():
+            try:
+                return self.request(url, options)
+            except HTTPError as e:
+                # The server is fine, but the conversion itself failed.
+                raise PandocServerError(
+                    "Pandoc server {} couldn't convert: {}".format(url, e))
+            except (OSError, ValueError, KeyError) as e:
+                # Includes timeouts and refused connections; skip this
+                # server until its next health check.
+                server_logger.warning(
+                    "Pandoc server {} failed a request: {}\n".format(url, e))
+                self._healthy[url] = False
+
+        raise PandocServerError("No healthy Pandoc server available")
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class PandocServerPool(object):
+    r""" A pool of local `pandoc server` worker processes.
+
+    Parameters
+    ==========
+    workers: int (Optional)
+        Number of server processes.
+    port: int (Optional)
+        First port to use; the workers get consecutive ports.  Free ports
+        are chosen when this is `None`.
+    timeout: float (Optional)
+        Per-request timeout, in seconds, for both the servers and clients.
+    pandoc_path: str (Optional)
+        The Pandoc executable.  Defaults to the one `pypandoc` uses.
+    """
+
+    def __init__(self, workers=1, port=None, timeout=30.0,
+                 pandoc_path=None):
+        self.workers = workers
+        self.port = port
+        self.timeout = timeout
+        self.pandoc_path = pandoc_path or pypandoc.get_pandoc_path()
+
+        self.processes = dict()
+
+    @property
+    def urls(self):
+        return ['http://127.0.0.1:{}'.format(port)
+                for port in sorted(self.processes.keys())]
+
+    def _start_worker(self, port):
+        args = [self.pandoc_path, 'server',
+                '--port={}'.format(port),
+                '--timeout={}'.format(int(self.timeout))]
+        self.processes[port] = subprocess.Popen(
+            args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def start(self, wait=10.0):
+        r''' Start the workers and wait (up to `wait` seconds) until they
+        answer their health checks.
+        '''
+        for i in range(self.workers):
+            if self.port is None:
+                port = find_free_port()
+            else:
+                port = self.port + i
+            self._start_worker(port)
+
+        client = self.client()
+        start_time = time.monotonic()
+        while time.monotonic() - start_time < wait:
+            if all(client.check_health(url) for url in client.urls):
+                return self
+            time.sleep(0.1)
+
+        self.stop()
+        raise PandocServerError("Pandoc server workers failed to start")
+
+    def check_health(self):
+        r''' Restart any workers that have exited or stopped answering.
+
+        Returns
+        =======
+        The ports of the restarted workers.
+        '''
+        client = self.client()
+        restarted = []
+        for port, process in list(self.processes.items()):
+            url = 'http://127.0.0.1:{}'.format(port)
+            if process.poll() is None and client.check_health(url):
+                continue
+
+            server_logger.warning(
+                "Restarting Pandoc server worker on port {}\n".format(port))
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            self._start_worker(port)
+            restarted.append(port)
+
+        return restarted
+
+    def stop(self):
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.processes = dict()
+
+    def client(self, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return PandocServerClient(self.urls, **kwargs)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def serve():
+    r""" A callable script that runs a pool of Pandoc server workers for
+    `PynowebFilter` to use, restarting workers that fail their health
+    checks.
+    """
+    parser = OptionParser(usage="PynowebPandocServer [options]")
+    parser.add_option("-w", "--workers",
+                      dest="workers", type="int", default=1,
+                      help="Number of Pandoc server processes")
+    parser.add_option("-p", "--port",
+                      dest="port", type="int", default=3030,
+                      help="First port for the workers: Default 3030")
+    parser.add_option("-t", "--timeout",
+                      dest="timeout", type="float", default=30.0,
+                      help="Per-request timeout in seconds")
+    parser.add_option("-i", "--health-interval",
+                      dest="health_interval", type="float", default=10.0,
+                      help="Seconds between worker health checks")
+
+    (options, args) = parser.parse_args()
+
+    pool = PandocServerPool(workers=options.workers,
+                            port=options.port,
+                            timeout=options.timeout)
+
+    with pool:
+        print("{}={}".format(server_urls_env_var, ','.join(pool.urls)))
+        sys.stdout.flush()
+        try:
+            while True:
+                time.sleep(options.health_interval)
+                pool.check_health()
+        except KeyboardInterrupt:
+            pass
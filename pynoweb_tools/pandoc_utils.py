@@ -1,20 +1,34 @@
 import re
 import os
+import time
+import threading
 from copy import copy
 
 import logging
 
 import json
-from functools import reduce
+import marshal
+from functools import lru_cache
 
 import pypandoc
 
+from .cache import DiskCache
+from .figures import figure_index
+from .filter_profile import FilterProfile, get_profile_path
+from .figure_convert import (FigureConverter, convert_figures_enabled,
+                             figure_references, figure_targets)
+from .pandoc_server import PandocServerClient, PandocServerError
+from .latex_subset import convert_latex_subset, fast_path_enabled
+from .latex_envs import iter_latex_envs
+from .incremental import (incremental_enabled, config_key, stored_block,
+                          block_key, renumber_blocks)
+
 # See https://hackage.haskell.org/package/pandoc-1.17.2
 # and https://hackage.haskell.org/package/pandoc-types-1.16.1.1 for
 # definitions.
 # Or simply `cabal get pandoc-types -d /tmp` and look at the source.
-from pandocfilters import (applyJSONFilters, Str, Math, Image, Div,
-                           RawInline, Span, Para)
+from pandocfilters import (Str, Math, Image, Div, RawInline, Span, Para,
+                           walk, stringify)
 
 pandoc_logger = logging.getLogger('pandoc_utils')
 pandoc_logger.addHandler(logging.NullHandler())
@@ -26,16 +40,67 @@ gpath_pattern_2 = re.compile(gpath_pattern_2)
 
 graphics_pattern = re.compile(r'\\includegraphics(?:\[.+\])?\{(.*?)\}')
 
-image_pattern = re.compile(r"(.*?)")
+env_conversions = {'Exa': 'example'}
 
-env_pattern = re.compile(
-    r'\\begin\{(\w+)\}(\[.+\])?(.*)\\end\{\1\}', re.S)
+r""" Input format of the nested Pandoc conversions of environment bodies.
+The `raw_tex` extension keeps the LaTeX Pandoc can't convert (Pandoc 1's
+`-R`), just like the reader of whole documents (see
+`watch.WatchBuild.pandoc_from`).
+"""
+nested_pandoc_format = 'latex+raw_tex'
 
-label_pattern = re.compile(r'(\s*?\\label\{(\w*?:?\w+)\})')
+r""" Arguments for the nested Pandoc conversions of environment bodies.
+"""
+nested_pandoc_args = ('-s', '--wrap=none')
 
-env_conversions = {'Exa': 'example'}
+r""" Token used to delimit environment bodies within a single, batched
+Pandoc conversion.  Each separator ends up as a lone `Para` in the output,
+which is where we split the blocks back apart.
+"""
+env_batch_separator = 'PYNOWEBTOOLSENVIRONMENTSEPARATOR'
+
+r""" Client for the long-lived Pandoc servers used by the nested
+conversions, when `PYNOWEB_PANDOC_SERVER` is set (see `pandoc_server`).
+It's created on first use; `False` means none is configured.
+"""
+pandoc_server_client = None
+
+r""" On-disk cache of the nested conversions' Pandoc JSON output (see
+`cache.DiskCache`).  It's created on first use; `False` means caching is
+disabled.
+
+We cache Pandoc's output and not the filtered blocks, since the latter
+depend on document state (e.g. environment and figure numbering).
+"""
+env_cache = None
 
-environment_counters = {}
+r""" Converter for the figures of documents with figure conversion
+enabled (see `figure_convert`).  It's created on first use.
+"""
+figure_converter = None
+
+r""" The Pandoc version used in the cache keys.
+"""
+nested_pandoc_version = None
+
+r""" On-disk store of filtered top-level blocks for incremental filtering
+(see `incremental`).  It's created on first use; `False` means caching is
+disabled.
+"""
+block_store = None
+
+r""" AST node types whose contents don't contain other nodes (see
+`walk_ast`).
+"""
+leaf_node_types = frozenset(['Str', 'Space', 'SoftBreak', 'LineBreak',
+                             'Code', 'CodeBlock', 'Math', 'RawInline',
+                             'RawBlock', 'HorizontalRule', 'Null',
+                             'MetaString', 'MetaBool'])
+
+r""" The AST node types `LatexFilter` changes; it leaves the others as they
+are.
+"""
+filter_node_types = ('RawInline', 'RawBlock', 'Image', 'Math')
 
 preserved_tex = ['\\eqref', '\\ref', '\\Cref', '\\cref', '\\includegraphics']
 
@@ -89,53 +154,226 @@ AST objects.
 """
 custom_inline_math = {'cleveref': cleveref_ast_sub}
 
-r""" Figure directories to search.
+class InlineTexMatcher(object):
+    r""" A compiled, single-pass matcher for the LaTeX in RawInline strings.
 
-These are a combination of the meta data values and any
-processed LaTeX `\graphicspath` directives.
-"""
-figure_dirs = set()
+    One alternation regex finds the `\includegraphics` commands, the
+    string-valued custom inline math and the preserved commands, so that a
+    RawInline string is classified and rewritten in one linear scan.
 
-r""" Dictionary of processed AST Image objects.
+    Parameters
+    ==========
+    preserved_tex: tuple of str
+        The preserved LaTeX commands.
+    replacements: tuple of (str, str)
+        Pairs of strings to find and their replacements.
+    """
 
-The keys are the replaced/updated image filenames, the values
-are lists with two elements: a string LaTeX label for the image,
-and the figure number.
-"""
-processed_figures = dict()
+    def __init__(self, preserved_tex, replacements=()):
+        self.preserved_tex = preserved_tex
+        self.replacements = dict(replacements)
+        self.graphics_preserved = '\\includegraphics' in preserved_tex
+
+        def alternation(strings):
+            strings = sorted(set(strings), key=len, reverse=True)
+            return '|'.join(map(re.escape, strings)) or r'(?!)'
+
+        self.pattern = re.compile(
+            r'(?P<graphics>\\includegraphics(?:\[[^\]]*\])?'
+            r'\{(?P<graphics_file>.*?)\})'
+            r'|(?P<replacement>' + alternation(self.replacements) + ')'
+            r'|(?P<preserved>' + alternation(preserved_tex) + ')')
+
+    def rewrite(self, source, rename_fig=None):
+        r''' Check `source` for preserved commands and rewrite it.
+
+        Parameters
+        ==========
+        source: str
+            The RawInline string.
+        rename_fig: callable (Optional)
+            Function that maps an `\includegraphics` filename to its new
+            filename.
+
+        Returns
+        =======
+        A tuple with a boolean indicating whether `source` contains any
+        preserved command and the rewritten string.
+        '''
+        is_preserved = [False]
+
+        def sub(ma):
+            if ma.group('graphics') is not None:
+                if self.graphics_preserved:
+                    is_preserved[0] = True
+                fig_name = ma.group('graphics_file')
+                if rename_fig is None or not fig_name:
+                    return ma.group(0)
+                start, end = ma.span('graphics_file')
+                return (ma.string[ma.start():start] + rename_fig(fig_name) +
+                        ma.string[end:ma.end()])
+            elif ma.group('replacement') is not None:
+                return self.replacements[ma.group(0)]
+            else:
+                is_preserved[0] = True
+                return ma.group(0)
+
+        new_source = self.pattern.sub(sub, source)
+
+        return is_preserved[0], new_source
+
+
+@lru_cache(maxsize=32)
+def get_inline_tex_matcher(preserved_tex, replacements=()):
+    r''' Get an `InlineTexMatcher`; it's only recompiled when the set of
+    commands changes.
+    '''
+    return InlineTexMatcher(preserved_tex, replacements)
 
-r""" Figure filename extensions.
-"""
-fig_fname_ext = None
+
+def meta_text(meta_value):
+    r''' The text of a Pandoc meta value (e.g. a `MetaString`, or the
+    `MetaInlines` Pandoc reads from YAML), including its raw LaTeX, which
+    `pandocfilters.stringify` drops.
+    '''
+    if meta_value.get('t') == 'MetaString':
+        return meta_value['c']
+
+    def raw_to_str(key, value, oformat, meta):
+        if key == 'RawInline':
+            return Str(value[1])
+
+    return stringify(walk(meta_value['c'], raw_to_str, '', {}))
+
+
+def meta_text_list(meta_value):
+    r''' The texts of a Pandoc `MetaList`, or a list with the text of a
+    single value (e.g. from `-M preserved_tex=\autoref`).
+    '''
+    if meta_value is None:
+        return []
+    elif meta_value.get('t') == 'MetaList':
+        return [meta_text(v) for v in meta_value['c']]
+    else:
+        return [meta_text(meta_value)]
+
+
+def meta_text_map(meta_value):
+    r''' The texts of a Pandoc `MetaMap`'s values, by key.
+    '''
+    if meta_value is None:
+        return {}
+
+    return {k: meta_text(v) for k, v in meta_value['c'].items()}
+
+
+class FilterConfig(object):
+    r""" Filter configuration for a document, compiled from the
+    module-level defaults and the document's Pandoc meta data.
+
+    `latex_prefilter` is called for every AST node, so this is built once
+    per document (see `LatexFilter`) instead of on every call.
+
+    Parameters
+    ==========
+    meta: dict
+        The document's Pandoc meta data.
+    source: str (Optional)
+        The document's file, when it's known (see
+        `filter_profile.get_profile_path`).
+    """
+
+    def __init__(self, meta, source=None):
+        self.meta = meta
+
+        self.custom_inline_math = custom_inline_math.copy()
+        self.custom_inline_math.update(meta_text_map(
+            meta.get('custom_inline_math', None)))
+
+        self.env_conversions = env_conversions.copy()
+        self.env_conversions.update(meta_text_map(
+            meta.get('env_conversions', None)))
+
+        self.preserved_tex = preserved_tex + meta_text_list(
+            meta.get('preserved_tex', None))
+
+        self.inline_math_callables = [
+            to_ for to_ in self.custom_inline_math.values() if callable(to_)]
+
+        self.inline_tex_matcher = get_inline_tex_matcher(
+            tuple(self.preserved_tex),
+            tuple((from_, to_)
+                  for from_, to_ in self.custom_inline_math.items()
+                  if not callable(to_)))
+
+        figure_dir = meta.get('figure_dir', None)
+        self.figure_dir = (meta_text(figure_dir)
+                           if figure_dir is not None else None)
+
+        # Either a single extension or a list of them to try.
+        fig_fname_ext = meta.get('figure_ext', None)
+        if fig_fname_ext is None:
+            self.fig_fname_ext = None
+        elif fig_fname_ext.get('t') == 'MetaList':
+            self.fig_fname_ext = meta_text_list(fig_fname_ext)
+        else:
+            self.fig_fname_ext = meta_text(fig_fname_ext)
+
+        self.profile_path = get_profile_path(meta, source=source)
+
+        self.convert_figures = convert_figures_enabled(meta)
+
+        self.latex_fast_path = fast_path_enabled(meta)
+
+        self.incremental = incremental_enabled(meta)
 
 
 def rename_find_fig(fig_name,
                     fig_dirs='',
-                    fig_ext=None):
+                    fig_ext=None,
+                    index=None):
     r''' Renames a figure (file, really), tries a list of extensions
     (or a single one) and looks for the one that exists (or uses
     the single one, regardless).
+
+    The figure directories are looked up in a `figures.FigureIndex`
+    (`figures.figure_index`, by default), so each directory is only listed
+    when it changes.  When `fig_ext` is a list, the first directory with a
+    file for any of its extensions wins, and within that directory, the
+    first extension.
     '''
+    if index is None:
+        index = figure_index
+
+    if not fig_ext:
+        fig_exts = ['']
+    elif isinstance(fig_ext, str):
+        fig_exts = [fig_ext]
+    else:
+        fig_exts = list(fig_ext)
 
     fig_fname = os.path.split(fig_name)[-1]
     fig_fname_base = os.path.splitext(fig_fname)[0]
     new_fig_fname = fig_fname_base
-    if fig_ext is not None:
+    if fig_exts[0]:
         new_fig_fname = os.path.extsep.join([new_fig_fname,
-                                             fig_ext])
+                                             fig_exts[0]])
 
     # XXX: We assume that `fig_dirs` is a collection.
     # See if we can find the file in one of the dirs.
     # Otherwise, if there's only one item in the collection,
     # use that (i.e. no check).
+    if len(fig_dirs) == 1 and len(fig_exts) == 1:
+        fig_dir, = fig_dirs
+        return os.path.join(fig_dir, new_fig_fname)
+
+    real_fig_file = index.find_first(fig_fname_base, fig_dirs, fig_exts)
+    if real_fig_file is not None:
+        return real_fig_file
+
     if len(fig_dirs) == 1:
         fig_dir, = fig_dirs
         new_fig_fname = os.path.join(fig_dir, new_fig_fname)
-    else:
-        fig_files = map(lambda x: os.path.join(x, new_fig_fname),
-                        fig_dirs)
-        real_fig_files = filter(os.path.exists, fig_files)
-        new_fig_fname = next(iter(real_fig_files), new_fig_fname)
 
     return new_fig_fname
 
@@ -181,110 +419,743 @@ def label_to_mathjax(env_label, label_postfix='_span', env_tag=None):
     return label_div
 
 
-def process_image(key, value, oformat, meta):
-    r''' Rewrite filename in Image AST object--adding paths from the
-    meta information and/or LaTeX `\graphicspaths` directive.
+def get_pandoc_server_client():
+    global pandoc_server_client
+
+    if pandoc_server_client is None:
+        pandoc_server_client = PandocServerClient.from_env() or False
+
+    return pandoc_server_client or None
+
 
-    This can be used to reassign paths to image file names when the
-    meta information has only one entry.  It will also wrap
-    LaTeX-labeled Image objects in a Span--for later
-    referencing/linking, say.
+def convert_latex_env(env_body):
+    r''' Convert a single LaTeX environment body to a Pandoc JSON string.
+
+    The conversion goes through the configured Pandoc servers, when there
+    are any, and falls back to a Pandoc subprocess.
     '''
-    if key != "Image":
-        return None
+    server_client = get_pandoc_server_client()
+    if server_client is not None:
+        try:
+            return server_client.convert_text(env_body, 'json',
+                                              format=nested_pandoc_format,
+                                              extra_args=nested_pandoc_args)
+        except PandocServerError as e:
+            pandoc_logger.warning(
+                "Falling back to a Pandoc subprocess: {}\n".format(e))
+
+    return pypandoc.convert_text(env_body, 'json',
+                                 format=nested_pandoc_format,
+                                 extra_args=nested_pandoc_args)
 
-    global figure_dirs, fig_fname_ext, processed_figures
 
-    # TODO: Find and use labels.
-    # TODO: Perhaps check that it's a valid file?
-    new_value = copy(value[2])
+def convert_latex_envs(env_bodies):
+    r''' Convert a collection of LaTeX environment bodies with one
+    Pandoc call.
 
-    new_fig_fname = rename_find_fig(new_value[0],
-                                    figure_dirs,
-                                    fig_fname_ext)
+    The bodies are joined by separator paragraphs (see
+    `env_batch_separator`), converted together and the resulting blocks are
+    split back apart.
 
-    pandoc_logger.debug("figure_dirs: {}\tfig_fname_ext: {}\n".format(
-        figure_dirs, fig_fname_ext))
-    pandoc_logger.debug("new_value: {}\tnew_fig_fname: {}\n".format(
-        new_value, new_fig_fname))
+    Returns
+    =======
+    A list of Pandoc JSON AST documents--one per body and in the same
+    order--or `None` when the output couldn't be split back into as many
+    bodies (e.g. a body with an unbalanced group swallowed a separator).
+    '''
+    env_bodies = list(env_bodies)
+    separator = u'\n\n{}\n\n'.format(env_batch_separator)
+
+    doc_proc = json.loads(convert_latex_env(separator.join(env_bodies)))
+
+    separator_block = Para([Str(env_batch_separator)])
+    env_blocks = [[]]
+    for block in doc_proc['blocks']:
+        if block == separator_block:
+            env_blocks.append([])
+        else:
+            env_blocks[-1].append(block)
 
-    # XXX: Avoid an endless loop of Image replacements.
-    if new_fig_fname in processed_figures.keys():
+    if len(env_blocks) != len(env_bodies):
+        pandoc_logger.warning(
+            ("Batched conversion produced {} environment bodies instead "
+             "of {}; falling back to separate conversions.\n").format(
+                 len(env_blocks), len(env_bodies)))
         return None
 
-    processed_figures[new_fig_fname] = [None, None]
+    return [dict(doc_proc, blocks=blocks) for blocks in env_blocks]
 
-    new_value[0] = new_fig_fname
 
-    # Wrap the image in a div with an `id`, so that we can
-    # reference it in HTML.
-    new_image = Image(value[0], value[1], new_value)
-    wrapped_image = new_image
-    try:
-        fig_label_obj = value[1][-1]['c'][0][-1][0]
+def walk_ast(x, handlers, oformat, meta, default=None):
+    r''' Walk a Pandoc JSON AST and apply filter actions to its nodes, like
+    `pandocfilters.walk`, but only to the node types in `handlers`.
 
-        pandoc_logger.debug("fig_label_obj: {}\n".format(fig_label_obj))
+    The walk is depth-first and in document order, like
+    `pandocfilters.walk`, but it isn't recursive, so deeply nested
+    documents can't reach Python's recursion limit.  The contents of
+    `leaf_node_types` nodes aren't walked, and the nodes an action returns
+    aren't walked again.  Lists are changed in place--and only those in
+    which an action replaced a node--instead of being copied.
 
-        if fig_label_obj[0] == 'data-label':
-            fig_label = fig_label_obj[1]
+    Parameters
+    ==========
+    x: list or dict
+        The AST (e.g. a document or a list of blocks).  It's changed in
+        place.
+    handlers: dict
+        Filter actions (see `pandocfilters.walk`) by node type.
+    oformat: str
+        The target format passed to the actions.
+    meta: dict
+        The document's meta data passed to the actions.
+    default: callable (Optional)
+        The action for the node types that aren't in `handlers`.
 
-            processed_figures[new_fig_fname][0] = fig_label
-            env_num = len(processed_figures)
-            processed_figures[new_fig_fname][1] = env_num
+    Returns
+    =======
+    The filtered AST, i.e. `x`.
+    '''
+    if isinstance(x, list):
+        stack = [[x, 0, None, True]]
+    elif isinstance(x, dict):
+        stack = [[list(x.values()), 0, None, False]]
+    else:
+        return x
+
+    # Each frame is a list of items to walk (a list from the AST, or the
+    # values of a dict), the index of the next item, the list's new items
+    # when an action has replaced one (otherwise `None`) and whether the
+    # items are from a list, since actions only apply to list items.
+    while stack:
+        frame = stack[-1]
+        items, i, new_items, is_list = frame
+
+        if i == len(items):
+            stack.pop()
+            if new_items is not None:
+                items[:] = new_items
+            continue
+
+        frame[1] = i + 1
+        item = items[i]
+
+        if isinstance(item, dict):
+            key = item.get('t', None)
+
+            if is_list and key is not None:
+                handler = handlers.get(key, default)
+                if handler is not None:
+                    res = handler(key, item.get('c', None), oformat, meta)
+                    if res is not None:
+                        if new_items is None:
+                            new_items = frame[2] = items[:i]
+                        if isinstance(res, list):
+                            new_items.extend(res)
+                        else:
+                            new_items.append(res)
+                        continue
+
+            if new_items is not None:
+                new_items.append(item)
+
+            if key is None:
+                stack.append([list(item.values()), 0, None, False])
+            elif key not in leaf_node_types:
+                contents = item.get('c', None)
+                if isinstance(contents, list):
+                    stack.append([contents, 0, None, True])
+                elif isinstance(contents, dict):
+                    stack.append([list(contents.values()), 0, None, False])
+        else:
+            if new_items is not None:
+                new_items.append(item)
 
-            hack_span = label_to_mathjax(fig_label, env_tag=env_num)
+            if isinstance(item, list):
+                stack.append([item, 0, None, True])
+
+    return x
 
-            wrapped_image = Span([copy(fig_label), [], []],
-                                 [hack_span, new_image])
-    except:
-        pass
 
-    pandoc_logger.debug("wrapped_image: {}\n".format(wrapped_image))
+def copy_ast(x):
+    r''' Copy a Pandoc JSON AST (or any tree of lists, dicts and strings).
+    '''
+    return marshal.loads(marshal.dumps(x))
 
-    return [wrapped_image]
 
+def collect_latex_env_bodies(blocks):
+    r''' Collect the bodies of the environments in all LaTeX RawBlocks
+    within `blocks`.
 
-def process_latex_envs(key, value, oformat, meta):
-    r''' Check LaTeX RawBlock AST objects for environments (i.e.
-    `\begin{env_name}` and `\end{env_name}`) and converts
-    them to Div's with class attribute set to their LaTeX names
-    (i.e. `env_name`).
-
-    The new Div has a `markdown` attribute set so that its contents
-    can be processed again by Pandoc.  This is needed for custom environments
-    (e.g. and example environment with more text and math to be processed),
-    which also means that *recursive Pandoc calls are needed* (since Pandoc
-    already stopped short producing the RawBlocks we start with).
-    For the recursive Pandoc calls to work, we need the Pandoc extension
-    `+markdown_in_html_blocks` enabled, as well.
+    Returns
+    =======
+    A dict mapping the bodies, in document order, to their number of
+    occurrences.
     '''
+    env_bodies = dict()
+
+    def collect_env(key, value, oformat, meta):
+        if value[0] == 'latex':
+            for env in iter_latex_envs(value[1]):
+                env_bodies[env.body] = env_bodies.get(env.body, 0) + 1
+
+    walk_ast(blocks, {'RawBlock': collect_env}, '', {})
+
+    return env_bodies
+
+
+def get_env_cache():
+    global env_cache
+
+    if env_cache is None:
+        env_cache = DiskCache.from_env('environments') or False
+
+    return env_cache or None
+
+
+def get_figure_converter():
+    global figure_converter
+
+    if figure_converter is None:
+        figure_converter = FigureConverter()
+
+    return figure_converter
 
-    if key != 'RawBlock' or value[0] != 'latex':
-        return None
 
-    global environment_counters
+def get_nested_pandoc_version():
+    global nested_pandoc_version
 
-    env_info = env_pattern.search(value[1])
-    if env_info is not None:
-        env_groups = env_info.groups()
-        env_name = env_groups[0]
-        env_name = env_conversions.get(env_name, env_name)
-        env_title = env_groups[1]
+    if nested_pandoc_version is None:
+        nested_pandoc_version = (os.environ.get('PANDOC_VERSION', None) or
+                                 pypandoc.get_pandoc_version())
 
-        if env_title is None:
-            env_title = ""
+    return nested_pandoc_version
 
-        env_body = env_groups[2]
 
-        env_num = environment_counters.get(env_name, 0)
+def get_block_store():
+    global block_store
+
+    if block_store is None:
+        block_store = DiskCache.from_env('blocks') or False
+
+    return block_store or None
+
+
+def env_cache_key(env_body):
+    r''' The cache key for an environment body.
+
+    Besides the body itself, the key covers the Pandoc version--taken from
+    `PANDOC_VERSION`, which Pandoc sets for its filters, when possible--and
+    the format and arguments of the nested conversions.
+    '''
+    return DiskCache.key(env_body, get_nested_pandoc_version(),
+                         nested_pandoc_format, list(nested_pandoc_args))
+
+
+def load_cached_env_bodies(env_bodies):
+    r''' Look up environment bodies in the on-disk cache.
+
+    Returns
+    =======
+    A dict with the Pandoc JSON AST documents of the bodies that were
+    found.
+    '''
+    cache = get_env_cache()
+    if cache is None:
+        return {}
+
+    res = {}
+    for env_body in env_bodies:
+        env_body_proc = cache.get(env_cache_key(env_body))
+        if isinstance(env_body_proc, str):
+            # Entries from before the documents were stored as JSON.
+            env_body_proc = json.loads(env_body_proc)
+        if env_body_proc is not None:
+            res[env_body] = env_body_proc
+
+    return res
+
+
+def store_cached_env_bodies(env_bodies_proc):
+    r''' Store a dict of environment bodies and their Pandoc JSON AST
+    documents in the on-disk cache.
+    '''
+    cache = get_env_cache()
+    if cache is None:
+        return
+
+    for env_body, env_body_proc in env_bodies_proc.items():
+        cache.set(env_cache_key(env_body), env_body_proc)
+
+
+class LatexFilter(object):
+    r""" The LaTeX prefilter along with the state it keeps for a document.
+
+    An instance owns all the state that processing a document accumulates,
+    so separate instances can filter separate documents in the same
+    process (e.g. in threads).  Instances are callable as
+    `pandocfilters` actions.
+
+    Parameters
+    ==========
+    meta: dict (Optional)
+        The document's Pandoc meta data.  When not given, the meta data of
+        the first filter call is used.
+    source: str (Optional)
+        The document's file, when it's known, e.g. for the default profile
+        report path (see `filter_profile`).
+
+    Attributes
+    ==========
+    config: FilterConfig
+        The document's filter configuration.
+    figure_dirs: set
+        Figure directories to search.  These are a combination of the meta
+        data values and any processed LaTeX `\graphicspath` directives.
+    processed_figures: dict
+        Processed AST Image objects.  The keys are the replaced/updated
+        image filenames, the values are lists with two elements: a string
+        LaTeX label for the image, and the figure number.
+    environment_counters: dict
+        Environment numbers by environment name.
+    converted_env_bodies: dict
+        Pandoc output for environment bodies that were converted ahead of
+        the filter walk (see `batch_convert_latex_envs`).  The keys are the
+        environment bodies (without labels) and the values are the Pandoc
+        JSON AST documents `process_latex_envs` would otherwise have
+        produced with its own Pandoc call; they're parsed once, and
+        filtered in place by `process_latex_envs`.
+    env_body_uses: dict
+        The number of times `process_latex_envs` still needs each of the
+        `converted_env_bodies`, so that only the last use filters the
+        document in place, and earlier ones filter a copy.
+    figure_env_bodies: set
+        The environment bodies whose figures were converted (see
+        `convert_figures`).
+    profile: filter_profile.FilterProfile
+        The document's profile data, when profiling is enabled (see
+        `filter_profile`), otherwise `None`.
+    handlers: dict
+        The `walk_ast` actions for `filter_node_types`.
+    block_record: dict
+        The figure lookups and figures of the top-level block being
+        filtered incrementally (see `filter_block`), otherwise `None`.
+    """
+
+    def __init__(self, meta=None, source=None):
+        self.source = source
+        self.config = None
+        self.figure_dirs = set()
+        self.processed_figures = dict()
+        self.environment_counters = dict()
+        self.converted_env_bodies = dict()
+        self.env_body_uses = dict()
+        self.figure_env_bodies = set()
+        self.profile = None
+        self.handlers = dict.fromkeys(filter_node_types, self)
+        self.block_record = None
+
+        if meta is not None:
+            self.get_config(meta)
+
+    @property
+    def fig_fname_ext(self):
+        r""" Figure filename extensions.
+        """
+        return self.config.fig_fname_ext if self.config else None
+
+    def get_config(self, meta):
+        r''' Get the document's `FilterConfig`, compiling it from `meta` on
+        first use.
+
+        Nested (i.e. environment body) filter walks have their own Pandoc meta
+        data, but they use the configuration of the document that contains
+        them.
+        '''
+        if self.config is None:
+            self.config = FilterConfig(meta, source=self.source)
+
+            if self.config.figure_dir is not None:
+                self.figure_dirs.add(self.config.figure_dir)
+
+            if self.config.profile_path is not None:
+                self.profile = FilterProfile(self.config.profile_path)
+                self._figure_scans = figure_index.stats['scans']
+
+        return self.config
+
+    def write_profile(self):
+        r''' Write the profile report, when profiling is enabled.
+        '''
+        if self.profile is not None:
+            self.profile.write(figure_index.stats['scans'] -
+                               self._figure_scans)
+
+    def find_fig(self, fig_name):
+        r''' Find a figure file in the document's figure directories (see
+        `rename_find_fig`).
+        '''
+        if self.profile is None:
+            new_fig_fname = rename_find_fig(fig_name, self.figure_dirs,
+                                            self.fig_fname_ext)
+        else:
+            start_time = time.perf_counter()
+            try:
+                new_fig_fname = rename_find_fig(fig_name, self.figure_dirs,
+                                                self.fig_fname_ext)
+            finally:
+                self.profile.add_figure_lookup(time.perf_counter() -
+                                               start_time)
+
+        if self.block_record is not None:
+            self.block_record['figure_lookups'][fig_name] = new_fig_fname
+
+        return new_fig_fname
+
+    def convert_latex_subset(self, env_bodies):
+        r''' Convert the environment bodies that are within the LaTeX subset
+        without Pandoc (see `latex_subset`), when the fast path is enabled.
+
+        Returns
+        =======
+        A dict with the Pandoc JSON AST documents of the converted bodies.
+        '''
+        if not self.config.latex_fast_path:
+            return {}
+
+        res = {}
+        for env_body in env_bodies:
+            env_body_proc = convert_latex_subset(env_body)
+            if env_body_proc is not None:
+                res[env_body] = env_body_proc
+
+        if self.profile is not None:
+            self.profile.cache['fast_path'] += len(res)
+            self.profile.cache['fast_path_fallbacks'] += (len(env_bodies) -
+                                                          len(res))
+
+        return res
+
+    def convert_latex_envs(self, env_bodies):
+        r''' See `convert_latex_envs`; the conversion is profiled.
+        '''
+        if self.profile is None:
+            return convert_latex_envs(env_bodies)
+
+        start_time = time.perf_counter()
+        try:
+            return convert_latex_envs(env_bodies)
+        finally:
+            self.profile.add_conversion(len(env_bodies),
+                                        time.perf_counter() - start_time,
+                                        True)
+
+    def convert_latex_env(self, env_body):
+        r''' See `convert_latex_env`; the conversion is profiled.
+        '''
+        if self.profile is None:
+            return convert_latex_env(env_body)
+
+        start_time = time.perf_counter()
+        try:
+            return convert_latex_env(env_body)
+        finally:
+            self.profile.add_conversion(1, time.perf_counter() - start_time,
+                                        False)
+
+    def process_image(self, key, value, oformat, meta):
+        r''' Rewrite filename in Image AST object--adding paths from the
+        meta information and/or LaTeX `\graphicspaths` directive.
+
+        This can be used to reassign paths to image file names when the
+        meta information has only one entry.  It will also wrap
+        LaTeX-labeled Image objects in a Span--for later
+        referencing/linking, say.
+        '''
+        if key != "Image":
+            return None
+
+        self.get_config(meta)
+
+        # TODO: Find and use labels.
+        # TODO: Perhaps check that it's a valid file?
+        new_value = copy(value[2])
+
+        new_fig_fname = self.find_fig(new_value[0])
+
+        debug = pandoc_logger.isEnabledFor(logging.DEBUG)
+
+        if debug:
+            pandoc_logger.debug(
+                "figure_dirs: {}\tfig_fname_ext: {}\n".format(
+                    self.figure_dirs, self.fig_fname_ext))
+            pandoc_logger.debug(
+                "new_value: {}\tnew_fig_fname: {}\n".format(
+                    new_value, new_fig_fname))
+
+        # XXX: Avoid an endless loop of Image replacements.
+        if new_fig_fname in self.processed_figures.keys():
+            if self.block_record is not None:
+                self.block_record['duplicate_figures'].append(new_fig_fname)
+            return None
+
+        self.processed_figures[new_fig_fname] = [None, None]
+
+        if self.block_record is not None:
+            self.block_record['figures'].append(new_fig_fname)
+
+        new_value[0] = new_fig_fname
+
+        # The walk doesn't descend into the nodes returned here, so filter
+        # the caption (e.g. its `\cref`s) now.
+        caption = self.walk(value[1], oformat, meta)
+
+        # Wrap the image in a div with an `id`, so that we can
+        # reference it in HTML.
+        new_image = Image(value[0], caption, new_value)
+        wrapped_image = new_image
+        try:
+            fig_label_obj = value[1][-1]['c'][0][-1][0]
+
+            if debug:
+                pandoc_logger.debug("fig_label_obj: {}\n".format(
+                    fig_label_obj))
+
+            if fig_label_obj[0] == 'data-label':
+                fig_label = fig_label_obj[1]
+
+                self.processed_figures[new_fig_fname][0] = fig_label
+                env_num = len(self.processed_figures)
+                self.processed_figures[new_fig_fname][1] = env_num
+
+                hack_span = label_to_mathjax(fig_label, env_tag=env_num)
+
+                wrapped_image = Span([copy(fig_label), [], []],
+                                     [hack_span, new_image])
+        except:
+            pass
+
+        if debug:
+            pandoc_logger.debug("wrapped_image: {}\n".format(wrapped_image))
+
+        return [wrapped_image]
+
+    def lookup_latex_env(self, env_body):
+        r''' Get the Pandoc JSON AST document for an environment body from
+        the batched conversions, the on-disk cache or--as a last resort--its
+        own Pandoc conversion.
+
+        The caller owns the document, i.e. it can filter it in place:  it's
+        a copy, unless this is the body's last use (see `env_body_uses`), in
+        which case it's removed from `converted_env_bodies`.
+        '''
+        profile = self.profile
+
+        env_body_proc = self.converted_env_bodies.get(env_body, None)
+
+        if profile is not None and env_body_proc is not None:
+            profile.cache['batch_hits'] += 1
+
+        if env_body_proc is None:
+            env_body_proc = self.convert_latex_subset([env_body]).get(
+                env_body, None)
+
+        if env_body_proc is None:
+            env_body_proc = load_cached_env_bodies([env_body]).get(env_body,
+                                                                   None)
+            if profile is not None and get_env_cache() is not None:
+                profile.cache['disk_hits' if env_body_proc is not None
+                              else 'disk_misses'] += 1
+
+        if env_body_proc is None:
+            env_body_proc = json.loads(self.convert_latex_env(env_body))
+            store_cached_env_bodies({env_body: env_body_proc})
+            if profile is not None:
+                profile.cache['single_conversions'] += 1
+
+        uses = self.env_body_uses.get(env_body, 0)
+        if uses > 1:
+            # Keep it for the remaining uses, whichever way it was
+            # converted (e.g. when a failed batch left it out).
+            self.env_body_uses[env_body] = uses - 1
+            self.converted_env_bodies[env_body] = env_body_proc
+            return copy_ast(env_body_proc)
+        elif uses == 1:
+            del self.env_body_uses[env_body]
+            self.converted_env_bodies.pop(env_body, None)
+            return env_body_proc
+        else:
+            # Not counted by `batch_convert_latex_envs`, so it may be
+            # needed again.
+            self.converted_env_bodies[env_body] = env_body_proc
+            return copy_ast(env_body_proc)
+
+    def batch_convert_latex_envs(self, blocks):
+        r''' Convert every (nested) LaTeX environment body in `blocks`
+        ahead of the filter walk.
+
+        Instead of one Pandoc process per environment, this makes one
+        Pandoc call per level of environment nesting, and only for the
+        bodies that aren't within the LaTeX subset (see
+        `convert_latex_subset`) or in the on-disk cache.  The results are
+        stored in `converted_env_bodies`, where `process_latex_envs` looks
+        for them before it resorts to its own Pandoc call, and the number of
+        times each is used (at any level of nesting) is added to
+        `env_body_uses`.
+        '''
+        converted_env_bodies = self.converted_env_bodies
+        env_body_uses = self.env_body_uses
+        profile = self.profile
+
+        env_bodies = collect_latex_env_bodies(blocks)
+
+        while env_bodies:
+            for b, uses in env_bodies.items():
+                env_body_uses[b] = env_body_uses.get(b, 0) + uses
+
+            new_bodies = [b for b in env_bodies
+                          if b not in converted_env_bodies]
+            converted_env_bodies.update(self.convert_latex_subset(new_bodies))
+
+            new_bodies = [b for b in new_bodies
+                          if b not in converted_env_bodies]
+            cached_bodies = load_cached_env_bodies(new_bodies)
+            converted_env_bodies.update(cached_bodies)
+
+            if profile is not None and get_env_cache() is not None:
+                profile.cache['disk_hits'] += len(cached_bodies)
+                profile.cache['disk_misses'] += (len(new_bodies) -
+                                                 len(cached_bodies))
+
+            new_bodies = [b for b in new_bodies
+                          if b not in converted_env_bodies]
+            if new_bodies:
+                env_bodies_proc = self.convert_latex_envs(new_bodies)
+                if env_bodies_proc is not None:
+                    env_bodies_proc = dict(zip(new_bodies, env_bodies_proc))
+                    converted_env_bodies.update(env_bodies_proc)
+                    store_cached_env_bodies(env_bodies_proc)
+                    if profile is not None:
+                        profile.cache['batched'] += len(new_bodies)
+
+            # A nested body is used as many times as the bodies that
+            # contain it.
+            nested_bodies = dict()
+            for b, uses in env_bodies.items():
+                if b not in converted_env_bodies:
+                    continue
+                for nested_b, nested_uses in collect_latex_env_bodies(
+                        converted_env_bodies[b]['blocks']).items():
+                    nested_bodies[nested_b] = (nested_bodies.get(nested_b, 0)
+                                               + uses * nested_uses)
+            env_bodies = nested_bodies
+
+        cache = get_env_cache()
+        if cache is not None and pandoc_logger.isEnabledFor(logging.DEBUG):
+            pandoc_logger.debug("Environment cache stats: {}\n".format(
+                cache.stats))
+
+    def convert_figures(self, blocks, fig_names=(), fig_dirs=()):
+        r''' Convert the figures referenced in `blocks`, and in the
+        environment bodies converted so far, to the `figure_ext` extension
+        when they're missing or out of date.
+
+        This only happens when figure conversion is enabled (see
+        `figure_convert`) and `figure_ext` is a single extension.
+
+        Parameters
+        ==========
+        blocks: list
+            The blocks to search for figure references.
+        fig_names: list (Optional)
+            More figure names to convert, e.g. those of the blocks reused by
+            incremental filtering (see `apply_incremental`).
+        fig_dirs: list (Optional)
+            More `\graphicspath` directories in which to look for them.
+
+        Returns
+        =======
+        The `FigureConverter.convert` results.
+        '''
+        fig_ext = self.fig_fname_ext
+        if not self.config.convert_figures or not isinstance(fig_ext, str):
+            return []
+
+        nested_blocks = []
+        for env_body, env_body_proc in self.converted_env_bodies.items():
+            if env_body not in self.figure_env_bodies:
+                self.figure_env_bodies.add(env_body)
+                nested_blocks.append(env_body_proc['blocks'])
+
+        block_fig_names, block_fig_dirs = figure_references([blocks,
+                                                             nested_blocks])
+        known_fig_names = set(block_fig_names)
+        block_fig_names += [n for n in fig_names
+                            if n not in known_fig_names]
+
+        pairs = figure_targets(block_fig_names,
+                               self.figure_dirs | block_fig_dirs |
+                               set(fig_dirs),
+                               fig_ext)
+
+        results = get_figure_converter().convert_all(pairs)
+
+        if any(r['status'] in ('cached', 'converted') for r in results):
+            # The figure directories have new files.
+            figure_index.clear()
+
+        return results
+
+    def process_latex_envs(self, key, value, oformat, meta):
+        r''' Check LaTeX RawBlock AST objects for environments (i.e.
+        `\begin{env_name}` and `\end{env_name}`) and converts
+        them to Div's with class attribute set to their LaTeX names
+        (i.e. `env_name`).
+
+        The new Div has a `markdown` attribute set so that its contents
+        can be processed again by Pandoc.  This is needed for custom
+        environments (e.g. and example environment with more text and math
+        to be processed), which also means that *recursive Pandoc calls are
+        needed* (since Pandoc already stopped short producing the RawBlocks
+        we start with).  For the recursive Pandoc calls to work, we need
+        the Pandoc extension `+markdown_in_html_blocks` enabled, as well.
+
+        Every top-level environment in a RawBlock becomes a Div (see
+        `latex_envs.iter_latex_envs`); the LaTeX outside of them, like
+        RawBlocks without environments, is dropped.
+
+        Environment bodies already converted by `batch_convert_latex_envs`,
+        or found in the on-disk cache, don't need their own Pandoc call.
+        The body's Pandoc output is filtered as a parsed AST, with the same
+        walk as the document (see `walk`), so nested environments aren't
+        serialized and parsed again at each level.
+        '''
+
+        if key != 'RawBlock' or value[0] != 'latex':
+            return None
+
+        config = self.get_config(meta)
+
+        div_blocks = [self.latex_env_div(env, config)
+                      for env in iter_latex_envs(value[1])]
+
+        if len(div_blocks) == 1:
+            return div_blocks[0]
+
+        return div_blocks
+
+    def latex_env_div(self, env, config):
+        r''' Convert a LaTeX environment (see `latex_envs.LatexEnv`) to a
+        Div; see `process_latex_envs`.
+        '''
+        env_name = config.env_conversions.get(env.name, env.name)
+        env_title, env_body, env_label = env.title, env.body, env.label
+
+        env_num = self.environment_counters.get(env_name, 0)
         env_num += 1
-        environment_counters[env_name] = env_num
+        self.environment_counters[env_name] = env_num
 
-        label_info = label_pattern.search(env_body)
-        env_label = ""
         label_div = None
-        if label_info is not None:
-            env_label = label_info.group(2)
+        if env_label is not None:
             label_div = label_to_mathjax(env_label, env_tag=env_num)
 
             # XXX: For the Pandoc-types we've been using, there's
@@ -292,48 +1163,403 @@ def process_latex_envs(key, value, oformat, meta):
             # Inlines, which Span is.  We wrap the Span in Para to
             # produce the requisite Block value.
             label_div = Para([label_div])
-
-            # Now, remove the latex label string from the original
-            # content:
-            env_body = env_body.replace(label_info.group(1), '')
+        else:
+            env_label = ""
 
         # Div AST objects:
         # type Attr = (String, [String], [(String, String)])
         # Attributes: identifier, classes, key-value pairs
-        div_attr = [env_label, [env_name], [['markdown', ''],
-                                            ["env-number", str(env_num)],
-                                            ['title-name', env_title]
-                                            ]]
+        div_attr = [env_label, [env_name],
+                    [['markdown', ''],
+                     ["env-number", str(env_num)],
+                     ['title-name', env_title]
+                     ]]
 
-        pandoc_logger.debug(u"env_body (pre-processed): {}\n".format(
-            str(env_body)))
+        debug = pandoc_logger.isEnabledFor(logging.DEBUG)
 
-        # XXX: Nested processing!
-        env_body_proc = pypandoc.convert_text(env_body, 'json',
-                                              format='latex',
-                                              extra_args=(
-                                                  '-s', '-R',
-                                                  '--wrap=none'),
-                                              )
+        if debug:
+            pandoc_logger.debug(
+                u"env_body (pre-processed): {}\n".format(str(env_body)))
 
-        pandoc_logger.debug(u"env_body (pandoc processed): {}\n".format(
-            env_body_proc))
+        # XXX: Nested processing!
+        env_body_proc = self.lookup_latex_env(env_body)
 
-        env_body_filt = applyJSONFilters(
-            [latex_prefilter], env_body_proc, format='json')
+        if debug:
+            pandoc_logger.debug(
+                u"env_body (pandoc processed): {}\n".format(
+                    env_body_proc))
 
-        div_blocks = json.loads(env_body_filt)['blocks']
+        div_blocks = self.walk(env_body_proc['blocks'], 'json',
+                               env_body_proc.get('meta', {}))
 
         if label_div is not None:
             div_blocks = [label_div] + div_blocks
 
         div_res = Div(div_attr, div_blocks)
 
-        pandoc_logger.debug("div_res: {}\n".format(div_res))
+        if debug:
+            pandoc_logger.debug("div_res: {}\n".format(div_res))
 
         return div_res
-    else:
-        return []
+
+    def __call__(self, key, value, oformat, meta, *args, **kwargs):
+        r""" The filter action; see `latex_prefilter`.
+        """
+        if pandoc_logger.isEnabledFor(logging.DEBUG):
+            pandoc_logger.debug((u"Filter key:{}, value:{}, meta:{},"
+                                 "args:{}, kwargs:{}\n").format(
+                                     key, value, meta, args, kwargs))
+
+        self.get_config(meta)
+
+        if self.profile is not None:
+            return self.profile.call_node(self.filter_node, key, value,
+                                          oformat, meta)
+
+        return self.filter_node(key, value, oformat, meta)
+
+    def filter_node(self, key, value, oformat, meta):
+        r""" Filter one AST node; see `latex_prefilter`.
+        """
+        config = self.config
+
+        if key == 'RawInline' and value[0] == 'latex':
+            # Check for preserved commands, `\includegraphics` commands (and
+            # their corresponding files) and string-valued custom inline
+            # math in one pass.
+            is_preserved, new_value = config.inline_tex_matcher.rewrite(
+                value[1], self.find_fig)
+
+            if is_preserved:
+                if pandoc_logger.isEnabledFor(logging.DEBUG):
+                    pandoc_logger.debug("new_value: {}\n".format(new_value))
+
+                for to_ in config.inline_math_callables:
+                    new_value = to_(new_value)
+
+                if (not config.inline_math_callables and
+                        config.inline_tex_matcher.replacements):
+                    new_value = [Math({'t': 'InlineMath', 'c': []},
+                                      new_value)]
+
+                return new_value
+            else:
+                # Check for `\graphicspaths` commands to parse for
+                # new paths.
+                gpaths_matches = gpath_pattern_1.search(value[1])
+                if gpaths_matches is not None:
+                    for gpaths in gpaths_matches.groups():
+                        gpaths = gpath_pattern_2.findall(gpaths)
+                        self.figure_dirs.update(gpaths)
+
+                # Do not include `\graphicspath` in output.
+                return []
+
+        elif key == "Image":
+
+            return self.process_image(key, value, oformat, meta)
+
+        elif key == "Math" and value[0]['t'] == "DisplayMath":
+
+            star = '*'
+            if '\\label' in value[1]:
+                star = ''
+            wrapped_value = ("\\begin{{equation{}}}\n"
+                             "{}\n"
+                             "\\end{{equation{}}}").format(
+                                 star, value[1], star)
+            return Math(value[0], wrapped_value)
+
+        if key == 'RawBlock' and value[0] == 'latex':
+
+            return self.process_latex_envs(key, value, oformat, meta)
+
+        elif "Raw" in key:
+            return []
+
+    def apply(self, doc, oformat=''):
+        r""" Filter a Pandoc JSON AST document.
+
+        This is what `toJSONFilter(self)` does, except that all the
+        environment bodies in the document are converted (in batches)
+        before the walk, and the walk only visits the nodes the filter
+        handles (see `walk`).  The document is changed in place.
+
+        With incremental filtering enabled, only the top-level blocks that
+        changed are filtered (see `apply_incremental`).
+
+        Parameters
+        ==========
+        doc: dict
+            The Pandoc JSON AST document.
+        oformat: str (Optional)
+            The target format passed to the filter by Pandoc.
+
+        Returns
+        =======
+        The filtered Pandoc JSON AST document.
+        """
+        meta = doc.get('meta', {})
+        config = self.get_config(meta)
+
+        if config.incremental and get_block_store() is not None:
+            return self.apply_incremental(doc, oformat)
+
+        self.batch_convert_latex_envs(doc['blocks'])
+
+        self.convert_figures(doc['blocks'])
+
+        doc = self.walk(doc, oformat, meta)
+
+        self.write_profile()
+
+        return doc
+
+    def apply_incremental(self, doc, oformat=''):
+        r""" Filter a Pandoc JSON AST document incrementally (see
+        `incremental`).
+
+        The filtered top-level blocks in `block_store` are reused, when the
+        state they depend on from the blocks before them hasn't changed
+        (see `block_entry_valid`), and renumbered when needed (see
+        `reuse_block`).  The other blocks are filtered--with their
+        environment bodies converted in batches, like `apply` does--and
+        those with environments are stored (see `filter_block`).
+
+        Returns
+        =======
+        The filtered Pandoc JSON AST document.
+        """
+        meta = doc.get('meta', {})
+        self.get_config(meta)
+
+        store = get_block_store()
+        profile = self.profile
+
+        # The meta data is part of the key, so this comes before its walk.
+        doc_key = config_key(self.config, oformat,
+                             get_nested_pandoc_version())
+
+        blocks = doc['blocks']
+        keys = [block_key(doc_key, block) if stored_block(block) else None
+                for block in blocks]
+        entries = [store.get(key) if key is not None else None
+                   for key in keys]
+
+        missed_blocks = [block for block, entry in zip(blocks, entries)
+                         if entry is None]
+        reused_entries = [entry for entry in entries if entry is not None]
+
+        self.batch_convert_latex_envs(missed_blocks)
+
+        self.convert_figures(
+            missed_blocks,
+            [n for entry in reused_entries for n in entry['figure_lookups']],
+            [d for entry in reused_entries
+             for d in entry['new_figure_dirs']])
+
+        self.walk(meta, oformat, meta)
+
+        new_blocks = []
+        plain_blocks = []
+        for block, key, entry in zip(blocks, keys, entries):
+            if key is None:
+                plain_blocks.append(block)
+                continue
+
+            if plain_blocks:
+                new_blocks.extend(self.walk(plain_blocks, oformat, meta))
+                plain_blocks = []
+
+            if entry is not None and self.block_entry_valid(entry):
+                # Renumbered entries aren't stored again, since
+                # renumbering is cheaper than writing them.
+                if self.reuse_block(entry) and profile is not None:
+                    profile.cache['block_renumbered'] += 1
+
+                if profile is not None:
+                    profile.cache['block_hits'] += 1
+            else:
+                entry = self.filter_block(block, oformat, meta)
+                store.set(key, entry)
+
+                if profile is not None:
+                    profile.cache['block_misses'] += 1
+
+            new_blocks.extend(entry['blocks'])
+
+        new_blocks.extend(self.walk(plain_blocks, oformat, meta))
+
+        doc['blocks'] = new_blocks
+
+        self.write_profile()
+
+        return doc
+
+    def filter_block(self, block, oformat, meta):
+        r""" Filter a top-level block for `apply_incremental`.
+
+        Returns
+        =======
+        The block's store entry:  the filtered blocks, and the state from
+        the blocks before it that they depend on and the state they add to
+        (see `block_entry_valid` and `reuse_block`).
+        """
+        figure_dirs = sorted(self.figure_dirs)
+        env_offsets = dict(self.environment_counters)
+        figure_offset = len(self.processed_figures)
+
+        self.block_record = {'figure_lookups': dict(), 'figures': [],
+                             'duplicate_figures': []}
+        try:
+            new_blocks = self.walk([block], oformat, meta)
+        finally:
+            block_record, self.block_record = self.block_record, None
+
+        env_counts = dict(
+            (env_name, env_num - env_offsets.get(env_name, 0))
+            for env_name, env_num in self.environment_counters.items()
+            if env_num != env_offsets.get(env_name, 0))
+
+        return {'blocks': new_blocks,
+                'figure_dirs': figure_dirs,
+                'new_figure_dirs': sorted(self.figure_dirs.difference(
+                    figure_dirs)),
+                'figure_lookups': block_record['figure_lookups'],
+                'figures': [[f, self.processed_figures[f][0]]
+                            for f in block_record['figures']],
+                'duplicate_figures': block_record['duplicate_figures'],
+                'env_counts': env_counts,
+                'env_offsets': dict((env_name, env_offsets.get(env_name, 0))
+                                    for env_name in env_counts),
+                'figure_offset': figure_offset}
+
+    def block_entry_valid(self, entry):
+        r""" Whether a stored block (see `filter_block`) can be reused after
+        the blocks filtered so far.
+
+        The figure directories must be the same as when it was filtered,
+        its figure names must still be found at the same files, and the
+        figures it processed--or skipped, since they were already
+        processed--must still be new--or already processed.
+        """
+        if entry['figure_dirs'] != sorted(self.figure_dirs):
+            return False
+
+        processed_figures = self.processed_figures
+        block_figures = set(f for f, _ in entry['figures'])
+
+        if not block_figures.isdisjoint(processed_figures):
+            return False
+
+        if not all(f in processed_figures or f in block_figures
+                   for f in entry['duplicate_figures']):
+            return False
+
+        return all(self.find_fig(fig_name) == new_fig_fname
+                   for fig_name, new_fig_fname
+                   in entry['figure_lookups'].items())
+
+    def reuse_block(self, entry):
+        r""" Add the state of a stored block (see `filter_block`) to the
+        filter's, as if the block had been filtered, and renumber its
+        environments and figures when the blocks before it changed.
+
+        Returns
+        =======
+        Whether the entry was renumbered.
+        """
+        self.figure_dirs.update(entry['new_figure_dirs'])
+
+        figure_offset = len(self.processed_figures)
+        figure_numbers = dict()
+        for fig_fname, fig_label in entry['figures']:
+            self.processed_figures[fig_fname] = [None, None]
+            if fig_label is not None:
+                fig_num = len(self.processed_figures)
+                self.processed_figures[fig_fname] = [fig_label, fig_num]
+                figure_numbers[fig_fname] = fig_num
+
+        env_offsets = dict()
+        for env_name, env_count in entry['env_counts'].items():
+            env_offsets[env_name] = self.environment_counters.get(env_name,
+                                                                  0)
+            self.environment_counters[env_name] = (env_offsets[env_name] +
+                                                   env_count)
+
+        if (env_offsets == entry['env_offsets'] and
+                (figure_offset == entry['figure_offset'] or
+                 not figure_numbers)):
+            return False
+
+        renumber_blocks(entry['blocks'], env_offsets, figure_numbers)
+
+        return True
+
+    def apply_blocks(self, blocks, oformat, meta):
+        r""" Filter a list of blocks from a document with meta data `meta`.
+
+        This is the per-block counterpart of `apply` used by the
+        streaming filter (see `ast_stream.stream_filter`); the
+        environment bodies are batched within `blocks`.
+        """
+        self.get_config(meta)
+
+        self.batch_convert_latex_envs(blocks)
+
+        self.convert_figures(blocks)
+
+        return self.walk(blocks, oformat, meta)
+
+    def walk(self, x, oformat, meta):
+        r""" Apply the filter to the `filter_node_types` nodes in `x` (see
+        `walk_ast`).
+
+        When profiling, every node goes through the filter, so that the
+        profile covers all node types.
+        """
+        return walk_ast(x, self.handlers, oformat, meta,
+                        default=self if self.profile is not None else None)
+
+
+_local = threading.local()
+
+
+def get_latex_filter(meta=None):
+    r''' Get the `LatexFilter` used by the module-level functions below.
+
+    There's one per thread, and a new one is created whenever `meta` isn't
+    the meta data of the current one's document (i.e. for each new
+    document).
+    '''
+    latex_filter = getattr(_local, 'latex_filter', None)
+
+    if latex_filter is None or (meta is not None and
+                                latex_filter.config is not None and
+                                latex_filter.config.meta is not meta):
+        latex_filter = LatexFilter()
+        _local.latex_filter = latex_filter
+
+    return latex_filter
+
+
+def get_filter_config(meta):
+    r''' Get the `FilterConfig` for the document with meta data `meta`.
+    '''
+    return get_latex_filter(meta).get_config(meta)
+
+
+def process_image(key, value, oformat, meta):
+    r''' See `LatexFilter.process_image`.
+    '''
+    return get_latex_filter(meta).process_image(key, value, oformat, meta)
+
+
+def process_latex_envs(key, value, oformat, meta):
+    r''' See `LatexFilter.process_latex_envs`.
+    '''
+    return get_latex_filter(meta).process_latex_envs(key, value, oformat,
+                                                     meta)
 
 
 def latex_prefilter(key, value, oformat, meta, *args, **kwargs):
@@ -350,6 +1576,10 @@ def latex_prefilter(key, value, oformat, meta, *args, **kwargs):
     allow more raw latex commands and to convert latex environment names
     to CSS class names, respectively.
 
+    This is a compatibility wrapper around a per-thread, per-document
+    `LatexFilter` (see `get_latex_filter`); use `LatexFilter` directly to
+    control the state kept for a document.
+
     # TODO: Describe more.
 
     # XXX: This filter does some questionable recursive calling at the
@@ -360,84 +1590,22 @@ def latex_prefilter(key, value, oformat, meta, *args, **kwargs):
     TODO: Document parameters.
 
     """
-    pandoc_logger.debug((u"Filter key:{}, value:{}, meta:{},"
-                   "args:{}, kwargs:{}\n").format(
-                       key, value, meta, args, kwargs))
-
-    global custom_inline_math, preserved_tex,\
-        env_conversions, figure_dirs, fig_fname_ext
-
-    custom_inline_math = custom_inline_math.copy()
-    custom_inline_math.update(meta.get(
-        'custom_inline_math', {}).get('c', {}))
-
-    env_conversions = env_conversions.copy()
-    env_conversions.update(meta.get(
-        'env_conversions', {}).get('c', {}))
-
-    preserved_tex += meta.get('preserved_tex', {}).get('c', [])
-
-    figure_dir_meta = meta.get('figure_dir', {}).get('c', None)
-    if figure_dir_meta is not None:
-        figure_dirs.add(figure_dir_meta)
-
-    fig_fname_ext = meta.get('figure_ext', {}).get('c', None)
-
-    if key == 'RawInline' and value[0] == 'latex':
-        if any(c_ in value[1] for c_ in preserved_tex):
-            # Check for `\includegraphics` commands and their
-            # corresponding files.
-            new_value = copy(value[1])
-            figure_files = graphics_pattern.findall(new_value)
-
-            def repstep(x, y):
-                new_y = rename_find_fig(y, figure_dirs, fig_fname_ext)
-                return x.replace(y, new_y)
+    return get_latex_filter(meta)(key, value, oformat, meta, *args, **kwargs)
 
-            new_value = reduce(repstep, figure_files, new_value)
 
-            pandoc_logger.debug("figure_files: {}\tnew_value: {}\n".format(
-                figure_files, new_value))
+def apply_latex_prefilter(doc, oformat=''):
+    r""" Apply `latex_prefilter` to a Pandoc JSON AST document, with a new
+    `LatexFilter`.
 
-            for from_, to_ in custom_inline_math.items():
-                if callable(to_):
-                    new_value = to_(new_value)
-                else:
-                    new_value = new_value.replace(from_, to_)
-                    new_value = [Math({'t': 'InlineMath', 'c': []},
-                                      new_value)]
-
-            return new_value
-        else:
-            # Check for `\graphicspaths` commands to parse for
-            # new paths.
-            gpaths_matches = gpath_pattern_1.search(value[1])
-            if gpaths_matches is not None:
-                for gpaths in gpaths_matches.groups():
-                    gpaths = gpath_pattern_2.findall(gpaths)
-                    figure_dirs.update(gpaths)
-
-            # Do not include `\graphicspath` in output.
-            return []
-
-    elif key == "Image":
-
-        return process_image(key, value, oformat, meta)
-
-    elif key == "Math" and value[0]['t'] == "DisplayMath":
-
-        star = '*'
-        if '\\label' in value[1]:
-            star = ''
-        wrapped_value = ("\\begin{{equation{}}}\n"
-                         "{}\n"
-                         "\\end{{equation{}}}").format(
-                             star, value[1], star)
-        return Math(value[0], wrapped_value)
+    See `LatexFilter.apply`.
+    """
+    return LatexFilter().apply(doc, oformat)
 
-    if key == 'RawBlock' and value[0] == 'latex':
 
-        return process_latex_envs(key, value, oformat, meta)
+def apply_latex_prefilter_blocks(blocks, oformat, meta):
+    r""" Apply `latex_prefilter` to a list of blocks from a document with
+    meta data `meta`.
 
-    elif "Raw" in key:
-        return []
+    See `LatexFilter.apply_blocks`.
+    """
+    return get_latex_filter(meta).apply_blocks(blocks, oformat, meta)
@@ -2,11 +2,15 @@ from pweave import (PwebFormats, PwebProcessors)
 from .formatters import (PwebMintedPandocFormatter, PwebMintedPandoc)
 
 
-PwebFormats.formats.update(
-    {
-        'pweb_minted_pandoc':
-        {'class': PwebMintedPandocFormatter,
-         'description':
-         ('Minted environs with Pandoc and Pelican figure output considerations.')
-         }
-    })
+def register_formats():
+    r''' Add our formatters to Pweave's `PwebFormats`, so that they can be
+    used by name, e.g. `Pweb(source, doctype='pweb_minted_pandoc')`.
+    '''
+    PwebFormats.formats.update(
+        {
+            'pweb_minted_pandoc':
+            {'class': PwebMintedPandocFormatter,
+             'description':
+             ('Minted environs with Pandoc and Pelican figure output considerations.')
+             }
+        })
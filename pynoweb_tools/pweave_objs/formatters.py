@@ -1,3 +1,5 @@
+import os
+
 from pweave import Pweb, PwebTexFormatter
 
 
@@ -5,6 +7,10 @@ class PwebMintedPandocFormatter(PwebTexFormatter):
     r""" Custom output format that handles figures for Pandoc and Pelican.
 
     TODO: Describe changes to figure handling.
+
+    Besides Pweave's `format`, which formats the whole document at once,
+    chunks can be formatted one at a time with `format_chunk` (see
+    `utils.stream_weave`).
     """
     def __init__(self, *args, **kwargs):
         self.after_code_newline = kwargs.pop('after_code_newline', True)
@@ -42,59 +48,96 @@ class PwebMintedPandocFormatter(PwebTexFormatter):
             width=r'\textwidth',
             doctype='tex')
 
+        # Fill in the language now, instead of for every chunk.
+        for key in ('codestart', 'termstart'):
+            if '%s' in self.formatdict[key]:
+                self.formatdict[key] = self.formatdict[key] % self.language
+
+    def format(self):
+        self.formatted = "\n".join(self.format_chunk(chunk)
+                                   for chunk in self.executed)
+        self.convert()
+        self.add_header()
+        self.add_footer()
+
+    def format_chunk(self, chunk):
+        r''' Format one executed chunk, as `format` does for each of them.
+
+        Returns
+        =======
+        The formatted string.
+        '''
+        if chunk['type'] == "code":
+            for key, value in self.formatdict.items():
+                chunk.setdefault(key, value)
+
+            if chunk["wrap"] is True or chunk['wrap'] == "code":
+                chunk['content'] = self._wrap(chunk['content'])
+
+        chunk = self.preformat_chunk(chunk)
+
+        if chunk['type'] == "doc":
+            return self.format_docchunk(chunk)
+        elif chunk['type'] == "code":
+            return self.format_codechunks(chunk)
+        else:
+            return chunk["content"]
+
     def formatfigure(self, chunk):
         fignames = chunk['figure']
         caption = chunk['caption']
         width = chunk.get('width',
                           self.formatdict.get('width'))
-        result = ""
-        figstring = ""
+        result = []
 
         fig_root = chunk.get('fig_root', None)
         # TODO: Get rid of `width`; no longer needed.
         graphics_opts = chunk.get('graphics_opts', '')
 
         if chunk["f_env"] is not None:
-            result += "\\begin{%s}\n" % chunk["f_env"]
+            result.append("\\begin{%s}\n" % chunk["f_env"])
 
-        for fig in fignames:
-            opts_str = ''
-            if width != '':
-                opts_str = "width={}".format(width)
+        # The options are the same for every figure.
+        opts_str = ''
+        if width != '':
+            opts_str = "width={}".format(width)
 
-            if graphics_opts != '':
-                opts_str += ',' + graphics_opts
+        if graphics_opts != '':
+            opts_str += ',' + graphics_opts
 
-            opts_str = opts_str.replace(' ', '')
+        opts_str = opts_str.replace(' ', '')
 
-            if opts_str != '':
-                opts_str = "[{}]".format(opts_str)
+        if opts_str != '':
+            opts_str = "[{}]".format(opts_str)
 
+        figstrings = []
+        for fig in fignames:
             if fig_root is not None and fig_root != '':
-                import os
                 fig = os.path.basename(fig)
                 fig = os.path.join(fig_root, fig)
 
-            figstring += ("\\includegraphics%s{%s}\n" % (opts_str, fig))
+            figstrings.append("\\includegraphics%s{%s}\n" % (opts_str, fig))
+
+        figstring = "".join(figstrings)
 
         # Figure environment
         if chunk['caption']:
-            result += ("\\begin{figure}[%s]\n"
-                       "\\center\n"
-                       "%s"
-                       "\\caption{%s}\n" % (chunk['f_pos'],
-                                            figstring, caption))
+            result.append("\\begin{figure}[%s]\n"
+                          "\\center\n"
+                          "%s"
+                          "\\caption{%s}\n" % (chunk['f_pos'],
+                                               figstring, caption))
             if 'name' in chunk:
-                result += "\label{fig:%s}\n" % chunk['name']
-            result += "\\end{figure}\n"
+                result.append("\\label{fig:%s}\n" % chunk['name'])
+            result.append("\\end{figure}\n")
 
         else:
-            result += figstring
+            result.append(figstring)
 
         if chunk["f_env"] is not None:
-            result += "\\end{%s}\n" % chunk["f_env"]
+            result.append("\\end{%s}\n" % chunk["f_env"])
 
-        return result
+        return "".join(result)
 
 
 class PwebMintedPandoc(Pweb):
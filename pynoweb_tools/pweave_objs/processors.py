@@ -0,0 +1,105 @@
+import os
+import json
+import time
+
+from pweave import rcParams
+from pweave.processors import JupyterProcessor, IPythonProcessor
+from pweave.processors.base import PwebProcessorBase
+
+from ..kernel_daemon import reset_code
+
+
+class ConnectedJupyterProcessor(JupyterProcessor):
+    r""" A Jupyter processor that runs code in an already running kernel
+    (e.g. one from a `kernel_daemon` pool) instead of starting its own.
+
+    The kernel is left running when the processor closes.
+
+    Parameters
+    ==========
+    connection_file: str
+        The kernel's connection file.
+    """
+
+    def __init__(self, parsed, kernel, source, mode, figdir, outdir,
+                 connection_file=None):
+        PwebProcessorBase.__init__(self, parsed, kernel, source, mode,
+                                   figdir, outdir)
+
+        from jupyter_client import BlockingKernelClient
+
+        self.extra_arguments = None
+        self.timeout = -1
+        self.interrupt_on_timeout = False
+
+        self.connection_file = connection_file
+        with open(connection_file, 'r') as f:
+            self.connection_info = json.load(f)
+
+        start_time = time.monotonic()
+
+        kc = BlockingKernelClient()
+        kc.load_connection_file(connection_file)
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=30)
+        except RuntimeError:
+            kc.stop_channels()
+            raise
+
+        self.kernel_ready_seconds = time.monotonic() - start_time
+
+        self.km = None
+        self.kc = kc
+        self.kc.allow_stdin = False
+
+    def close(self):
+        self.kc.stop_channels()
+
+
+class ConnectedIPythonProcessor(ConnectedJupyterProcessor,
+                                IPythonProcessor):
+    r""" A `ConnectedJupyterProcessor` for IPython kernels.
+
+    The kernel's working directory is set to the output directory, and its
+    namespace is reset (rerunning the pool's preload script) when the
+    processor closes, so that the next document starts fresh.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ConnectedIPythonProcessor, self).__init__(*args, **kwargs)
+
+        self.loadstring("import os as _os; _os.chdir({}); del _os".format(
+            json.dumps(os.path.abspath(self.outdir))))
+
+        if rcParams["usematplotlib"]:
+            self.init_matplotlib()
+
+    def close(self):
+        try:
+            self.loadstring(reset_code(
+                self.connection_info.get('pynoweb_preload', None)))
+        finally:
+            super(ConnectedIPythonProcessor, self).close()
+
+
+def connected_processor(kernel, connection_file):
+    r''' Get a processor class, for `Pweb.run`, that uses the running kernel
+    with connection file `connection_file`.
+
+    The time it took to connect to the kernel is recorded in the
+    returned callable's `kernel_ready_seconds` attribute.
+    '''
+    if "python" in kernel:
+        processor_class = ConnectedIPythonProcessor
+    else:
+        processor_class = ConnectedJupyterProcessor
+
+    def processor(*args):
+        proc = processor_class(*args, connection_file=connection_file)
+        processor.kernel_ready_seconds = proc.kernel_ready_seconds
+        return proc
+
+    processor.kernel_ready_seconds = None
+
+    return processor
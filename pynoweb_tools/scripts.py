@@ -1,21 +1,43 @@
+import io
 import sys
 import os
+import json
+import glob
 from optparse import OptionParser
 
-import pweave
-from pweave import rcParams
-
-from pandocfilters import toJSONFilter
-
-from .pweave_objs.formatters import PwebMintedPandocFormatter
-from .utils import weave_retry_cache
-from .pandoc_utils import latex_prefilter
+from .pandoc_utils import LatexFilter
+from .ast_stream import stream_filter
 
 
 def weave():
     r""" This provides a callable script that mimics the `Pweave` command but
     uses our specially purposed Pandoc formatter and cache retry wrapper.
 
+    Several source files (or glob patterns, or a manifest of files) can be
+    given, in which case they're woven concurrently in up to `--jobs`
+    worker processes, each with its own kernel.  The output file and figure
+    directory options can then contain the fields `{name}` and `{dir}` (see
+    `utils.document_paths`), so that documents don't share them; it's an
+    error when they do.
+
+    With `--incremental`, only the chunks that changed since the last weave
+    (and the chunks that depend on them) are run; see `chunk_cache`.
+
+    With `--stream`, each chunk is formatted and written to the output file
+    as soon as it's executed, instead of after the whole document has run.
+
+    With `--groups`, the chunks in different groups (see `chunk_groups`)
+    run concurrently, each group in its own kernel.
+
+    With `--kernel-connection` or `--kernel-pool`, the code runs in an
+    already running kernel (see `kernel_daemon`), and the time it took that
+    kernel to answer is reported.
+
+    With `--watch`, the (single) source is woven again, incrementally and in
+    the same kernel, whenever it changes; with `--pandoc-output`, the woven
+    output is also converted with Pandoc and the LaTeX prefilter whenever
+    it, a bibliography or a figure changes.  See `watch.WatchBuild`.
+
     TODO: Much of this isn't needed anymore, so refactor.  Especially
     since the retry stuff should just be in a `Pweave.Processor`.
 
@@ -27,7 +49,8 @@ def weave():
         print("Enter PynowebWeave -h for help")
         sys.exit()
 
-    parser = OptionParser(usage="PynowebWeave [options] sourcefile")
+    parser = OptionParser(
+        usage="PynowebWeave [options] sourcefile [sourcefile ...]")
     parser.add_option("-d", "--documentation-mode",
                       dest="docmode",
                       action="store_true",
@@ -47,62 +70,236 @@ def weave():
     parser.add_option("-o", "--output-file",
                       dest="output",
                       default=None,
-                      help="Path and filename for output file")
+                      help=("Path and filename for output file: "
+                            "Default '{dir}/{name}.tex'"))
     parser.add_option("-k", "--kernel",
                       dest="kernel",
                       default="python3",
                       help="Jupyter kernel in which to process code")
+    parser.add_option("-i", "--incremental",
+                      dest="incremental", action="store_true",
+                      default=False,
+                      help=("Only run the chunks that changed since the last "
+                            "weave, and the chunks that depend on them"))
+    parser.add_option("-s", "--stream",
+                      dest="stream", action="store_true",
+                      default=False,
+                      help=("Write each chunk to the output file as soon as "
+                            "it's executed"))
+    parser.add_option("-g", "--groups",
+                      dest="groups", action="store_true",
+                      default=False,
+                      help=("Run the chunk groups (the 'group' chunk option) "
+                            "concurrently, each in its own kernel"))
+    parser.add_option("--kernel-connection",
+                      dest="kernel_connection", default=None,
+                      help=("Connection file of a running kernel in which "
+                            "to process code"))
+    parser.add_option("--kernel-pool",
+                      dest="kernel_pool", action="store_true",
+                      default=False,
+                      help=("Use a kernel from a PynowebKernelDaemon pool, "
+                            "when one is ready"))
+    parser.add_option("-m", "--manifest",
+                      dest="manifest", default=None,
+                      help="A file listing source files, one per line")
+    parser.add_option("-j", "--jobs",
+                      dest="jobs", type="int", default=1,
+                      help=("Number of documents to weave concurrently: "
+                            "Default 1"))
+    parser.add_option("-w", "--watch",
+                      dest="watch", action="store_true",
+                      default=False,
+                      help="Rebuild the document whenever its inputs change")
+    parser.add_option("--pandoc-output",
+                      dest="pandoc_output", default=None,
+                      help=("With --watch, convert the woven output to this "
+                            "file with Pandoc"))
+    parser.add_option("--pandoc-to",
+                      dest="pandoc_to", default=None,
+                      help=("With --watch, the Pandoc output format: "
+                            "Default based on the --pandoc-output extension"))
+    parser.add_option("--pandoc-arg",
+                      dest="pandoc_args", action="append", default=[],
+                      help=("With --watch, an extra Pandoc argument; can be "
+                            "repeated"))
+    parser.add_option("--bibliography",
+                      dest="bibliographies", action="append", default=[],
+                      help=("With --watch, a bibliography file for Pandoc; "
+                            "can be repeated"))
+    parser.add_option("--watch-path",
+                      dest="watch_paths", action="append", default=[],
+                      help=("With --watch, another file or directory whose "
+                            "changes trigger a Pandoc conversion; can be "
+                            "repeated"))
 
     (options, args) = parser.parse_args()
 
-    try:
-        infile = args[0]
-    except IndexError:
-        infile = ""
+    # Pweave and Jupyter are slow to import, and only needed here; see
+    # `latex_json_filter`.
+    from .utils import weave_document, weave_documents
+    from .pandoc_batch import read_manifest, format_report
+    from .watch import WatchBuild
 
-    opts_dict = vars(options)
+    sources = []
+    for arg in args:
+        if glob.has_magic(arg):
+            sources += sorted(glob.glob(arg))
+        else:
+            sources.append(arg)
 
-    # set some global options
-    rcParams['figdir'] = opts_dict.pop('figdir', None)
-    rcParams['storeresults'] = opts_dict.pop('cache', None)
-    rcParams["chunk"]["defaultoptions"].update({'wrap': False})
+    if options.manifest is not None:
+        sources += read_manifest(options.manifest)
 
-    weave_kernel = opts_dict.pop('kernel')
+    weave_kwargs = dict(output=options.output,
+                        figdir=options.figdir,
+                        kernel=options.kernel,
+                        docmode=options.docmode,
+                        cache=options.cache,
+                        kernel_connection=options.kernel_connection,
+                        kernel_pool=options.kernel_pool,
+                        incremental=options.incremental,
+                        stream=options.stream,
+                        groups=options.groups)
 
-    # pweb_formatter = PwebMintedPandoc(infile,
-    #                                   format="tex",
-    #                                   shell=shell_opt,
-    #                                   figdir=rcParams['figdir'],
-    #                                   output=opts_dict.pop('output', None),
-    #                                   docmode=opts_dict.pop('docmode', None))
+    if options.watch:
+        if len(sources) != 1:
+            parser.error("--watch takes exactly one source file")
 
-    out_file = opts_dict.pop('output', None)
-    out_dir, out_filename = os.path.split(out_file)
-    _, out_filename_ext = os.path.splitext(out_filename)
+        del weave_kwargs['kernel_connection']
+        del weave_kwargs['kernel_pool']
 
-    weaver = pweave.Pweb(infile,
-                         doctype=out_filename_ext[1:],
-                         kernel=weave_kernel,
-                         # XXX: Pydoc is super confusing; this
-                         # should be the output dir and filename.
-                         output=out_file,
-                         figdir=rcParams['figdir'],
-                         kernel_args={'embed_kernel': False})
+        WatchBuild(sources[0], weave_kwargs,
+                   pandoc_output=options.pandoc_output,
+                   pandoc_to=options.pandoc_to,
+                   pandoc_args=options.pandoc_args,
+                   bibliographies=options.bibliographies,
+                   watch_paths=options.watch_paths).run()
+        return
 
-    weaver.documentationmode = opts_dict.pop('docmode', None)
+    if len(sources) == 1:
+        results = [weave_document(sources[0], **weave_kwargs)]
+    else:
+        try:
+            results = weave_documents(sources, jobs=options.jobs,
+                                      **weave_kwargs)
+        except ValueError as e:
+            parser.error(str(e))
 
-    weaver.setformat(Formatter=PwebMintedPandocFormatter)
+    for result in results:
+        if result['error'] is not None:
+            sys.stderr.write("{}:\n{}\n".format(result['input'],
+                                                 result['error']))
+        for discarded in result['discarded']:
+            print("{}: discarded cached results{}: {}".format(
+                result['input'],
+                '' if discarded['chunk'] is None else
+                ' of chunk {} ({})'.format(discarded['chunk'],
+                                           discarded['name']),
+                discarded['reason']))
+        if result['kernel_ready_seconds'] is not None:
+            print("{}: kernel ready in {:.3f}s".format(
+                result['input'], result['kernel_ready_seconds']))
 
-    # if weave_format_opts is not None:
-    #     weaver.updateformat(weave_format_opts)
+    if len(results) > 1:
+        print(format_report(results, 'weaving'))
 
-    weave_retry_cache(weaver)
+    if any(result['error'] is not None for result in results):
+        sys.exit(1)
 
 
 def latex_json_filter():
     r""" A Pandoc filter for additional and custom LaTeX processing
     functionality.
 
-    .. see: pandoc_utils.latex_prefilter
+    Like `pandocfilters.toJSONFilter`, but the LaTeX environment bodies are
+    converted in batches before the filter walk.
+
+    With `--stream` (or the environment variable `PYNOWEB_FILTER_STREAM`
+    set to `1`, since Pandoc doesn't pass options to its filters), the
+    document is read, filtered and written one top-level block at a time,
+    so that memory use is bounded by the largest block.  Environment
+    bodies are then batched per top-level block.
+
+    With `--batch`, the arguments are Pandoc JSON AST files instead, which
+    are filtered across a pool of processes and written next to their
+    inputs (see `pandoc_batch`).
+
+    Pandoc runs this for every document, so it only imports what it
+    needs; in particular, not Pweave or Jupyter (see
+    `benchmarks/bench_filter_import.py`).
+
+    .. see: pandoc_utils.LatexFilter
+    .. see: ast_stream.stream_filter
+    .. see: pandoc_batch.filter_files
     """
-    toJSONFilter(latex_prefilter)
+    parser = OptionParser(
+        usage=("PynowebFilter [options] [format]\n"
+               "       PynowebFilter --batch [options] [jsonfile ...]"))
+    parser.add_option("-s", "--stream",
+                      dest="stream", action="store_true",
+                      default=os.environ.get(
+                          'PYNOWEB_FILTER_STREAM', '') == '1',
+                      help=("Filter the document one top-level block at "
+                            "a time"))
+    parser.add_option("-b", "--batch",
+                      dest="batch", action="store_true",
+                      default=False,
+                      help=("Filter the given Pandoc JSON AST files into "
+                            "<name>.filtered.json files"))
+    parser.add_option("-m", "--manifest",
+                      dest="manifest", default=None,
+                      help=("With --batch, a file listing the Pandoc JSON "
+                            "AST files, one per line"))
+    parser.add_option("-j", "--jobs",
+                      dest="jobs", type="int", default=None,
+                      help=("With --batch, the number of worker processes: "
+                            "Default the number of CPUs"))
+    parser.add_option("-t", "--to",
+                      dest="oformat", default="",
+                      help="With --batch, the target format")
+
+    (options, args) = parser.parse_args()
+
+    if options.batch:
+        from .pandoc_batch import filter_files, read_manifest, format_report
+
+        paths = list(args)
+        if options.manifest is not None:
+            paths += read_manifest(options.manifest)
+
+        results = filter_files(paths, options.oformat,
+                               workers=options.jobs)
+
+        for result in results:
+            if result['error'] is not None:
+                sys.stderr.write("{}:\n{}\n".format(result['input'],
+                                                     result['error']))
+
+        print(format_report(results))
+
+        if any(result['error'] is not None for result in results):
+            sys.exit(1)
+        return
+
+    oformat = args[0] if len(args) > 0 else ""
+
+    input_stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+
+    latex_filter = LatexFilter()
+
+    if options.stream:
+        stream_filter(
+            lambda blocks, meta: latex_filter.apply_blocks(
+                blocks, oformat, meta),
+            input_stream, sys.stdout,
+            filter_meta=lambda meta: latex_filter.walk(meta, oformat,
+                                                       meta))
+
+        latex_filter.write_profile()
+    else:
+        doc = json.loads(input_stream.read())
+
+        doc = latex_filter.apply(doc, oformat)
+
+        sys.stdout.write(json.dumps(doc))
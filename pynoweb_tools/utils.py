@@ -1,26 +1,363 @@
+import io
 import os
-import glob
+import copy
+import time
+import traceback
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+from pweave import Pweb, rcParams
+
+from .pweave_objs import register_formats
+from .pweave_objs.formatters import PwebMintedPandocFormatter
+from .pweave_objs.processors import connected_processor
+from .kernel_daemon import claim_kernel, release_kernel
+from .chunk_cache import incremental_run
+from .chunk_groups import grouped_run
 
 
 def weave_retry_cache(pweb_formatter):
-    r''' Catch cache issues and start fresh when they're found.
+    r''' Catch cache issues and weave again when they're found.
+
+    Documentation mode results that don't match the document's chunks
+    raise an `IndexError`.  Instead of starting fresh, only those results
+    are discarded and the document is woven again incrementally (see
+    `chunk_cache.incremental_run`), so that only the chunks without valid
+    cached results run.
 
-    TODO: Just create new processors?
+    What was discarded, and why, is listed in
+    `pweb_formatter.discarded_chunks`.
 
     Parameters
     ==========
     pweb_formatter: Pweb
         Pweb formatter to be run.
     '''
+    pweb_formatter.discarded_chunks = []
 
     try:
         pweb_formatter.weave()
-    except IndexError:
-        input_file = pweb_formatter.source
-
-        cache_dir = os.path.abspath(pweb_formatter.cachedir)
-        input_file_base, input_file_ext = os.path.splitext(input_file)
-        cache_glob = input_file_base + '*'
-        cache_pattern = os.path.join(cache_dir, cache_glob)
-        _ = map(os.unlink, glob.glob(cache_pattern))  # noqa
+    except IndexError as e:
+        input_file = os.path.abspath(pweb_formatter.source)
+
+        cache_dir = os.path.join(os.path.dirname(input_file),
+                                 rcParams["cachedir"])
+        input_file_base = os.path.basename(input_file).split(".")[0]
+        results_file = os.path.join(cache_dir, input_file_base + '.pkl')
+        if os.path.exists(results_file):
+            os.unlink(results_file)
+
+        pweb_formatter.discarded_chunks.append(
+            {'chunk': None, 'name': None,
+             'reason': ("documentation mode results don't match the "
+                        "document ({})".format(e))})
+
+        processor = getattr(pweb_formatter.run, 'keywords',
+                            {}).get('Processor', None)
+        pweb_formatter.run = partial(incremental_run, pweb_formatter,
+                                     Processor=processor)
         pweb_formatter.weave()
+
+
+def stream_run(weaver, on_chunk, Processor=None):
+    r''' Run a `Pweb` document's code one chunk at a time, calling
+    `on_chunk` with each chunk's executed chunks as soon as they're ready.
+
+    The executed chunks are only kept (in `weaver.executed`) when the
+    results are stored for documentation mode.
+    '''
+    from pweave import PwebProcessors
+
+    if Processor is None:
+        Processor = PwebProcessors.getprocessor(weaver.kernel)
+
+    proc = Processor(copy.deepcopy(weaver.parsed), weaver.kernel,
+                     weaver.source, False, weaver.figdir, weaver.wd)
+    proc.ensureDirectoryExists(proc.getFigDirectory())
+
+    executed = []
+    try:
+        for i, chunk in enumerate(proc.parsed):
+            # The processor adds the results to its chunks; don't keep them.
+            proc.parsed[i] = None
+
+            res = proc._runcode(chunk)
+            res = res if isinstance(res, list) else [res]
+            if rcParams["storeresults"]:
+                executed += copy.deepcopy(res)
+            on_chunk(res)
+    finally:
+        proc.close()
+
+    if rcParams["storeresults"]:
+        proc.store(executed)
+
+    weaver.executed = executed
+
+
+def stream_weave(weaver, Processor=None, incremental=False, groups=False,
+                 GroupProcessor=None):
+    r''' Weave a document, writing each chunk to the output file as soon as
+    it's executed and formatted.
+
+    This takes the place of `Pweb.weave`; unlike it, the whole formatted
+    document is never held in memory.  The formatter must format chunks
+    independently (see `PwebMintedPandocFormatter.format_chunk`).
+
+    Parameters
+    ==========
+    weaver: Pweb
+        The document.
+    Processor: class (Optional)
+        The processor class (see `Pweb.run`).
+    incremental: bool (Optional)
+        Run the code with `chunk_cache.incremental_run`.
+    groups: bool (Optional)
+        Run the chunk groups concurrently with `chunk_groups.grouped_run`.
+    GroupProcessor: class (Optional)
+        The processor class for the chunk groups (see `grouped_run`).
+    '''
+    formatter = weaver.formatter
+    weaver.setsink()
+
+    with io.open(weaver.sink, 'wt', encoding='utf-8') as sink:
+        if formatter.header is not None:
+            sink.write(formatter.header)
+
+        first_chunk = True
+
+        def write_chunks(chunks):
+            nonlocal first_chunk
+            for chunk in chunks:
+                text = formatter.format_chunk(chunk)
+                # Chunks are separated by newlines, as in `Pweb.format`.
+                if not first_chunk:
+                    sink.write('\n')
+                first_chunk = False
+                sink.write(text.replace('\r', ''))
+            sink.flush()
+
+        if incremental:
+            incremental_run(weaver, Processor=Processor,
+                            on_chunk=write_chunks)
+        elif groups:
+            grouped_run(weaver, Processor=Processor,
+                        GroupProcessor=GroupProcessor,
+                        on_chunk=write_chunks)
+        else:
+            stream_run(weaver, write_chunks, Processor=Processor)
+
+        if formatter.footer is not None:
+            sink.write(formatter.footer)
+
+    weaver._print('Weaved {src} to {dst}\n'.format(src=weaver.source,
+                                                   dst=weaver.sink))
+
+
+def document_paths(source, output=None, figdir='figures'):
+    r''' Expand the output file and figure directory templates for a
+    source document.
+
+    `output` and `figdir` can contain the fields `{name}` (the source's
+    base name, without extension) and `{dir}` (the source's directory), so
+    that each of several documents gets its own output and figures.
+
+    Returns
+    =======
+    The output file and figure directory.
+    '''
+    source_dir, source_fname = os.path.split(source)
+    fields = {'name': os.path.splitext(source_fname)[0],
+              'dir': source_dir or os.curdir}
+
+    if output is None:
+        output = os.path.join('{dir}', '{name}.tex')
+
+    return output.format(**fields), figdir.format(**fields)
+
+
+def weave_document(source, output=None, figdir='figures',
+                   kernel='python3', docmode=False, cache=False,
+                   kernel_connection=None, kernel_pool=False,
+                   pool_dir=None, incremental=False, stream=False,
+                   groups=False):
+    r''' Weave one document with `PwebMintedPandocFormatter` and the cache
+    retry wrapper.
+
+    Parameters
+    ==========
+    source: str
+        The source document.
+    output: str (Optional)
+        Path and filename for the output file; it can be a template (see
+        `document_paths`).
+    figdir: str (Optional)
+        Directory for the figures, relative to the output file's directory;
+        it can be a template (see `document_paths`).
+    kernel: str (Optional)
+        Jupyter kernel in which to process code.
+    docmode: bool (Optional)
+        Use documentation mode: inline code is hidden and the cached chunk
+        results are used (i.e. it implies `incremental`).
+    cache: bool (Optional)
+        Cache results to disk for documentation mode.
+    kernel_connection: str (Optional)
+        Connection file of a running kernel to use instead of starting one.
+    kernel_pool: bool (Optional)
+        Use a kernel from a `kernel_daemon` pool, when one is ready.
+    pool_dir: str (Optional)
+        The kernel pool directory (see `kernel_daemon.default_pool_dir`).
+    incremental: bool (Optional)
+        Only run the chunks that changed since the last weave (see
+        `chunk_cache`).
+    stream: bool (Optional)
+        Write each chunk to the output file as soon as it's executed (see
+        `stream_weave`).
+    groups: bool (Optional)
+        Run the chunk groups (see `chunk_groups`) concurrently, each in its
+        own kernel.  The groups other than the main one always start their
+        own kernels.  This doesn't apply to incremental weaves.
+
+    Returns
+    =======
+    A dict with the `input` and `output` paths, the wall time in `seconds`,
+    the time it took a running kernel to answer in `kernel_ready_seconds`
+    (`None` for a new kernel), the `discarded` cache entries (see
+    `weave_retry_cache`) and, when the document couldn't be woven, the
+    `error`.
+    '''
+    output, figdir = document_paths(source, output, figdir)
+
+    result = {'input': source, 'output': output, 'seconds': None,
+              'kernel_ready_seconds': None, 'discarded': [], 'error': None}
+
+    start_time = time.perf_counter()
+
+    connection_file = kernel_connection
+    claimed = False
+    if connection_file is None and kernel_pool:
+        connection_file = claim_kernel(kernel, pool_dir)
+        claimed = connection_file is not None
+
+    try:
+        # These are process-wide settings, which is why concurrent weaves
+        # each get their own process (see `weave_documents`).
+        rcParams['figdir'] = figdir
+        rcParams['storeresults'] = cache
+        rcParams["chunk"]["defaultoptions"].update({'wrap': False})
+        register_formats()
+
+        _, out_filename = os.path.split(output)
+        _, out_filename_ext = os.path.splitext(out_filename)
+
+        weaver = Pweb(source,
+                      doctype=out_filename_ext[1:],
+                      kernel=kernel,
+                      # XXX: Pydoc is super confusing; this
+                      # should be the output dir and filename.
+                      output=output,
+                      figdir=figdir,
+                      kernel_args={'embed_kernel': False})
+
+        weaver.documentationmode = docmode
+
+        weaver.setformat(Formatter=PwebMintedPandocFormatter)
+
+        processor = None
+        group_processor = None
+        if connection_file is not None:
+            from pweave import PwebProcessors
+            processor = connected_processor(kernel, connection_file)
+            group_processor = PwebProcessors.getprocessor(kernel)
+
+        # `Pweb.weave` runs the code with the default processor.
+        if stream:
+            weaver.weave = partial(stream_weave, weaver,
+                                   Processor=processor,
+                                   incremental=incremental or docmode,
+                                   groups=groups,
+                                   GroupProcessor=group_processor)
+        elif incremental or docmode:
+            weaver.run = partial(incremental_run, weaver,
+                                 Processor=processor)
+        elif groups:
+            weaver.run = partial(grouped_run, weaver, Processor=processor,
+                                 GroupProcessor=group_processor)
+        elif processor is not None:
+            weaver.run = partial(weaver.run, Processor=processor)
+
+        try:
+            weave_retry_cache(weaver)
+        finally:
+            result['discarded'] = weaver.discarded_chunks
+
+        if processor is not None:
+            result['kernel_ready_seconds'] = processor.kernel_ready_seconds
+    except Exception:
+        result['output'] = None
+        result['error'] = traceback.format_exc()
+    finally:
+        if claimed:
+            release_kernel(connection_file)
+
+    result['seconds'] = time.perf_counter() - start_time
+
+    return result
+
+
+def weave_documents(sources, output=None, figdir='figures', jobs=None,
+                    **kwargs):
+    r''' Weave many documents concurrently, each in a worker process with
+    its own kernel.
+
+    Parameters
+    ==========
+    sources: list of str
+        The source documents.
+    output: str (Optional)
+        Output file template (see `document_paths`).
+    figdir: str (Optional)
+        Figure directory template (see `document_paths`).
+    jobs: int (Optional)
+        Number of worker processes (and kernels).  Defaults to the number
+        of CPUs.
+    kwargs: dict
+        Remaining `weave_document` arguments.
+
+    Returns
+    =======
+    The `weave_document` results, in the order of `sources`.
+
+    Raises
+    ======
+    ValueError
+        When two documents have the same output file or figure directory,
+        since their workers would write over each other.
+    '''
+    outputs = dict()
+    figdirs = dict()
+    for source in sources:
+        doc_output, doc_figdir = document_paths(source, output, figdir)
+        # The figure directory is relative to the output file's directory.
+        doc_figdir = os.path.join(os.path.dirname(doc_output), doc_figdir)
+
+        for kind, paths, path in (('output file', outputs, doc_output),
+                                  ('figure directory', figdirs, doc_figdir)):
+            path = os.path.normcase(os.path.abspath(path))
+            if path in paths:
+                raise ValueError(
+                    "{} and {} have the same {} {}; use the fields {{name}} "
+                    "or {{dir}} to separate them".format(
+                        paths[path], source, kind, path))
+            paths[path] = source
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    jobs = max(1, min(jobs, len(sources)))
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(weave_document, source, output, figdir,
+                                   **kwargs)
+                   for source in sources]
+        return [future.result() for future in futures]
@@ -0,0 +1,323 @@
+r"""
+Watch Mode
+==========
+Rebuild a document whenever its inputs change: weave the Pweave source,
+then convert the woven output with Pandoc and the LaTeX prefilter.
+
+Only the stages whose inputs changed run: a change to the source re-weaves
+it (incrementally, see `chunk_cache`) and, if the woven output changed,
+converts it again; a change to a bibliography or a figure only converts
+it again.  The kernel stays up between rebuilds, and the prefilter runs in
+this process instead of a new `PynowebFilter` process per conversion.
+
+Changes are found by polling modification times, and a burst of writes
+(e.g. an editor's save) results in one rebuild once the files have been
+quiet for `debounce` seconds.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import traceback
+
+import pypandoc
+
+from .pandoc_utils import LatexFilter
+
+watch_logger = logging.getLogger('watch')
+watch_logger.addHandler(logging.NullHandler())
+
+r""" Pandoc output formats by output file extension, for the extensions
+that aren't format names.
+"""
+pandoc_formats = {'md': 'markdown', 'tex': 'latex', 'htm': 'html'}
+
+
+def file_signature(path):
+    r''' A value that changes whenever the file (or the list of files in the
+    directory) at `path` changes, or `None` when it doesn't exist.
+    '''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    if not os.path.isdir(path):
+        return (stat.st_mtime_ns, stat.st_size)
+
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                entry_stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((entry.name, entry_stat.st_mtime_ns,
+                            entry_stat.st_size))
+
+    return tuple(sorted(entries))
+
+
+class Watcher(object):
+    r""" Polls files and directories for changes.
+
+    Parameters
+    ==========
+    paths: list of str
+        The files and directories to watch.  For directories, the files
+        directly in them are watched.
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.signatures = dict((p, file_signature(p)) for p in self.paths)
+
+    def changes(self):
+        r''' The paths that changed since the last call.
+        '''
+        changed = set()
+        for path in self.paths:
+            signature = file_signature(path)
+            if signature != self.signatures[path]:
+                self.signatures[path] = signature
+                changed.add(path)
+        return changed
+
+    def refresh(self, paths):
+        r''' Take the current state of `paths` as unchanged, e.g. after
+        writing to them ourselves.
+        '''
+        for path in paths:
+            self.signatures[path] = file_signature(path)
+
+    def wait(self, interval=0.2, debounce=0.3, timeout=None):
+        r''' Wait for changes, and then until there are no more changes for
+        `debounce` seconds.
+
+        Returns
+        =======
+        The changed paths; an empty set when `timeout` seconds pass without
+        changes.
+        '''
+        start_time = time.monotonic()
+        changed = set()
+        while not changed:
+            if timeout is not None and time.monotonic() - start_time > timeout:
+                return changed
+            time.sleep(interval)
+            changed = self.changes()
+
+        quiet_since = time.monotonic()
+        while time.monotonic() - quiet_since < debounce:
+            time.sleep(min(interval, debounce))
+            more_changed = self.changes()
+            if more_changed:
+                changed |= more_changed
+                quiet_since = time.monotonic()
+
+        return changed
+
+
+def file_hash(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+class WatchBuild(object):
+    r""" Weave and convert a document whenever its inputs change.
+
+    Parameters
+    ==========
+    source: str
+        The Pweave source document.
+    weave_kwargs: dict (Optional)
+        Arguments for `utils.weave_document`.
+    pandoc_output: str (Optional)
+        The file to convert the woven output to.  Without it, the document
+        is only woven.
+    pandoc_to: str (Optional)
+        The Pandoc output format.  Defaults to one based on
+        `pandoc_output`'s extension.
+    pandoc_args: list of str (Optional)
+        More Pandoc arguments for the conversion.
+    bibliographies: list of str (Optional)
+        Bibliography files; they're passed to Pandoc and watched.
+    watch_paths: list of str (Optional)
+        More files or directories (e.g. figure directories) whose changes
+        trigger a conversion.
+    """
+
+    def __init__(self, source, weave_kwargs=None, pandoc_output=None,
+                 pandoc_to=None, pandoc_args=(), bibliographies=(),
+                 watch_paths=()):
+        from .utils import document_paths
+
+        self.source = source
+        self.weave_kwargs = dict(weave_kwargs or {})
+        self.weave_kwargs['incremental'] = True
+
+        self.woven_output, figdir = document_paths(
+            source, self.weave_kwargs.get('output', None),
+            self.weave_kwargs.get('figdir', 'figures'))
+        self.weave_kwargs['output'] = self.woven_output
+
+        self.pandoc_output = pandoc_output
+        if pandoc_to is None and pandoc_output is not None:
+            ext = os.path.splitext(pandoc_output)[1][1:]
+            pandoc_to = pandoc_formats.get(ext, ext)
+        self.pandoc_to = pandoc_to
+        self.pandoc_args = list(pandoc_args)
+        self.bibliographies = list(bibliographies)
+
+        self.fig_path = os.path.join(os.path.dirname(self.woven_output),
+                                     figdir)
+        self.convert_inputs = (self.bibliographies + list(watch_paths) +
+                               [self.fig_path])
+
+        self.woven_hash = None
+        self.daemon = None
+
+    def stages(self, changed):
+        r''' The stages (`'weave'` and/or `'convert'`) to run for the
+        changed paths.
+        '''
+        stages = []
+        if self.source in changed:
+            stages.append('weave')
+        if self.pandoc_output is not None and (
+                stages or any(p in changed for p in self.convert_inputs)):
+            stages.append('convert')
+        return stages
+
+    def start_kernel(self):
+        r''' Start the kernel that's kept between rebuilds.
+        '''
+        from .kernel_daemon import KernelDaemon, claim_kernel
+
+        kernel = self.weave_kwargs.get('kernel', 'python3')
+        self.pool_dir = tempfile.mkdtemp(prefix='pynoweb_watch_')
+        self.daemon = KernelDaemon({kernel: 1}, pool_dir=self.pool_dir)
+        self.daemon.start()
+        self.weave_kwargs['kernel_connection'] = claim_kernel(kernel,
+                                                              self.pool_dir)
+
+    def stop_kernel(self):
+        if self.daemon is not None:
+            self.daemon.stop()
+            self.daemon = None
+
+    def weave(self):
+        from .utils import weave_document
+
+        if self.daemon is not None and self.daemon.check_health():
+            # The kernel died and was replaced.
+            from .kernel_daemon import claim_kernel
+            self.weave_kwargs['kernel_connection'] = claim_kernel(
+                self.weave_kwargs.get('kernel', 'python3'), self.pool_dir)
+
+        return weave_document(self.source, **self.weave_kwargs)
+
+    def pandoc_from(self):
+        r''' The Pandoc input format of the woven output, with its raw LaTeX
+        kept for the prefilter--the same `raw_tex` reader extension as the
+        nested conversions (see `pandoc_utils.nested_pandoc_format`).
+        '''
+        ext = os.path.splitext(self.woven_output)[1][1:]
+        return pandoc_formats.get(ext, ext) + '+raw_tex'
+
+    def convert_args(self):
+        r''' The Pandoc arguments of the conversion to `pandoc_to`.
+        '''
+        extra_args = list(self.pandoc_args)
+        for bibliography in self.bibliographies:
+            extra_args.append('--bibliography={}'.format(bibliography))
+        return extra_args
+
+    def convert(self):
+        r''' Convert the woven output with Pandoc and the LaTeX prefilter.
+        '''
+        # The nested conversions' other arguments (see
+        # `pandoc_utils.nested_pandoc_args`) are only for environment bodies.
+        ast_json = pypandoc.convert_file(self.woven_output, 'json',
+                                         format=self.pandoc_from())
+
+        doc = LatexFilter(source=self.woven_output).apply(
+            json.loads(ast_json), self.pandoc_to)
+
+        pypandoc.convert_text(json.dumps(doc), self.pandoc_to,
+                              format='json', outputfile=self.pandoc_output,
+                              extra_args=self.convert_args())
+
+    def build(self, changed):
+        r''' Run the stages for the changed paths.
+
+        Returns
+        =======
+        A dict with the `stages` that ran, the wall time in `seconds` and,
+        when a stage failed, the `error`.
+        '''
+        stages = self.stages(changed)
+        result = {'stages': [], 'seconds': None, 'error': None}
+
+        start_time = time.perf_counter()
+        try:
+            if 'weave' in stages:
+                result['stages'].append('weave')
+                weave_result = self.weave()
+                if weave_result['error'] is not None:
+                    result['error'] = weave_result['error']
+                    return result
+
+                # Nothing to convert when the woven output didn't change.
+                woven_hash = file_hash(self.woven_output)
+                if ('convert' in stages and woven_hash == self.woven_hash and
+                        not any(p in changed for p in self.convert_inputs)):
+                    stages.remove('convert')
+                self.woven_hash = woven_hash
+
+            if 'convert' in stages:
+                result['stages'].append('convert')
+                self.convert()
+        except Exception:
+            result['error'] = traceback.format_exc()
+        finally:
+            result['seconds'] = time.perf_counter() - start_time
+
+        return result
+
+    def run(self, interval=0.2, debounce=0.3, report=sys.stdout):
+        r''' Build the document, then rebuild it on changes until
+        interrupted.
+        '''
+        watcher = Watcher([self.source] + self.convert_inputs)
+
+        self.start_kernel()
+        try:
+            changed = set([self.source])
+            while True:
+                result = self.build(changed)
+                if result['error'] is not None:
+                    report.write(result['error'] + '\n')
+                report.write("{} in {:.3f}s\n".format(
+                    ', '.join(result['stages']) or 'nothing to rebuild',
+                    result['seconds']))
+                report.flush()
+
+                # The weave writes the figures, and they're already in the
+                # conversion that followed it.
+                if 'weave' in result['stages']:
+                    watcher.refresh([self.fig_path])
+
+                changed = watcher.wait(interval=interval, debounce=debounce)
+                watch_logger.info("Changed: {}\n".format(
+                    ', '.join(sorted(changed))))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop_kernel()
@@ -40,6 +40,8 @@ setup(name='pynoweb_tools',
       entry_points={
           'console_scripts':
               ['PynowebWeave = pynoweb_tools.scripts:weave',
-               'PynowebFilter = pynoweb_tools.scripts:latex_json_filter'
+               'PynowebFilter = pynoweb_tools.scripts:latex_json_filter',
+               'PynowebPandocServer = pynoweb_tools.pandoc_server:serve',
+               'PynowebKernelDaemon = pynoweb_tools.kernel_daemon:serve'
                ]},
       )
@@ -0,0 +1,56 @@
+import io
+import json
+
+from pandocfilters import walk, Para, Str, Space, RawInline, Math, Header
+
+from pynoweb_tools.ast_stream import iter_document, stream_filter
+from pynoweb_tools.pandoc_utils import (latex_prefilter,
+                                        apply_latex_prefilter_blocks)
+
+
+def make_doc():
+    blocks = [Header(1, ['intro', [], []], [Str('Intro')])]
+    blocks += [Para([Str(u'Caf\xe9'), Space(),
+                     RawInline('latex', '\\cref{eq:%d}' % i),
+                     Space(), Math({'t': 'InlineMath', 'c': []}, 'x^%d' % i)])
+               for i in range(20)]
+    return {'pandoc-api-version': [1, 17, 0, 5],
+            'meta': {'title': {'t': 'MetaInlines', 'c': [Str('Title')]}},
+            'blocks': blocks}
+
+
+def test_iter_document():
+    doc = make_doc()
+    entries = list(iter_document(io.StringIO(json.dumps(doc)),
+                                 chunk_size=7))
+
+    assert entries[0] == ('pandoc-api-version', [1, 17, 0, 5])
+    assert entries[1] == ('meta', doc['meta'])
+    assert entries[2] == ('blocks', None)
+    assert [v for k, v in entries if k == 'block'] == doc['blocks']
+    assert entries[-1] == ('end_blocks', None)
+
+
+def test_stream_filter():
+    doc = make_doc()
+    meta = doc['meta']
+
+    expected = walk(json.loads(json.dumps(doc)), latex_prefilter,
+                    'html', meta)
+
+    def filter_blocks(blocks, meta):
+        return apply_latex_prefilter_blocks(blocks, 'html', meta)
+
+    output_stream = io.StringIO()
+    stream_filter(filter_blocks, io.StringIO(json.dumps(doc)),
+                  output_stream, chunk_size=13)
+
+    assert json.loads(output_stream.getvalue()) == expected
+
+    # Blocks that come before the meta data still work.
+    reordered = json.dumps({'blocks': doc['blocks'], 'meta': meta,
+                            'pandoc-api-version': [1, 17, 0, 5]})
+    output_stream = io.StringIO()
+    stream_filter(filter_blocks, io.StringIO(reordered), output_stream)
+
+    assert json.loads(output_stream.getvalue()) == expected
@@ -0,0 +1,73 @@
+import os
+import time
+
+from pynoweb_tools.cache import DiskCache, default_cache_dir
+
+
+def test_disk_cache(tmp_path):
+    cache = DiskCache(str(tmp_path))
+
+    key = DiskCache.key('body', '1.19.2', ['-s'])
+    assert key == DiskCache.key('body', '1.19.2', ['-s'])
+    assert key != DiskCache.key('body', '2.0', ['-s'])
+
+    assert cache.get(key) is None
+    cache.set(key, {'blocks': []})
+    assert cache.get(key) == {'blocks': []}
+
+    assert cache.stats == {'hits': 1, 'misses': 1, 'writes': 1,
+                           'evictions': 0}
+
+
+def test_disk_cache_lru(tmp_path):
+    value = 'x' * 100
+    cache = DiskCache(str(tmp_path), max_size=350)
+
+    keys = [DiskCache.key(i) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.set(key, value)
+        # Give each entry a distinct last-use time.
+        os.utime(cache._path(key), (time.time() - 10 + i,) * 2)
+
+    # Use the oldest entry, so that the second one is evicted instead.
+    assert cache.get(keys[0]) == value
+
+    cache.set(DiskCache.key(3), value)
+
+    assert cache.stats['evictions'] == 1
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == value
+    assert cache.size() <= 350
+
+
+def test_disk_cache_size(monkeypatch, tmp_path):
+    value = 'x' * 100
+    cache = DiskCache(str(tmp_path), max_size=350)
+    key = DiskCache.key(0)
+
+    # Overwriting an entry doesn't add to the size.
+    for _ in range(5):
+        cache.set(key, value)
+    entry_size = os.path.getsize(cache._path(key))
+    assert cache.size() == entry_size
+    assert cache.stats['evictions'] == 0
+
+    # Another process gets the size without listing the entries...
+    other_cache = DiskCache(str(tmp_path), max_size=350)
+    monkeypatch.setattr(DiskCache, '_entries', None)
+    other_cache.set(DiskCache.key(1), value)
+    assert other_cache.size() == 2 * entry_size
+    monkeypatch.undo()
+
+    # ...until it's recounted.
+    monkeypatch.setattr('pynoweb_tools.cache.size_recount_writes', 0)
+    os.unlink(cache._path(key))
+    cache.set(DiskCache.key(2), value)
+    assert cache.size() == 2 * entry_size
+
+
+def test_default_cache_dir():
+    assert default_cache_dir({'PYNOWEB_CACHE_DIR': ''}) is None
+    assert default_cache_dir({'PYNOWEB_CACHE_DIR': '/tmp/x'}) == '/tmp/x'
+    assert default_cache_dir({'XDG_CACHE_HOME': '/tmp/c'}) == \
+        os.path.join('/tmp/c', 'pynoweb_tools')
@@ -0,0 +1,245 @@
+'''
+Tests for incremental weaving.  The kernel is replaced with a processor
+that runs the code in a Python namespace.
+'''
+import io
+import contextlib
+
+from pweave import Pweb
+from pweave.processors.base import PwebProcessorBase
+
+from pynoweb_tools.chunk_cache import (chunk_dependencies, code_names,
+                                       incremental_run)
+
+
+class NamespaceProcessor(PwebProcessorBase):
+    runs = []
+
+    def __init__(self, *args):
+        super(NamespaceProcessor, self).__init__(*args)
+        self.ns = {'__name__': '__main__'}
+
+    def loadstring(self, code, chunk=None):
+        if chunk is not None:
+            self.runs.append(chunk['content'].strip())
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            exec(code, self.ns)
+        return [{'output_type': 'stream', 'name': 'stdout',
+                 'text': out.getvalue()}]
+
+
+def weave(source_path, text):
+    source_path.write_text(text)
+    NamespaceProcessor.runs = []
+    weaver = Pweb(str(source_path), doctype='tex', kernel='python3')
+    incremental_run(weaver, Processor=NamespaceProcessor)
+    outputs = [c['result'][0]['text'] for c in weaver.executed
+               if c['type'] == 'code']
+    return NamespaceProcessor.runs, outputs
+
+
+doc = '''Some text.
+
+<<name='a'>>=
+x = 1
+print(x)
+@
+
+<<name='b'>>=
+y = x + 1
+print(y)
+@
+
+<<name='c'>>=
+print(x + y)
+@
+
+<<name='d', depends='a'>>=
+print(x * 10)
+@
+'''
+
+
+def test_incremental_run(tmp_path):
+    source_path = tmp_path / 'doc.texw'
+
+    runs, outputs = weave(source_path, doc)
+    assert len(runs) == 4
+    assert outputs == ['1\n', '2\n', '3\n', '10\n']
+
+    # Nothing changed, so nothing runs.
+    runs, outputs = weave(source_path, doc)
+    assert runs == []
+    assert outputs == ['1\n', '2\n', '3\n', '10\n']
+
+    # Prose edits don't run anything either.
+    runs, outputs = weave(source_path, doc.replace('Some', 'Other'))
+    assert runs == []
+
+    # Only the changed chunk runs; the state from the chunks before it is
+    # restored, and `d` only depends on `a`.
+    runs, outputs = weave(source_path, doc.replace('x + y', 'x * y'))
+    assert runs == ['print(x * y)']
+    assert outputs == ['1\n', '2\n', '2\n', '10\n']
+
+    # A chunk that only depends on `a` isn't affected by `b`.
+    runs, outputs = weave(source_path, doc.replace('x + 1', 'x + 2'))
+    assert runs == ['y = x + 2\nprint(y)', 'print(x + y)']
+    assert outputs == ['1\n', '3\n', '4\n', '10\n']
+
+
+def test_unrestorable_state(tmp_path):
+    source_path = tmp_path / 'doc.texw'
+    fn_doc = doc.replace('y = x + 1', 'def f():\n    return x + 1\ny = f()')
+
+    weave(source_path, fn_doc)
+
+    # Functions defined in the kernel can't be restored, so their chunk
+    # runs again.
+    runs, outputs = weave(source_path, fn_doc.replace('x + y', 'x * y'))
+    assert runs[0].startswith('def f')
+    assert outputs == ['1\n', '2\n', '2\n', '10\n']
+
+
+def test_dependency_chain(tmp_path):
+    source_path = tmp_path / 'doc.texw'
+    chain_doc = """
+<<name='setup', depends=''>>=
+import math
+x = 1
+@
+
+<<name='data', depends='setup'>>=
+y = x + 1
+@
+
+<<name='plot', depends='data'>>=
+print(math.sqrt(x + y))
+@
+"""
+
+    weave(source_path, chain_doc)
+
+    # `plot` needs `math` from `setup`, which `data` doesn't touch, so both
+    # are restored.
+    runs, outputs = weave(source_path, chain_doc.replace('x + y', 'x * y'))
+    assert runs == ['print(math.sqrt(x * y))']
+    assert outputs == ['', '', '1.4142135623730951\n']
+
+
+def test_process_state(tmp_path):
+    source_path = tmp_path / 'doc.texw'
+    seed_doc = """
+<<name='seed'>>=
+import random
+random.seed(0)
+@
+
+<<name='draw'>>=
+x = 1
+@
+
+<<name='show'>>=
+print(round(random.random(), 6) + x)
+@
+"""
+
+    _, full_outputs = weave(source_path, seed_doc)
+
+    # The seed isn't in the kernel namespace, so a chunk that uses a module
+    # (without declaring `depends`) runs again instead of being restored.
+    runs, outputs = weave(source_path, seed_doc.replace('+ x', '+ 1 * x'))
+    assert runs == ['import random\nrandom.seed(0)',
+                    'print(round(random.random(), 6) + 1 * x)']
+    assert outputs == full_outputs
+
+
+def test_star_import(tmp_path):
+    source_path = tmp_path / 'doc.texw'
+    star_doc = doc.replace('x = 1', 'from math import *\nx = 1').replace(
+        'print(x + y)', 'print(floor(x + y))')
+
+    weave(source_path, star_doc)
+
+    # The names a star import binds can't be listed, so its chunk runs
+    # again.
+    runs, outputs = weave(source_path, star_doc.replace('x + y', 'x * y'))
+    assert runs == ['from math import *\nx = 1\nprint(x)',
+                    'print(floor(x * y))']
+    assert outputs == ['1\n', '2\n', '2\n', '10\n']
+
+
+def test_chunk_dependencies():
+    parsed = [{'type': 'doc', 'content': 'text'},
+              {'type': 'code', 'content': 'x = 1', 'options': {'name': 'a'}},
+              {'type': 'doc', 'content': 'x is <%= x %>'},
+              {'type': 'code', 'content': 'y = 2',
+               'options': {'depends': ''}},
+              {'type': 'code', 'content': 'z = 3',
+               'options': {'depends': 'a, missing'}}]
+
+    assert chunk_dependencies(parsed) == {1: [], 2: [1], 3: [], 4: [1, 2, 3]}
+
+    assert code_names('%matplotlib inline\nimport numpy as np\n'
+                      'def f(a):\n    return np.sum(a)') == \
+        ['a', 'f', 'np']
+    assert code_names('from os.path import *') is None
+    assert code_names('globals()["x"] = 1') is None
+    assert code_names('%run setup.py') is None
+
+
+def test_cache_validation(tmp_path):
+    from pynoweb_tools.chunk_cache import ChunkCache
+
+    source_path = tmp_path / 'doc.texw'
+    weave(source_path, doc)
+
+    cache = ChunkCache.for_source(str(source_path)).load()
+    keys = sorted(cache.entries.keys(),
+                  key=lambda k: cache.results(k)[0]['number'])
+
+    # Corrupt the entry for `c`.
+    cache.entries[keys[2]]['count'] = 2
+    cache.save(keys)
+
+    runs, outputs = weave(source_path, doc)
+    assert runs == ['print(x + y)']
+    assert outputs == ['1\n', '2\n', '3\n', '10\n']
+
+    # A cache file in another format is discarded, and reported, as a whole.
+    with open(cache.path, 'wb') as f:
+        f.write(b'not a pickle')
+
+    weaver = Pweb(str(source_path), doctype='tex', kernel='python3')
+    incremental_run(weaver, Processor=NamespaceProcessor)
+    assert [d['name'] for d in weaver.discarded_chunks] == \
+        ['a', 'b', 'c', 'd']
+    assert weaver.discarded_chunks[0]['reason'].startswith(
+        'unreadable cache file')
+
+
+def test_weave_retry_cache(tmp_path):
+    from functools import partial
+    from pynoweb_tools.utils import weave_retry_cache
+
+    source_path = tmp_path / 'doc.texw'
+    weave(source_path, doc)
+
+    results_path = tmp_path / 'cache' / 'doc.pkl'
+    results_path.write_bytes(b'stale results')
+
+    def stale_run(Processor=None):
+        raise IndexError('list index out of range')
+
+    NamespaceProcessor.runs = []
+    weaver = Pweb(str(source_path), doctype='tex', kernel='python3')
+    weaver.run = partial(stale_run, Processor=NamespaceProcessor)
+    weave_retry_cache(weaver)
+
+    # Only the documentation mode results are discarded; the chunk results
+    # are reused.
+    assert not results_path.exists()
+    assert NamespaceProcessor.runs == []
+    assert len(weaver.discarded_chunks) == 1
+    assert (tmp_path / 'doc.tex').exists()
@@ -0,0 +1,115 @@
+'''
+Tests for running chunk groups concurrently.  The kernels are replaced
+with processors that run the code in their own Python namespaces.
+'''
+import io
+import time
+from functools import partial
+
+from pweave import Pweb
+from pweave.processors.base import PwebProcessorBase
+
+from pynoweb_tools.chunk_cache import chunk_dependencies
+from pynoweb_tools.chunk_groups import group_chunks, grouped_run
+
+
+class NamespaceProcessor(PwebProcessorBase):
+    instances = 0
+
+    def __init__(self, *args):
+        super(NamespaceProcessor, self).__init__(*args)
+        self.ns = {}
+        NamespaceProcessor.instances += 1
+
+    def loadstring(self, code, chunk=None):
+        # `redirect_stdout` isn't thread-safe.
+        out = io.StringIO()
+        self.ns['print'] = partial(print, file=out)
+        try:
+            exec(code, self.ns)
+        except NameError as e:
+            print(e, file=out)
+        return [{'output_type': 'stream', 'name': 'stdout',
+                 'text': out.getvalue()}]
+
+
+doc = '''Setup.
+
+<<name='setup'>>=
+n = 1
+print(n)
+@
+
+<<name='a1', group='a'>>=
+import time
+time.sleep(0.4)
+a = 10
+print(a)
+@
+
+<<name='b1', group='b'>>=
+import time
+time.sleep(0.4)
+print(n)
+@
+
+<<name='a2', group='a'>>=
+print(a + 1)
+@
+
+Done.
+'''
+
+
+def test_group_chunks(tmp_path):
+    source_path = tmp_path / 'doc.texw'
+    source_path.write_text(doc)
+    weaver = Pweb(str(source_path), doctype='tex', kernel='python3')
+
+    groups = group_chunks(weaver.parsed)
+    names = dict((g, [weaver.parsed[i].get('options', {}).get('name')
+                      for i in indices]) for g, indices in groups.items())
+
+    assert names['a'] == ['a1', 'a2']
+    assert names['b'] == ['b1']
+    assert 'setup' in names[None]
+
+    # By default, chunks only depend on the chunks before them in their
+    # group.
+    deps = chunk_dependencies(weaver.parsed)
+    index = dict((c.get('options', {}).get('name'), i)
+                 for i, c in enumerate(weaver.parsed))
+    assert deps[index['a2']] == [index['a1']]
+    assert deps[index['b1']] == []
+
+
+def test_grouped_run(tmp_path):
+    source_path = tmp_path / 'doc.texw'
+    source_path.write_text(doc)
+    weaver = Pweb(str(source_path), doctype='tex', kernel='python3')
+
+    NamespaceProcessor.instances = 0
+
+    start_time = time.perf_counter()
+    grouped_run(weaver, Processor=NamespaceProcessor)
+    elapsed = time.perf_counter() - start_time
+
+    # The groups ran concurrently, each with its own processor.
+    assert NamespaceProcessor.instances == 3
+    assert elapsed < 0.75
+
+    outputs = [c['result'][0]['text'] for c in weaver.executed
+               if c['type'] == 'code']
+
+    # The results are in document order, and group `b` doesn't see the
+    # main group's state.
+    assert outputs == ['1\n', '10\n', "name 'n' is not defined\n", '11\n']
+    assert weaver.executed[0]['content'].startswith('Setup.')
+    assert weaver.executed[-1]['content'].strip() == 'Done.'
+
+    # The same chunks are handed over in order as they're ready.
+    executed = weaver.executed
+    streamed = []
+    grouped_run(weaver, Processor=NamespaceProcessor,
+                on_chunk=streamed.append)
+    assert [c for cs in streamed for c in cs] == executed
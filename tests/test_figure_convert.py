@@ -0,0 +1,132 @@
+'''
+Tests for figure conversion.  The converter is a Python one-liner that
+upper-cases the source file.
+'''
+import os
+import sys
+import json
+
+from pandocfilters import Para, Image, RawInline
+
+import pynoweb_tools.pandoc_utils
+from pynoweb_tools.cache import DiskCache
+from pynoweb_tools.figures import FigureIndex
+from pynoweb_tools.pandoc_utils import rename_find_fig
+from pynoweb_tools.figure_convert import (FigureConverter,
+                                          convert_figures_enabled,
+                                          figure_references, figure_targets)
+
+upper_script = ("import sys; open(sys.argv[2], 'w').write("
+                "open(sys.argv[1]).read().upper())")
+
+converters = [('pdf', 'png', [sys.executable, '-c', upper_script,
+                              '{source}', '{target}'])]
+
+
+def make_blocks():
+    return [Para([Image(['', [], []], [], ['first.pdf', '']),
+                  RawInline('latex', '\\graphicspath{{extra/}}'),
+                  RawInline('latex', '\\includegraphics{second}'),
+                  RawInline('latex', '\\includegraphics[width=1in]{first}')])]
+
+
+def test_figure_references(tmp_path):
+    names, dirs = figure_references(make_blocks())
+    assert names == ['first.pdf', 'second', 'first']
+    assert dirs == set(['extra/'])
+
+    fig_dir = tmp_path / 'figures'
+    fig_dir.mkdir()
+    (fig_dir / 'first.pdf').write_text('a')
+    (fig_dir / 'second.pdf').write_text('b')
+    (fig_dir / 'third.png').write_text('c')
+
+    pairs = figure_targets(['first', 'second.pdf', 'third', 'missing'],
+                           [str(fig_dir)], 'png',
+                           index=FigureIndex(refresh_interval=0))
+    assert pairs == [(str(fig_dir / 'first.pdf'), str(fig_dir / 'first.png')),
+                     (str(fig_dir / 'second.pdf'),
+                      str(fig_dir / 'second.png'))]
+
+
+def test_figure_targets_figure_dir(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    index = FigureIndex(refresh_interval=0)
+
+    fig_dir = tmp_path / 'figures'
+    fig_dir.mkdir()
+    (tmp_path / 'plot.pdf').write_text('a')
+    (tmp_path / 'other.pdf').write_text('b')
+    (fig_dir / 'other.pdf').write_text('c')
+
+    # The targets are where the prefilter renames the figures to, i.e. in
+    # `figure_dir`, even when the figure names exist relative to the
+    # working directory.  Sources in `figure_dir` are preferred.
+    pairs = figure_targets(['plot.pdf', 'other.pdf'], [str(fig_dir)], 'png',
+                           index=index)
+    assert pairs == [('plot.pdf', str(fig_dir / 'plot.png')),
+                     (str(fig_dir / 'other.pdf'), str(fig_dir / 'other.png'))]
+    assert [t for _, t in pairs] == [
+        rename_find_fig(n, [str(fig_dir)], 'png', index=index)
+        for n in ('plot.pdf', 'other.pdf')]
+
+
+def test_figure_converter(tmp_path):
+    source = tmp_path / 'plot.pdf'
+    target = tmp_path / 'plot.png'
+    source.write_text('plot')
+
+    cache = DiskCache(str(tmp_path / 'cache'))
+    converter = FigureConverter(converters, cache=cache, workers=2)
+
+    assert converter.convert_all([(str(source), str(target))])[0][
+        'status'] == 'converted'
+    assert target.read_text() == 'PLOT'
+
+    # Up to date.
+    assert converter.convert(str(source), str(target))['status'] == 'current'
+
+    # Touched, but unchanged: the conversion comes from the cache.
+    os.utime(str(target), (0, 0))
+    assert converter.convert(str(source), str(target))['status'] == 'cached'
+    assert target.read_text() == 'PLOT'
+
+    # Changed.
+    source.write_text('new plot')
+    os.utime(str(target), (0, 0))
+    assert converter.convert(str(source), str(target))['status'] == \
+        'converted'
+    assert target.read_text() == 'NEW PLOT'
+
+    result = converter.convert(str(tmp_path / 'plot.eps'),
+                               str(tmp_path / 'other.png'))
+    assert result['status'] == 'failed'
+
+    assert converter.stats == {'current': 1, 'cached': 1, 'converted': 2,
+                               'failed': 1}
+
+
+def test_latex_filter_convert_figures(monkeypatch, tmp_path):
+    monkeypatch.delenv('PYNOWEB_CONVERT_FIGURES', raising=False)
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils, 'figure_converter',
+                        FigureConverter(converters, cache=False))
+
+    assert not convert_figures_enabled({})
+    assert convert_figures_enabled({}, {'PYNOWEB_CONVERT_FIGURES': '1'})
+
+    fig_dir = tmp_path / 'figures'
+    fig_dir.mkdir()
+    (fig_dir / 'first.pdf').write_text('first')
+    (fig_dir / 'second.pdf').write_text('second')
+
+    doc = {'pandoc-api-version': [1, 17, 0, 5],
+           'meta': {'figure_dir': {'t': 'MetaString', 'c': str(fig_dir)},
+                    'figure_ext': {'t': 'MetaString', 'c': 'png'},
+                    'convert_figures': {'t': 'MetaBool', 'c': True}},
+           'blocks': make_blocks()}
+
+    doc = pynoweb_tools.pandoc_utils.LatexFilter().apply(doc, 'html')
+
+    assert (fig_dir / 'first.png').read_text() == 'FIRST'
+    assert (fig_dir / 'second.png').read_text() == 'SECOND'
+    assert str(fig_dir / 'first.png') in json.dumps(doc)
@@ -0,0 +1,91 @@
+'''
+Tests for the figure index and figure file lookup.
+'''
+import os
+
+from pynoweb_tools.figures import FigureIndex
+from pynoweb_tools.pandoc_utils import rename_find_fig
+
+
+def test_figure_index(tmp_path):
+    first_dir = tmp_path / 'first'
+    second_dir = tmp_path / 'second'
+    first_dir.mkdir()
+    second_dir.mkdir()
+
+    (first_dir / 'a.pdf').write_text('')
+    (second_dir / 'a.png').write_text('')
+    (second_dir / 'b.png').write_text('')
+
+    index = FigureIndex(refresh_interval=0)
+    fig_dirs = [str(first_dir), str(second_dir)]
+
+    assert rename_find_fig('figs/b.pdf', fig_dirs, 'png', index=index) == \
+        os.path.join(str(second_dir), 'b.png')
+
+    # The first directory with any of the extensions wins, and within it,
+    # the preferred extension.
+    assert rename_find_fig('a', fig_dirs, ['pdf', 'png'], index=index) == \
+        os.path.join(str(first_dir), 'a.pdf')
+    assert rename_find_fig('a', fig_dirs, ['png', 'pdf'], index=index) == \
+        os.path.join(str(first_dir), 'a.pdf')
+    assert rename_find_fig('a', [str(second_dir)], ['pdf', 'png'],
+                           index=index) == \
+        os.path.join(str(second_dir), 'a.png')
+
+    # Missing figures keep their new name, after the directories are
+    # listed again.
+    assert rename_find_fig('c.pdf', fig_dirs, 'png', index=index) == 'c.png'
+    assert index.stats['scans'] == 4
+
+    # Each directory is only listed once...
+    for _ in range(10):
+        rename_find_fig('b', fig_dirs, 'png', index=index)
+    assert index.stats['scans'] == 4
+
+    # ...until it changes.
+    (first_dir / 'b.png').write_text('')
+    os.utime(str(first_dir), ns=(0, 0))
+    assert rename_find_fig('b', [str(first_dir)], ['png', 'pdf'],
+                           index=index) == \
+        os.path.join(str(first_dir), 'b.png')
+    assert index.stats['scans'] == 5
+
+    # A file written within the resolution of the directory's modification
+    # time is found by listing it again.
+    (second_dir / 'd.png').write_text('')
+    os.utime(str(second_dir), ns=(0, 0))
+    index.directory(str(second_dir))
+    (second_dir / 'e.png').write_text('')
+    os.utime(str(second_dir), ns=(0, 0))
+    assert rename_find_fig('e', fig_dirs, ['png', 'pdf'], index=index) == \
+        os.path.join(str(second_dir), 'e.png')
+
+
+def test_figure_index_misses(tmp_path):
+    fig_dirs = [str(tmp_path / 'first'), str(tmp_path / 'second')]
+    for fig_dir in fig_dirs:
+        os.mkdir(fig_dir)
+
+    index = FigureIndex(refresh_interval=60)
+
+    # Missing figures don't list the directories again and again...
+    for i in range(10):
+        assert index.find_first('fig{}'.format(i), fig_dirs, ['png']) is None
+    assert index.stats['scans'] == 2
+
+    # ...and new files are found once the index is cleared.
+    with open(os.path.join(fig_dirs[1], 'fig0.png'), 'w'):
+        pass
+    index.clear()
+    assert index.find_first('fig0', fig_dirs, ['png']) == \
+        os.path.join(fig_dirs[1], 'fig0.png')
+    assert index.stats['scans'] == 4
+
+
+def test_rename_find_fig_single_dir():
+    # A single directory is used without looking for the file.
+    index = FigureIndex()
+    assert rename_find_fig('a/fig.pdf', {'figures'}, 'png',
+                           index=index) == os.path.join('figures', 'fig.png')
+    assert index.stats['scans'] == 0
@@ -0,0 +1,141 @@
+'''
+Tests for incremental filtering.  Each incremental result is compared with
+the same document filtered in full.
+'''
+import json
+
+from pandocfilters import RawBlock, Para, Str, Space, Image, Span
+
+import pynoweb_tools.pandoc_utils
+from pynoweb_tools.cache import DiskCache
+from pynoweb_tools.pandoc_utils import LatexFilter
+from pynoweb_tools.incremental import incremental_enabled
+
+
+def convert_text(source, to, format=None, extra_args=()):
+    r''' Convert text to Pandoc JSON with one `Para` per paragraph, a
+    `RawBlock` for paragraphs with environments, and a figure for
+    paragraphs like `![label](name)`.
+    '''
+    convert_text.calls += 1
+    blocks = []
+    for par in source.split('\n\n'):
+        par = par.strip()
+        if par.startswith('\\begin'):
+            blocks.append(RawBlock('latex', par))
+        elif par.startswith('!['):
+            label, fig_name = par[2:-1].split('](')
+            blocks.append(figure(fig_name, label))
+        elif par:
+            blocks.append(Para([Str(par)]))
+    return json.dumps({'pandoc-api-version': [1, 17, 0, 5], 'meta': {},
+                       'blocks': blocks})
+
+
+convert_text.calls = 0
+
+
+def env(env_name, label, body):
+    return RawBlock('latex', '\\begin{{{}}}\\label{{{}}}{}\\end{{{}}}'.format(
+        env_name, label, body, env_name))
+
+
+def figure(fig_name, label):
+    caption = [Str('A'), Space(), Str('plot'),
+               Span(['', [], [['data-label', label]]], [])]
+    return Para([Image(['', [], []], caption, [fig_name, 'fig:'])])
+
+
+def make_doc(blocks, profile_path):
+    return {'pandoc-api-version': [1, 17, 0, 5],
+            'meta': {'figure_dir': {'t': 'MetaString', 'c': 'figures'},
+                     'figure_ext': {'t': 'MetaString', 'c': 'png'},
+                     'filter_profile': {'t': 'MetaString',
+                                        'c': str(profile_path)}},
+            'blocks': blocks}
+
+
+def filter_doc(doc, store):
+    r''' Filter a copy of `doc` incrementally with `store`, or in full when
+    it's `False`.
+    '''
+    pynoweb_tools.pandoc_utils.block_store = store
+    convert_text.calls = 0
+    return LatexFilter().apply(json.loads(json.dumps(doc)))['blocks']
+
+
+def test_incremental_enabled():
+    assert not incremental_enabled({}, {})
+    assert incremental_enabled({}, {'PYNOWEB_INCREMENTAL': '1'})
+    assert incremental_enabled({'incremental': {'t': 'MetaBool',
+                                                'c': True}}, {})
+    assert not incremental_enabled({'incremental': {'t': 'MetaBool',
+                                                    'c': False}},
+                                   {'PYNOWEB_INCREMENTAL': '1'})
+
+
+def test_incremental_filter(monkeypatch, tmp_path):
+    monkeypatch.setenv('PYNOWEB_INCREMENTAL', '1')
+    monkeypatch.setenv('PYNOWEB_LATEX_FAST_PATH', '0')
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils.pypandoc,
+                        'convert_text', convert_text)
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils, 'env_cache', False)
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils, 'block_store', None)
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils,
+                        'nested_pandoc_version', '1.19.2')
+
+    store = DiskCache(str(tmp_path / 'blocks'))
+    profile_path = tmp_path / 'profile.json'
+
+    def block_counts():
+        report = json.loads(profile_path.read_text())
+        return dict((k, report['env_cache'][k])
+                    for k in ('block_hits', 'block_misses',
+                              'block_renumbered'))
+
+    blocks = [Para([Str('Intro')]),
+              env('remark', 'rem:a', 'first\n\n![fig:a](a.pdf)'),
+              figure('b.pdf', 'fig:b'),
+              env('theorem', 'thm:a',
+                  'second\n\n\\begin{remark}nested\\end{remark}'),
+              # A figure that was already processed isn't wrapped again.
+              env('remark', 'rem:b', 'third\n\n![fig:c](a.pdf)')]
+    doc = make_doc(blocks, profile_path)
+
+    full_blocks = filter_doc(doc, False)
+
+    # Only the blocks with environments are stored.
+    assert filter_doc(doc, store) == full_blocks
+    assert block_counts() == {'block_hits': 0, 'block_misses': 3,
+                              'block_renumbered': 0}
+
+    # Nothing changed, so nothing is converted or filtered.
+    assert filter_doc(doc, store) == full_blocks
+    assert convert_text.calls == 0
+    assert block_counts() == {'block_hits': 3, 'block_misses': 0,
+                              'block_renumbered': 0}
+
+    # A new environment with a figure at the start, and an edited
+    # paragraph:  only the new environment is converted, and the stored
+    # blocks after it with environments (including nested ones) and figures
+    # are renumbered.
+    doc['blocks'] = ([env('remark', 'rem:new', 'new\n\n![fig:new](new.pdf)'),
+                      Para([Str('Edited')])] + blocks[1:])
+
+    full_blocks = filter_doc(doc, False)
+
+    assert filter_doc(doc, store) == full_blocks
+    assert convert_text.calls == 1
+    assert block_counts() == {'block_hits': 3, 'block_misses': 1,
+                              'block_renumbered': 3}
+
+    # Without the first `a.pdf`, the second is processed, so its block is
+    # filtered again.  The theorem's stored numbers are right again.
+    del doc['blocks'][2]
+
+    full_blocks = filter_doc(doc, False)
+
+    assert filter_doc(doc, store) == full_blocks
+    assert convert_text.calls == 1
+    assert block_counts() == {'block_hits': 2, 'block_misses': 1,
+                              'block_renumbered': 0}
@@ -0,0 +1,66 @@
+'''
+Tests for the warm kernel pools.
+'''
+import pytest
+
+from pynoweb_tools.kernel_daemon import (KernelDaemon, claim_kernel,
+                                         release_kernel, reset_code)
+
+
+def test_claim_release(tmp_path):
+    ready_dir = tmp_path / 'python3' / 'ready'
+    claimed_dir = tmp_path / 'python3' / 'claimed'
+    ready_dir.mkdir(parents=True)
+    claimed_dir.mkdir()
+    (ready_dir / 'a.json').write_text('{}')
+
+    connection_file = claim_kernel('python3', str(tmp_path))
+    assert connection_file == str(claimed_dir / 'a.json')
+
+    # The only kernel is taken.
+    assert claim_kernel('python3', str(tmp_path)) is None
+    assert claim_kernel('ir', str(tmp_path)) is None
+
+    release_kernel(connection_file)
+    assert (ready_dir / 'a.json').exists()
+
+
+def test_kernel_daemon(tmp_path):
+    pytest.importorskip('ipykernel')
+    from jupyter_client import BlockingKernelClient
+
+    preload = tmp_path / 'preload.py'
+    preload.write_text('preloaded = 1\n')
+
+    def run(kc, code):
+        outputs = []
+
+        def output_hook(msg):
+            if msg['msg_type'] == 'stream':
+                outputs.append(msg['content']['text'])
+
+        kc.execute_interactive(code, output_hook=output_hook, timeout=30)
+        return ''.join(outputs)
+
+    pool_dir = str(tmp_path / 'pool')
+
+    with KernelDaemon({'python3': 1}, pool_dir=pool_dir,
+                      preload=str(preload)):
+        for _ in range(2):
+            connection_file = claim_kernel('python3', pool_dir)
+            assert connection_file is not None
+
+            kc = BlockingKernelClient()
+            kc.load_connection_file(connection_file)
+            kc.start_channels()
+            kc.wait_for_ready(timeout=30)
+
+            # The namespace is reset between documents, but the preload
+            # script's names are always there.
+            assert run(kc, 'print(preloaded)') == '1\n'
+            assert run(kc, "print('doc_var' in dir())") == 'False\n'
+            run(kc, 'doc_var = 2')
+
+            run(kc, reset_code(str(preload)))
+            kc.stop_channels()
+            release_kernel(connection_file)
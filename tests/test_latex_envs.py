@@ -0,0 +1,63 @@
+'''
+Tests for the LaTeX environment tokenizer.
+'''
+import time
+
+from pynoweb_tools.latex_envs import iter_latex_envs, LatexEnv
+
+
+def test_iter_latex_envs():
+    source = ('\\begin{lemma}[Title {x]}]\n  \\label{lem:1}A \\begin{lemma}'
+              'B\\label{lem:2}\\end{lemma}\\end{lemma}\n'
+              'between\n'
+              '\\begin{proof}C % \\end{proof}\n\\end{proof}')
+
+    envs = list(iter_latex_envs(source))
+
+    lemma_end = source.index('between') - 1
+    proof_start = source.index('\\begin{proof}')
+    assert envs == [
+        LatexEnv('lemma', '[Title {x]}]',
+                 'A \\begin{lemma}B\\label{lem:2}\\end{lemma}', 'lem:1',
+                 (0, lemma_end), (25, lemma_end - len('\\end{lemma}'))),
+        LatexEnv('proof', '', 'C % \\end{proof}\n', None,
+                 (proof_start, len(source)),
+                 (proof_start + len('\\begin{proof}'),
+                  len(source) - len('\\end{proof}')))]
+    assert source[slice(*envs[0].body_span)].startswith('\n  \\label')
+
+    # Verbatim bodies aren't tokenized.
+    envs = list(iter_latex_envs(
+        '\\begin{verbatim}\\end{a}\\begin{b}\\end{verbatim}'))
+    assert [(e.name, e.body) for e in envs] == [
+        ('verbatim', '\\end{a}\\begin{b}')]
+
+    # A mismatched `\end` closes the environments within its own, stray
+    # ones are ignored, and unclosed environments are text.
+    envs = list(iter_latex_envs(
+        '\\end{x}\\begin{a}\\begin{b}x\\end{a}\\end{b}'
+        '\\begin{c}\\begin{d}y\\end{d}'))
+    assert [(e.name, e.body) for e in envs] == [('a', '\\begin{b}x'),
+                                                ('d', 'y')]
+
+    assert list(iter_latex_envs('\\begin{a}[\\end{a}')) == [
+        LatexEnv('a', '', '[', None, (0, 17), (9, 10))]
+    assert list(iter_latex_envs('no environments')) == []
+
+
+def test_iter_latex_envs_linear():
+    # These made the old regular expression backtrack quadratically.
+    for source in ['\\begin{a}' * 20000,
+                   '\\begin{a}[' * 20000 + '\\end{b}',
+                   ('\\begin{a}' + 'x' * 10) * 20000 + '\\end{a}']:
+        start_time = time.perf_counter()
+        list(iter_latex_envs(source))
+        assert time.perf_counter() - start_time < 2
+
+    n = 20000
+    source = '\\begin{a}x\\end{a}' * n
+    assert len(list(iter_latex_envs(source))) == n
+
+    source = '\\begin{a}' * n + '\\end{a}' * n
+    envs = list(iter_latex_envs(source))
+    assert [e.span for e in envs] == [(0, len(source))]
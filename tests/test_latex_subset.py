@@ -0,0 +1,158 @@
+'''
+Tests for the pure-Python LaTeX subset conversion.  The conformance test
+compares it with a real Pandoc, when one is installed.
+'''
+import json
+import random
+
+import pytest
+
+from pandocfilters import (Para, Str, Space, SoftBreak, Math, Emph, RawInline,
+                           RawBlock)
+
+import pynoweb_tools.pandoc_utils
+from pynoweb_tools import latex_subset
+from pynoweb_tools.latex_subset import convert_latex_subset, fast_path_enabled
+
+subset_bodies = [
+    'If $x_1 > 0$ then \\cref{eq:1} holds for all $n$.',
+    '\nFirst paragraph,\nover two lines.\n\n  \n Second (see [1]).\n',
+    'By \\Cref{thm:a,thm:b}, \\emph{every} $\\{x_i\\}$ converges.',
+    '\\emph{a $b$}\\textit{c $d$}\\emph{}\\emph{$e$}',
+    '\\textit{a \\emph{b} $c$}d, \\eqref{eq:2}\\ref{sec:3}.',
+    'A well-known 1+1=2; e.g. a/b: c! d? <e> f* g|h @i',
+    '$ a $ and $b\nc$ or \\emph{}',
+    '',
+]
+
+outside_bodies = [
+    '$$x$$',
+    'a -- b',
+    'it\'s',
+    '``quoted\'\'',
+    'a~b',
+    '100\\% sure',
+    'a % comment',
+    '\\textbf{a}',
+    '\\emph{ a}',
+    '\\emph{a',
+    'a}',
+    '{a}',
+    '\\cref {a}',
+    '\\emph{a}\\textit{b}',
+    '$a\\$b$',
+    '$x',
+    'caf\u00e9',
+    '\\begin{proof}a\\end{proof}',
+]
+
+
+def random_body(rng, n_tokens=40):
+    pieces = []
+    for _ in range(n_tokens):
+        kind = rng.random()
+        if kind < 0.5:
+            pieces.append(rng.choice(['word', 'x', 'A.', 'e.g.', '(a)',
+                                      'b,', 'c;', 'well-known', '42']))
+        elif kind < 0.65:
+            pieces.append('$' + rng.choice(['x', 'x_1 + y', ' a ',
+                                            '\\alpha^2']) + '$')
+        elif kind < 0.75:
+            pieces.append('\\{}{{{}}}'.format(
+                rng.choice(latex_subset.ref_commands),
+                rng.choice(['eq:1', 'fig:a', 'thm:b,thm:c'])))
+        elif kind < 0.85:
+            pieces.append('\\{}{{{} $z$}}'.format(
+                rng.choice(latex_subset.emph_commands),
+                rng.choice(['some', 'more words'])))
+        else:
+            pieces.append(rng.choice(['\n', '\n\n', '  ', '\t']))
+        pieces.append(rng.choice([' ', ' ', '', '\n']))
+    return ''.join(pieces)
+
+
+def normalize(x):
+    r''' Drop the empty contents that some Pandoc versions omit.
+    '''
+    if isinstance(x, list):
+        return [normalize(i) for i in x]
+    elif isinstance(x, dict):
+        return dict((k, normalize(v)) for k, v in x.items()
+                    if not (k == 'c' and v == []))
+    return x
+
+
+def test_convert_latex_subset():
+    doc = convert_latex_subset('If $ x $ then\n\\emph{all}, '
+                               '\\cref{eq:1}.\n\nNext.')
+    assert doc['blocks'] == [
+        Para([Str('If'), Space(), Math({'t': 'InlineMath', 'c': []}, 'x'),
+              Space(), Str('then'), SoftBreak(), Emph([Str('all')]),
+              Str(','), Space(), RawInline('latex', '\\cref{eq:1}'),
+              Str('.')]),
+        Para([Str('Next.')])]
+
+    converted = latex_subset.stats['converted']
+    fallbacks = latex_subset.stats['fallbacks']
+
+    for body in outside_bodies:
+        assert convert_latex_subset(body) is None, body
+
+    assert latex_subset.stats['converted'] == converted
+    assert latex_subset.stats['fallbacks'] == fallbacks + len(outside_bodies)
+
+    assert fast_path_enabled({}, {})
+    assert not fast_path_enabled({}, {'PYNOWEB_LATEX_FAST_PATH': '0'})
+    assert not fast_path_enabled({'latex_fast_path': {'t': 'MetaBool',
+                                                      'c': False}}, {})
+
+
+def test_conformance():
+    pypandoc = pytest.importorskip('pypandoc')
+    try:
+        pypandoc.get_pandoc_version()
+    except OSError:
+        pytest.skip('Pandoc is not installed')
+
+    rng = random.Random(0)
+    bodies = subset_bodies + [random_body(rng) for _ in range(30)]
+
+    for body in bodies:
+        doc = convert_latex_subset(body)
+        assert doc is not None, body
+
+        # The same reader configuration as the filter's nested conversions.
+        pandoc_doc = json.loads(pypandoc.convert_text(
+            body, 'json',
+            format=pynoweb_tools.pandoc_utils.nested_pandoc_format,
+            extra_args=pynoweb_tools.pandoc_utils.nested_pandoc_args))
+
+        assert normalize(doc['blocks']) == \
+            normalize(pandoc_doc['blocks']), body
+
+
+def test_latex_filter_fast_path(monkeypatch, tmp_path):
+    def convert_text(source, to, format=None, extra_args=()):
+        raise AssertionError("Pandoc shouldn't be called")
+
+    monkeypatch.delenv('PYNOWEB_LATEX_FAST_PATH', raising=False)
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils.pypandoc,
+                        'convert_text', convert_text)
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils, 'env_cache', False)
+
+    profile_path = tmp_path / 'profile.json'
+    doc = {'pandoc-api-version': [1, 17, 0, 5],
+           'meta': {'filter_profile': {'t': 'MetaString',
+                                       'c': str(profile_path)}},
+           'blocks': [Para([Str('Intro')])] + [
+               RawBlock('latex', '\\begin{remark}' + body + '\\end{remark}')
+               for body in subset_bodies[:3]]}
+
+    doc = pynoweb_tools.pandoc_utils.LatexFilter().apply(doc)
+
+    assert [b['t'] for b in doc['blocks']] == ['Para', 'Div', 'Div', 'Div']
+
+    report = json.loads(profile_path.read_text())
+    assert report['env_cache']['fast_path'] == 3
+    assert report['env_cache']['fast_path_fallbacks'] == 0
+    assert report['nested_conversions']['count'] == 0
@@ -0,0 +1,60 @@
+'''
+Tests for batch filtering of Pandoc JSON AST files.
+'''
+import json
+
+from pandocfilters import Para, RawInline, Str
+
+from pynoweb_tools.pandoc_batch import (filter_files, filtered_path,
+                                        read_manifest)
+
+
+def write_doc(path, blocks):
+    path.write_text(json.dumps({'pandoc-api-version': [1, 17, 0, 5],
+                                'meta': {},
+                                'blocks': blocks}))
+    return str(path)
+
+
+def test_filter_files(tmp_path):
+    good_path = write_doc(tmp_path / 'good.json',
+                          [Para([Str('a'),
+                                 RawInline('latex', '\\noindent')])])
+    bad_path = tmp_path / 'bad.json'
+    bad_path.write_text('{"blocks": [')
+
+    manifest_path = tmp_path / 'manifest.txt'
+    manifest_path.write_text('# A comment\n\ngood.json\nbad.json\n')
+
+    paths = read_manifest(str(manifest_path))
+    assert paths == [good_path, str(bad_path)]
+
+    for workers in (1, 2):
+        results = filter_files(paths, 'html', workers=workers)
+
+        # The broken document shouldn't stop the good one.
+        assert [r['input'] for r in results] == paths
+        assert results[0]['error'] is None
+        assert results[1]['error'] is not None
+        assert all(r['seconds'] >= 0 for r in results)
+
+        assert results[0]['output'] == filtered_path(good_path)
+        with open(results[0]['output']) as f:
+            assert json.load(f)['blocks'] == [Para([Str('a')])]
+
+
+def test_filter_files_profiles(monkeypatch, tmp_path):
+    monkeypatch.setenv('PYNOWEB_FILTER_PROFILE', '1')
+    monkeypatch.chdir(tmp_path)
+
+    paths = [write_doc(tmp_path / name, [Para([Str(name)])])
+             for name in ('first.json', 'second.json')]
+
+    results = filter_files(paths, 'html', workers=2)
+    assert all(r['error'] is None for r in results)
+
+    # Each document gets its own report instead of sharing the default.
+    for name in ('first', 'second'):
+        with open(str(tmp_path / (name + '.profile.json'))) as f:
+            assert json.load(f)['nodes']['Para']['count'] == 1
+    assert not (tmp_path / 'pynoweb_filter_profile.json').exists()
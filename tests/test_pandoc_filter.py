@@ -25,11 +25,9 @@ import logging
 import json
 # import pytest
 
-import pandocfilters
 import pypandoc
 
 import pynoweb_tools.pandoc_utils
-from pynoweb_tools.pandoc_utils import latex_prefilter
 
 # logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(
@@ -85,11 +83,9 @@ def debug_example():
     # filter_res = json.dumps(json_json_res)
 
     # Apply our filter...
-    # Make sure we clear out the global(s)...
-    pynoweb_tools.pandoc_utils.processed_figures = dict()
-    from pynoweb_tools.pandoc_utils import latex_prefilter
-    filter_res = pandocfilters.applyJSONFilters(
-        [latex_prefilter], json_res, format='json')
+    # (with a new `LatexFilter`, so there's no state from other documents).
+    filter_res = json.dumps(
+        pynoweb_tools.pandoc_utils.apply_latex_prefilter(json_json_res))
 
     filter_json_res = json.loads(filter_res)
 
@@ -315,36 +311,41 @@ def test_nested_envir_2():
 
     \end{document}
     '''
-    json_res = pypandoc.convert_text(test_file_exa,
-                                     # 'markdown_github+markdown_in_html_blocks',
-                                     'json',
-                                     format='latex',
-                                     extra_args=('-s', '-R', '--wrap=none'),
-                                     )
-    # json_json_res = json.loads(json_res)
-
-    pynoweb_tools.pandoc_utils.processed_figures = dict()
+    json_res = pypandoc.convert_text(
+        test_file_exa,
+        # 'markdown_github+markdown_in_html_blocks',
+        'json',
+        format=pynoweb_tools.pandoc_utils.nested_pandoc_format,
+        extra_args=pynoweb_tools.pandoc_utils.nested_pandoc_args,
+    )
+    json_json_res = json.loads(json_res)
 
-    filter_res = pandocfilters.applyJSONFilters(
-        [latex_prefilter], json_res, format='json')
+    # A new `LatexFilter`, so there's no state from other documents.
+    filter_res = json.dumps(
+        pynoweb_tools.pandoc_utils.apply_latex_prefilter(json_json_res))
 
     # filter_json_res = json.loads(filter_res)
 
     pandoc_res = pypandoc.convert_text(filter_res,
                                        'markdown_github+markdown_in_html_blocks',
                                        format='json',
-                                       extra_args=('-s', '-R', '--wrap=none'),
+                                       extra_args=('-s', '--wrap=none'),
                                        )
 
     # print(pandoc_res)
 
-    # Make sure our nested div environments made it into the output.
-    div_env_str = (r'<div class="proof" markdown="" env-number="1"'
-                   r' title-name="">')
+    # Make sure our div environments made it into the output...
+    div_env_str = (r'<div id="lem:a_lemma" class="lemma" markdown=""'
+                   r' env-number="1" title-name="">')
     assert div_env_str in pandoc_res
 
+    # ...along with the nested one (a `proof`, which Pandoc 2 and later
+    # convert on their own).
+    assert '<div class="proof">' in pandoc_res
+    assert 'Obviously true!' in pandoc_res
+
     # Make sure our nested lemma reference made it in.
-    div_lemma_str = r'Lemma $\\eqref{lem:a\_lemma}$ '
+    div_lemma_str = r'Lemma $\eqref{lem:a_lemma}$ '
     assert div_lemma_str in pandoc_res
 
 
@@ -0,0 +1,103 @@
+'''
+Tests for the Pandoc server client, run against a small stand-in server
+that speaks the `pandoc server` protocol.
+'''
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import pynoweb_tools.pandoc_utils
+from pynoweb_tools.pandoc_server import (PandocServerClient,
+                                         PandocServerError, server_options)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/version':
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b'3.1')
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        options = json.loads(self.rfile.read(length).decode('utf-8'))
+        self.requests.append(options)
+
+        output = json.dumps({'pandoc-api-version': [1, 17, 0, 5],
+                             'meta': {},
+                             'blocks': [{'t': 'Para',
+                                         'c': [{'t': 'Str',
+                                                'c': options['text']}]}]})
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps({'output': output, 'base64': False,
+                                     'messages': []}).encode('utf-8'))
+
+
+@pytest.fixture
+def stand_in_server():
+    StandInHandler.requests = []
+    server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_server_options():
+    options = server_options('json', 'latex', ('-s', '-R', '--wrap=none'))
+    assert options == {'from': 'latex+raw_tex', 'to': 'json',
+                       'standalone': True, 'wrap': 'none'}
+
+    with pytest.raises(PandocServerError):
+        server_options('json', 'latex', ('--filter=foo',))
+
+
+def test_server_client(stand_in_server):
+    client = PandocServerClient([stand_in_server])
+
+    assert client.check_health(stand_in_server)
+
+    res = json.loads(client.convert_text('some text', 'json',
+                                         format='latex',
+                                         extra_args=('-s',)))
+    assert res['blocks'][0]['c'][0]['c'] == 'some text'
+    assert StandInHandler.requests[0]['standalone'] is True
+
+
+def test_server_client_unhealthy():
+    # Nothing listens on this port, so the request should fail over.
+    from pynoweb_tools.pandoc_server import find_free_port
+    url = 'http://127.0.0.1:{}'.format(find_free_port())
+    client = PandocServerClient([url], timeout=1.0)
+
+    assert not client.check_health(url)
+
+    with pytest.raises(PandocServerError):
+        client.convert_text('some text', 'json', format='latex')
+
+
+def test_nested_conversion_server(stand_in_server, monkeypatch):
+    monkeypatch.setenv('PYNOWEB_PANDOC_SERVER', stand_in_server)
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils,
+                        'pandoc_server_client', None)
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils,
+                        'nested_pandoc_args', ('-s', '--wrap=none'))
+
+    res = pynoweb_tools.pandoc_utils.convert_latex_env('env body')
+
+    assert json.loads(res)['blocks'][0]['c'][0]['c'] == 'env body'
+    assert len(StandInHandler.requests) == 1
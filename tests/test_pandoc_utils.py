@@ -0,0 +1,447 @@
+'''
+Unit tests for `pynoweb_tools.pandoc_utils` that work directly on Pandoc
+JSON ASTs.  The nested Pandoc conversions are replaced with a simple
+paragraph splitter, so these don't need a Pandoc installation.
+'''
+import os
+import json
+
+from pandocfilters import (walk, RawBlock, RawInline, Para, Str, Space,
+                           Math, Emph, Div, BlockQuote)
+
+import pynoweb_tools.pandoc_utils
+from pynoweb_tools.cache import DiskCache
+
+
+def fake_convert_text(source, to, format=None, extra_args=()):
+    r''' Convert text to Pandoc JSON with one `Para` per paragraph.
+    '''
+    fake_convert_text.calls += 1
+    paras = [p.strip() for p in source.split('\n\n') if p.strip()]
+    return json.dumps({'pandoc-api-version': [1, 17, 0, 5],
+                       'meta': {},
+                       'blocks': [Para([Str(p)]) for p in paras]})
+
+
+fake_convert_text.calls = 0
+
+
+def make_doc(blocks):
+    return {'pandoc-api-version': [1, 17, 0, 5],
+            'meta': {},
+            'blocks': blocks}
+
+
+def test_batch_convert_latex_envs(monkeypatch):
+    # The bodies are simple enough for the fast path (see `latex_subset`).
+    monkeypatch.setenv('PYNOWEB_LATEX_FAST_PATH', '0')
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils.pypandoc,
+                        'convert_text', fake_convert_text)
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils, 'env_cache', False)
+    fake_convert_text.calls = 0
+
+    envs = [r'\begin{Exa}\label{ex:first}first body\end{Exa}',
+            r'\begin{Exa}second body\end{Exa}',
+            r'\begin{remark}third body\end{remark}']
+    doc = make_doc([RawBlock('latex', e) for e in envs])
+
+    doc = pynoweb_tools.pandoc_utils.apply_latex_prefilter(doc)
+
+    # All three environments should come from one Pandoc call.
+    assert fake_convert_text.calls == 1
+
+    div_blocks = doc['blocks']
+    assert [b['t'] for b in div_blocks] == ['Div', 'Div', 'Div']
+
+    div_attr, div_content = div_blocks[0]['c']
+    assert div_attr[0] == 'ex:first'
+    assert div_attr[1] == ['example']
+    assert div_content[-1] == Para([Str('first body')])
+
+    div_attr, div_content = div_blocks[2]['c']
+    assert div_attr[1] == ['remark']
+    assert ['env-number', '1'] in div_attr[2]
+    assert div_content == [Para([Str('third body')])]
+
+
+def test_batch_convert_latex_envs_fallback(monkeypatch):
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils.pypandoc,
+                        'convert_text', fake_convert_text)
+
+    # A body that produces an extra separator can't be split back apart.
+    separator = pynoweb_tools.pandoc_utils.env_batch_separator
+    res = pynoweb_tools.pandoc_utils.convert_latex_envs(
+        ['first body\n\n' + separator, 'second body'])
+
+    assert res is None
+
+    # The filter then converts such a body once, however often it's used.
+    monkeypatch.setenv('PYNOWEB_LATEX_FAST_PATH', '0')
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils, 'env_cache', False)
+    fake_convert_text.calls = 0
+
+    env = '\\begin{Exa}first body\n\n' + separator + '\\end{Exa}'
+    doc = make_doc([RawBlock('latex', env) for _ in range(3)])
+    doc = pynoweb_tools.pandoc_utils.apply_latex_prefilter(doc)
+
+    # The failed batch, then one conversion of its own.
+    assert fake_convert_text.calls == 2
+    assert [b['c'][1] for b in doc['blocks']] == \
+        [[Para([Str('first body')]), Para([Str(separator)])]] * 3
+
+
+def test_env_cache(monkeypatch, tmp_path):
+    monkeypatch.setenv('PYNOWEB_LATEX_FAST_PATH', '0')
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils.pypandoc,
+                        'convert_text', fake_convert_text)
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils, 'env_cache',
+                        DiskCache(str(tmp_path)))
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils,
+                        'nested_pandoc_version', '1.19.2')
+
+    envs = [r'\begin{Exa}first body\end{Exa}',
+            r'\begin{Exa}second body\end{Exa}']
+
+    for _ in range(2):
+        fake_convert_text.calls = 0
+
+        doc = make_doc([RawBlock('latex', e) for e in envs])
+        doc = pynoweb_tools.pandoc_utils.apply_latex_prefilter(doc)
+
+        assert [b['t'] for b in doc['blocks']] == ['Div', 'Div']
+
+    # The rebuild should be served entirely from the cache.
+    assert fake_convert_text.calls == 0
+
+    cache = pynoweb_tools.pandoc_utils.env_cache
+    assert cache.stats['hits'] == 2
+    assert cache.stats['misses'] == 2
+
+
+def test_latex_filter_several_envs(monkeypatch):
+    monkeypatch.setenv('PYNOWEB_LATEX_FAST_PATH', '0')
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils.pypandoc,
+                        'convert_text', fake_convert_text)
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils, 'env_cache', False)
+
+    # Every top-level environment in a RawBlock becomes a Div, and nested
+    # ones with the same name don't end their parents.
+    env = ('\\begin{remark}[A]\\label{rem:a}first\\end{remark}\n'
+           '\\begin{remark}second \\begin{remark}third\\end{remark}'
+           '\\end{remark}')
+    doc = make_doc([RawBlock('latex', env)])
+
+    doc = pynoweb_tools.pandoc_utils.apply_latex_prefilter(doc)
+
+    assert [b['t'] for b in doc['blocks']] == ['Div', 'Div']
+
+    first_attr, first_content = doc['blocks'][0]['c']
+    assert first_attr[0] == 'rem:a'
+    assert ['title-name', '[A]'] in first_attr[2]
+    assert first_content[-1] == Para([Str('first')])
+
+    second_attr, second_content = doc['blocks'][1]['c']
+    assert ['env-number', '2'] in second_attr[2]
+    assert second_content == [Para([Str(
+        'second \\begin{remark}third\\end{remark}')])]
+
+
+def test_filter_config():
+    from pandocfilters import walk, RawInline
+
+    preserved_tex = list(pynoweb_tools.pandoc_utils.preserved_tex)
+
+    def meta_inlines(tex):
+        return {'t': 'MetaInlines', 'c': [RawInline('tex', tex)]}
+
+    # The meta data as Pandoc reads it from a YAML block.
+    meta = {'preserved_tex': {'t': 'MetaList',
+                              'c': [meta_inlines('\\autoref'),
+                                    meta_inlines('\\nameref')]},
+            'custom_inline_math': {'t': 'MetaMap',
+                                   'c': {'\\R': meta_inlines('\\mathbb{R}')}},
+            'figure_dir': {'t': 'MetaInlines', 'c': [Str('figures')]},
+            'figure_ext': {'t': 'MetaString', 'c': 'png'}}
+    doc = make_doc([Para([RawInline('latex', '\\noindent')])
+                    for _ in range(10)])
+    doc['meta'] = meta
+
+    walk(doc, pynoweb_tools.pandoc_utils.latex_prefilter, 'html', meta)
+
+    # The meta data shouldn't accumulate in the module-level defaults.
+    assert pynoweb_tools.pandoc_utils.preserved_tex == preserved_tex
+
+    config = pynoweb_tools.pandoc_utils.get_filter_config(meta)
+    assert config.preserved_tex == preserved_tex + ['\\autoref',
+                                                    '\\nameref']
+    assert config.custom_inline_math['\\R'] == '\\mathbb{R}'
+    assert config.figure_dir == 'figures'
+    assert config.fig_fname_ext == 'png'
+    assert config.inline_tex_matcher.rewrite('\\autoref{a} in \\R') == (
+        True, '\\autoref{a} in \\mathbb{R}')
+
+    # ...and as it's set on the command line (e.g. `-M
+    # preserved_tex=\autoref`).
+    cli_config = pynoweb_tools.pandoc_utils.FilterConfig(
+        {'preserved_tex': {'t': 'MetaString', 'c': '\\autoref'},
+         'figure_ext': {'t': 'MetaList',
+                        'c': [{'t': 'MetaString', 'c': 'png'},
+                              {'t': 'MetaString', 'c': 'pdf'}]}})
+    assert cli_config.preserved_tex == preserved_tex + ['\\autoref']
+    assert cli_config.fig_fname_ext == ['png', 'pdf']
+
+    # A new document gets a new configuration.
+    new_config = pynoweb_tools.pandoc_utils.get_filter_config({})
+    assert new_config is not config
+    assert new_config.fig_fname_ext is None
+
+
+def test_latex_filter_state(monkeypatch):
+    from pandocfilters import Image
+    from pynoweb_tools.pandoc_utils import LatexFilter
+
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils.pypandoc,
+                        'convert_text', fake_convert_text)
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils, 'env_cache', False)
+
+    def make_fig_doc(figure_dir):
+        doc = make_doc([RawBlock('latex',
+                                 r'\begin{Exa}first body\end{Exa}'),
+                        Para([Image(['', [], []], [], ['fig.pdf', ''])])])
+        doc['meta'] = {'figure_dir': {'t': 'MetaString', 'c': figure_dir},
+                       'figure_ext': {'t': 'MetaString', 'c': 'png'}}
+        return doc
+
+    first_filter = LatexFilter()
+    first_doc = first_filter.apply(make_fig_doc('first_figs'))
+
+    second_filter = LatexFilter()
+    second_doc = second_filter.apply(make_fig_doc('second_figs'))
+
+    # Neither figure directories nor environment numbers should leak
+    # between documents.
+    assert first_filter.figure_dirs == {'first_figs'}
+    assert second_filter.figure_dirs == {'second_figs'}
+
+    for doc, figure_dir in ((first_doc, 'first_figs'),
+                            (second_doc, 'second_figs')):
+        assert ['env-number', '1'] in doc['blocks'][0]['c'][0][2]
+        image = doc['blocks'][1]['c'][0]
+        assert image['c'][2][0] == figure_dir + '/fig.png'
+
+
+def test_inline_tex_matcher():
+    from pynoweb_tools.pandoc_utils import get_inline_tex_matcher
+
+    matcher = get_inline_tex_matcher(('\\includegraphics', '\\cref'),
+                                     (('\\R', '\\mathbb{R}'),))
+
+    # The same command set shouldn't be recompiled.
+    assert matcher is get_inline_tex_matcher(
+        ('\\includegraphics', '\\cref'), (('\\R', '\\mathbb{R}'),))
+
+    assert matcher.rewrite('\\noindent') == (False, '\\noindent')
+    assert matcher.rewrite('\\cref{eq:a} in \\R') == (
+        True, '\\cref{eq:a} in \\mathbb{R}')
+
+    is_preserved, new_value = matcher.rewrite(
+        '\\includegraphics[width=2in]{a/fig.pdf}',
+        lambda fig_name: 'figures/fig.png')
+    assert is_preserved
+    assert new_value == '\\includegraphics[width=2in]{figures/fig.png}'
+
+
+def test_latex_prefilter_raw_inline():
+    from pynoweb_tools.pandoc_utils import latex_prefilter
+
+    res = latex_prefilter('RawInline', ['latex', '\\Cref{lem:a}'],
+                          'html', {})
+    assert res == [Str(u'Lemma\xa0'),
+                   {'t': 'Math', 'c': [{'t': 'InlineMath', 'c': []},
+                                       '\\eqref{lem:a}']}]
+
+    # Non-preserved commands are dropped.
+    assert latex_prefilter('RawInline', ['latex', '\\noindent'],
+                           'html', {}) == []
+
+
+def test_walk_ast():
+    from pynoweb_tools.pandoc_utils import walk_ast
+
+    def action(key, value, oformat, meta):
+        if key == 'Emph':
+            return value
+        elif key == 'RawInline':
+            return []
+        elif key == 'Math':
+            return Str(value[1])
+
+    def make_blocks():
+        return [Para([Str('a'), Space(),
+                      Emph([Str('b'), RawInline('tex', 'c')]),
+                      Math({'t': 'InlineMath', 'c': []}, 'd')]),
+                Div(['', [], []], [BlockQuote([Para([Emph([Str('e')])])])])]
+
+    handlers = dict.fromkeys(['Emph', 'RawInline', 'Math'], action)
+
+    blocks = make_blocks()
+    res = walk_ast(blocks, handlers, '', {})
+
+    assert res is blocks
+    assert res == walk(make_blocks(), action, '', {})
+    assert res[0] == Para([Str('a'), Space(), Str('b'), RawInline('tex', 'c'),
+                           Str('d')])
+
+    # Deeply nested documents don't reach the recursion limit.
+    deep = Para([Str('x')])
+    for _ in range(10000):
+        deep = BlockQuote([deep])
+    walk_ast([deep], handlers, '', {})
+
+
+def test_latex_filter_image_caption():
+    from pandocfilters import Image
+
+    # Figure captions are filtered, too.
+    doc = make_doc([Para([Image(['', [], []],
+                                [Str('See'),
+                                 RawInline('latex', r'\cref{eq:1}')],
+                                ['plot.pdf', ''])])])
+
+    latex_filter = pynoweb_tools.pandoc_utils.LatexFilter()
+    doc = latex_filter.apply(doc, 'html')
+
+    image = doc['blocks'][0]['c'][0]
+    assert image['t'] == 'Image'
+    assert image['c'][1] == [Str('See'), Str('Equation\xa0'),
+                             Math({'t': 'InlineMath', 'c': []},
+                                  r'\eqref{eq:1}')]
+
+
+def test_latex_filter_display_math(monkeypatch):
+    def convert_text(source, to, format=None, extra_args=()):
+        return json.dumps(make_doc([Para([Math({'t': 'DisplayMath', 'c': []},
+                                               'x')])]))
+
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils.pypandoc,
+                        'convert_text', convert_text)
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils, 'env_cache', False)
+
+    doc = make_doc([RawBlock('latex', r'\begin{remark}$$x$$\end{remark}')])
+    doc = pynoweb_tools.pandoc_utils.apply_latex_prefilter(doc)
+
+    # The environment's equation is only wrapped once.
+    math = doc['blocks'][0]['c'][1][0]['c'][0]
+    assert math['c'][1] == '\\begin{equation*}\nx\n\\end{equation*}'
+
+
+def test_latex_filter_nested_envs(monkeypatch):
+    def convert_text(source, to, format=None, extra_args=()):
+        convert_text.calls += 1
+        blocks = []
+        for par in source.split('\n\n'):
+            par = par.strip()
+            if par.startswith('\\begin'):
+                blocks.append(RawBlock('latex', par))
+            elif par.startswith('$$'):
+                blocks.append(Para([Math({'t': 'DisplayMath', 'c': []},
+                                         par.strip('$'))]))
+            elif par:
+                blocks.append(Para([Str(par)]))
+        return json.dumps(make_doc(blocks))
+
+    convert_text.calls = 0
+
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils.pypandoc,
+                        'convert_text', convert_text)
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils, 'env_cache', False)
+
+    # The same environment twice, each with a nested environment.
+    env = ('\\begin{theorem}$$x$$\n\n'
+           '\\begin{proof}$$y$$\\end{proof}\\end{theorem}')
+    doc = make_doc([RawBlock('latex', env), RawBlock('latex', env)])
+
+    latex_filter = pynoweb_tools.pandoc_utils.LatexFilter()
+    doc = latex_filter.apply(doc)
+
+    # One Pandoc call per level of nesting.
+    assert convert_text.calls == 2
+
+    # Both copies are filtered the same way, and only once.
+    for i, div in enumerate(doc['blocks']):
+        attr, (math_para, proof) = div['c']
+        assert ['env-number', str(i + 1)] in attr[2]
+        assert math_para['c'][0]['c'][1] == \
+            '\\begin{equation*}\nx\n\\end{equation*}'
+
+        proof_attr, (proof_para,) = proof['c']
+        assert ['env-number', str(i + 1)] in proof_attr[2]
+        assert proof_para['c'][0]['c'][1] == \
+            '\\begin{equation*}\ny\n\\end{equation*}'
+
+    # The last uses took the converted documents.
+    assert latex_filter.converted_env_bodies == {}
+    assert latex_filter.env_body_uses == {}
+
+
+def test_filter_profile(monkeypatch, tmp_path):
+    from pandocfilters import RawInline, Math, Image
+    from pynoweb_tools.filter_profile import get_profile_path
+
+    monkeypatch.setenv('PYNOWEB_LATEX_FAST_PATH', '0')
+
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils.pypandoc,
+                        'convert_text', fake_convert_text)
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils, 'env_cache', False)
+    monkeypatch.delenv('PYNOWEB_FILTER_PROFILE', raising=False)
+
+    assert get_profile_path({}) is None
+    assert get_profile_path({}, {'PYNOWEB_FILTER_PROFILE': '1'}) == \
+        'pynoweb_filter_profile.json'
+    # Documents read from files each get their own default report.
+    assert get_profile_path({}, {'PYNOWEB_FILTER_PROFILE': '1'},
+                            source=os.path.join('docs', 'a.json')) == \
+        os.path.join('docs', 'a.profile.json')
+    assert get_profile_path({'filter_profile': {'t': 'MetaBool',
+                                                'c': False}},
+                            {'PYNOWEB_FILTER_PROFILE': '1'}) is None
+
+    doc = make_doc([
+        RawBlock('latex', r'\begin{Exa}first body\end{Exa}'),
+        RawBlock('latex', r'\begin{Exa}second body\end{Exa}'),
+        Para([RawInline('latex', r'\cref{eq:a}'),
+              Image(['', [], []], [], ['plot.pdf', '']),
+              Math({'t': 'DisplayMath', 'c': []}, 'x')])])
+
+    # Disabled, the filter keeps no profile.
+    latex_filter = pynoweb_tools.pandoc_utils.LatexFilter()
+    latex_filter.apply(json.loads(json.dumps(doc)), 'html')
+    assert latex_filter.profile is None
+
+    profile_path = tmp_path / 'profile.json'
+    doc['meta']['filter_profile'] = {'t': 'MetaString',
+                                     'c': str(profile_path)}
+
+    latex_filter = pynoweb_tools.pandoc_utils.LatexFilter()
+    latex_filter.apply(doc, 'html')
+
+    report = json.loads(profile_path.read_text())
+
+    assert report['handlers']['process_latex_envs']['count'] == 2
+    assert report['handlers']['inline_tex']['count'] == 1
+    assert report['handlers']['process_image']['count'] == 1
+    assert report['handlers']['display_math']['count'] == 1
+    assert report['nodes']['RawBlock']['count'] == 2
+
+    # The `Para`s within the environment bodies are counted, and their time
+    # is excluded from the environments' own time.
+    assert report['nodes']['Para']['count'] >= 3
+    env_times = report['handlers']['process_latex_envs']
+    assert env_times['self_seconds'] <= env_times['seconds']
+
+    assert report['nested_conversions']['count'] == 1
+    assert report['nested_conversions']['calls'][0]['bodies'] == 2
+    assert report['env_cache']['batched'] == 2
+    assert report['env_cache']['batch_hits'] == 2
+    assert report['env_cache']['single_conversions'] == 0
+    assert report['figure_lookups']['count'] == 1
@@ -0,0 +1,19 @@
+'''
+Tests for the command-line entry points.
+'''
+import sys
+import subprocess
+
+
+def test_filter_imports():
+    # `PynowebFilter` runs once per document, so it mustn't pay for the
+    # weave-only imports.
+    code = ("import sys, pynoweb_tools.scripts; "
+            "print(' '.join(sys.modules))")
+    modules = subprocess.check_output([sys.executable, '-c', code],
+                                      universal_newlines=True).split()
+    packages = set(m.split('.')[0] for m in modules)
+
+    assert 'pynoweb_tools.pandoc_utils' in modules
+    assert not packages & set(['pweave', 'jupyter_client', 'nbformat',
+                               'IPython'])
@@ -0,0 +1,130 @@
+'''
+Tests for the weaving helpers in `pynoweb_tools.utils`.
+'''
+import io
+import os
+import contextlib
+from functools import partial
+
+import pytest
+
+from pweave import Pweb
+from pweave.processors.base import PwebProcessorBase
+
+from pynoweb_tools.pweave_objs.formatters import PwebMintedPandocFormatter
+from pynoweb_tools.utils import (document_paths, weave_documents,
+                                 stream_weave)
+
+
+def test_document_paths():
+    source = os.path.join('reports', 'first.texw')
+
+    assert document_paths(source) == (os.path.join('reports', 'first.tex'),
+                                      'figures')
+    assert document_paths(source, 'build/{name}.md', 'figures/{name}') == \
+        ('build/first.md', 'figures/first')
+    assert document_paths('first.texw', 'out.tex') == ('out.tex', 'figures')
+
+
+def test_weave_documents_failures(tmp_path):
+    sources = [str(tmp_path / 'missing_1.texw'),
+               str(tmp_path / 'missing_2.texw')]
+
+    results = weave_documents(sources, figdir='figures/{name}', jobs=2)
+
+    assert [r['input'] for r in results] == sources
+    assert all(r['error'] is not None for r in results)
+    assert all(r['seconds'] >= 0 for r in results)
+
+
+def test_weave_documents_shared_paths(tmp_path):
+    sources = [str(tmp_path / 'a' / 'first.texw'),
+               str(tmp_path / 'b' / 'second.texw')]
+
+    with pytest.raises(ValueError, match='same output file'):
+        weave_documents(sources, output=str(tmp_path / 'out.tex'))
+
+    with pytest.raises(ValueError, match='same figure directory'):
+        weave_documents(sources, output=str(tmp_path / '{name}.tex'))
+
+    with pytest.raises(ValueError, match='same figure directory'):
+        weave_documents(sources, output='{dir}/{name}.tex',
+                        figdir=str(tmp_path / 'figures'))
+
+    # Nothing was started.
+    assert not any(tmp_path.iterdir())
+
+
+class NamespaceProcessor(PwebProcessorBase):
+    r""" Runs the code in a Python namespace instead of a kernel.
+    """
+
+    def __init__(self, *args):
+        super(NamespaceProcessor, self).__init__(*args)
+        self.ns = {}
+
+    def loadstring(self, code, chunk=None):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            exec(code, self.ns)
+        return [{'output_type': 'stream', 'name': 'stdout',
+                 'text': out.getvalue()}]
+
+
+def test_stream_weave(tmp_path):
+    source_path = tmp_path / 'doc.texw'
+    source_path.write_text('\n\n'.join(
+        'Text {0}.\n\n<<name="c{0}">>=\nprint({0} * 2)\n@'.format(i)
+        for i in range(20)))
+
+    def make_weaver(output):
+        weaver = Pweb(str(source_path), doctype='tex', kernel='python3',
+                      output=str(tmp_path / output))
+        weaver.setformat(Formatter=PwebMintedPandocFormatter)
+        return weaver
+
+    weaver = make_weaver('whole.tex')
+    weaver.run = partial(weaver.run, Processor=NamespaceProcessor)
+    weaver.weave()
+
+    written = []
+
+    weaver = make_weaver('streamed.tex')
+    format_chunk = weaver.formatter.format_chunk
+
+    def recording_format_chunk(chunk):
+        # Everything formatted so far is already in the output file.
+        with open(weaver.sink) as f:
+            written.append(f.read())
+        return format_chunk(chunk)
+
+    weaver.formatter.format_chunk = recording_format_chunk
+    stream_weave(weaver, Processor=NamespaceProcessor)
+
+    whole = (tmp_path / 'whole.tex').read_text()
+    assert (tmp_path / 'streamed.tex').read_text() == whole
+    assert '\\begin{minted}[xleftmargin=0.5em]{python}' in whole
+    assert written[-1] and whole.startswith(written[-1])
+
+    # Incrementally, too.
+    weaver = make_weaver('incremental.tex')
+    stream_weave(weaver, Processor=NamespaceProcessor, incremental=True)
+    assert (tmp_path / 'incremental.tex').read_text() == whole
+
+
+def test_formatfigure():
+    formatter = PwebMintedPandocFormatter([])
+
+    chunk = {'figure': ['figures/a.png', 'figures/b.png'],
+             'caption': 'Two plots', 'f_env': None, 'f_pos': 'htpb',
+             'name': 'plots', 'fig_root': 'img',
+             'graphics_opts': 'height = 2in'}
+
+    assert formatter.formatfigure(chunk) == (
+        "\\begin{figure}[htpb]\n"
+        "\\center\n"
+        "\\includegraphics[width=\\textwidth,height=2in]{img/a.png}\n"
+        "\\includegraphics[width=\\textwidth,height=2in]{img/b.png}\n"
+        "\\caption{Two plots}\n"
+        "\\label{fig:plots}\n"
+        "\\end{figure}\n")
@@ -0,0 +1,149 @@
+'''
+Tests for the watch mode's change detection and rebuild stages.
+'''
+import os
+import threading
+
+import pynoweb_tools.pandoc_utils
+from pynoweb_tools.watch import Watcher, WatchBuild
+
+
+def touch(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    # Make sure the modification time changes, whatever the clock's
+    # resolution.
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_watcher(tmp_path):
+    source = tmp_path / 'doc.texw'
+    fig_dir = tmp_path / 'figures'
+    fig_dir.mkdir()
+    touch(str(source), 'a')
+
+    watcher = Watcher([str(source), str(fig_dir)])
+    assert watcher.changes() == set()
+
+    touch(str(source), 'b')
+    assert watcher.changes() == set([str(source)])
+    assert watcher.changes() == set()
+
+    touch(str(fig_dir / 'a.png'), '')
+    assert watcher.changes() == set([str(fig_dir)])
+
+    assert watcher.wait(interval=0.01, timeout=0.05) == set()
+
+    # A burst of writes ends up in one set of changes.
+    def writes():
+        for i in range(3):
+            touch(str(source), str(i))
+            threading.Event().wait(0.02)
+        touch(str(fig_dir / 'b.png'), '')
+
+    writer = threading.Thread(target=writes)
+    writer.start()
+    changed = watcher.wait(interval=0.01, debounce=0.2, timeout=5)
+    writer.join()
+
+    assert changed == set([str(source), str(fig_dir)])
+    assert watcher.changes() == set()
+
+    # Our own writes aren't changes once refreshed.
+    touch(str(source), 'c')
+    touch(str(fig_dir / 'c.png'), '')
+    watcher.refresh([str(fig_dir)])
+    assert watcher.changes() == set([str(source)])
+
+
+def test_watch_build_stages(tmp_path):
+    source = str(tmp_path / 'doc.texw')
+    bib = str(tmp_path / 'refs.bib')
+
+    build = WatchBuild(source, pandoc_output=str(tmp_path / 'doc.md'),
+                       bibliographies=[bib])
+
+    assert build.pandoc_to == 'markdown'
+    assert build.woven_output == str(tmp_path / 'doc.tex')
+    fig_dir = str(tmp_path / 'figures')
+
+    assert build.stages(set([source])) == ['weave', 'convert']
+    assert build.stages(set([bib])) == ['convert']
+    assert build.stages(set([fig_dir])) == ['convert']
+    assert build.stages(set()) == []
+
+    assert WatchBuild(source).stages(set([source, bib])) == ['weave']
+
+    ran = []
+
+    def weave():
+        ran.append('weave')
+        with open(build.woven_output, 'w') as f:
+            f.write(woven[0])
+        return {'error': None}
+
+    build.weave = weave
+    build.convert = lambda: ran.append('convert')
+
+    woven = ['one']
+    assert build.build(set([source]))['stages'] == ['weave', 'convert']
+
+    # The woven output didn't change, so there's nothing to convert.
+    assert build.build(set([source]))['stages'] == ['weave']
+
+    # ...unless a conversion input changed too.
+    assert build.build(set([source, bib]))['stages'] == ['weave', 'convert']
+
+    woven[0] = 'two'
+    assert build.build(set([source]))['stages'] == ['weave', 'convert']
+
+    assert build.build(set([fig_dir]))['stages'] == ['convert']
+    assert ran == ['weave', 'convert', 'weave', 'weave', 'convert',
+                   'weave', 'convert', 'convert']
+
+    def failing_convert():
+        raise ValueError('bad document')
+
+    build.convert = failing_convert
+    result = build.build(set([bib]))
+    assert 'bad document' in result['error']
+
+    # Without a Pandoc output, the source is only woven.
+    build = WatchBuild(source)
+    build.weave = weave
+    build.convert = failing_convert
+
+    for _ in range(2):
+        result = build.build(set([source]))
+        assert result['stages'] == ['weave']
+        assert result['error'] is None
+
+
+def test_watch_build_convert(monkeypatch, tmp_path):
+    monkeypatch.setattr(pynoweb_tools.pandoc_utils, 'env_cache', False)
+
+    build = WatchBuild(str(tmp_path / 'doc.texw'),
+                       pandoc_output=str(tmp_path / 'doc.md'),
+                       pandoc_args=['--wrap=none'],
+                       bibliographies=['refs.bib'])
+
+    assert build.pandoc_from() == 'latex+raw_tex'
+    # The woven output and the environment bodies are read alike.
+    assert build.pandoc_from() == \
+        pynoweb_tools.pandoc_utils.nested_pandoc_format
+    assert build.convert_args() == ['--wrap=none',
+                                    '--bibliography=refs.bib']
+
+    with open(build.woven_output, 'w') as f:
+        f.write('Some text.\n\n'
+                '\\begin{theorem}\\label{thm:a}\nA result.\n'
+                '\\end{theorem}\n')
+
+    build.convert()
+
+    # The environment reached the prefilter as raw LaTeX.
+    with open(build.pandoc_output) as f:
+        converted = f.read()
+    assert 'Some text.' in converted
+    assert '{#thm:a .theorem' in converted